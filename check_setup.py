@@ -5,6 +5,7 @@ Run this before starting to verify your environment is ready.
 """
 
 import sys
+import importlib.util
 import subprocess
 import os
 from pathlib import Path
@@ -35,10 +36,9 @@ def check_dependencies():
     required = ['yaml', 'pandas', 'PIL', 'openpyxl', 'xlsxwriter', 'pytesseract']
     missing = []
     
+    # find_spec only looks the package up, without the cost of importing it
     for package in required:
-        try:
-            __import__(package)
-        except ImportError:
+        if importlib.util.find_spec(package) is None:
             missing.append(package)
     
     if not missing:
@@ -4,157 +4,406 @@ Expense Parser - Extract structured data from receipts
 No coding required - just configure config.yaml and run!
 """
 
+import io
 import os
+import re
 import sys
 import json
+import csv
 import argparse
-import tempfile
+import time
+import random
+import sqlite3
+import functools
+import hashlib
+import importlib.util
+import threading
+import unicodedata
 import shutil
+import tempfile
+from collections import defaultdict
+import concurrent.futures
+from contextlib import contextmanager
 from pathlib import Path
-from datetime import datetime
-from typing import List, Dict, Any, Optional
+from datetime import datetime, timedelta
+from typing import List, Dict, Any, Iterable, Iterator, Optional, Tuple, TYPE_CHECKING
 import base64
 
-import yaml
-import pandas as pd
-from PIL import Image
-import pytesseract
+if TYPE_CHECKING:
+    from PIL import Image
+    import pandas as pd
 
-# Load environment variables from .env file if present
-try:
-    from dotenv import load_dotenv
-    load_dotenv()
-except ImportError:
-    pass  # python-dotenv not installed, skip
+# Heavy libraries (PyYAML, pandas, Pillow, pytesseract, the provider SDKs) are
+# imported inside the functions that use them, so `--help`, a local-only
+# run or a single receipt only pays for what it actually needs.
 
-# Try to import optional dependencies
-try:
-    import openai
-    HAS_OPENAI = True
-except ImportError:
-    HAS_OPENAI = False
 
-try:
-    import anthropic
-    HAS_ANTHROPIC = True
-except ImportError:
-    HAS_ANTHROPIC = False
+def load_env():
+    """Load environment variables from a .env file if python-dotenv is installed."""
+    try:
+        from dotenv import load_dotenv
+        load_dotenv()
+    except ImportError:
+        pass  # python-dotenv not installed, skip
 
 
 def load_config(config_path: str = "config.yaml") -> Dict[str, Any]:
     """Load user configuration from YAML file."""
+    import yaml
+    
     with open(config_path, 'r', encoding='utf-8') as f:
         return yaml.safe_load(f)
 
 
-def encode_image(image_path: str) -> str:
-    """Encode image to base64 for API calls."""
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
+# Bump whenever the extraction prompt changes, so cached answers from the
+# old prompt are not reused.
+PROMPT_VERSION = 3
+
+
+@contextmanager
+def timed(stats: Dict[str, Any], stage: str):
+    """Add the wall time of the block to ``stats['timings'][stage]`` (seconds)."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings = stats.setdefault('timings', {})
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - started
+
+
+def file_hash(path: str) -> str:
+    """Return the SHA-256 hex digest of a file's raw bytes."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def extraction_fingerprint(config: Dict[str, Any]) -> str:
+    """Return the config settings that can change what a receipt parses to.
+
+    Settings that only affect saving (``output_columns``, ``output_format``,
+    ...) are left out, so changing them never invalidates the cache.
+    """
+    provider = config.get('model_provider', 'openai')
+    tiers = routing_tiers(config)
+    adaptive = any(tier.get('image_quality', config.get('image_quality')) == 'adaptive'
+                   for tier in tiers or [config])
+    validation = config.get('validation', {})
+    settings = {
+        'prompt_version': PROMPT_VERSION,
+        'model_provider': provider,
+        'routing': config.get('routing') if tiers else None,
+        'model': config.get('model'),
+        'temperature': config.get('temperature'),
+        'categories': config.get('categories', []),
+        'image_quality': config.get('image_quality', 'medium'),
+        'max_image_size': config.get('max_image_size', 4096),
+    }
+    if tiers:
+        # Which tier's answer is kept
+        settings['escalate_when'] = (config.get('routing') or {}).get('escalate_when')
+        settings['required_fields'] = validation.get('required_fields', [])
+    if adaptive:
+        # Which image size's answer is kept (validate_receipt() warnings re-send too)
+        settings['adaptive_quality'] = config.get('adaptive_quality')
+        settings['validation'] = {key: validation.get(key) for key in
+                                  ('required_fields', 'max_amount', 'no_future_dates')}
+    if provider == 'local' or any(tier.get('provider') == 'local' for tier in tiers):
+        # The rule-based parser also depends on these
+        settings.update({
+            'category_keywords': config.get('category_keywords', {}),
+            'tax_rate': config.get('tax_rate', 0.09),
+            'tax_inclusive': config.get('tax_inclusive', True),
+            'default_currency': config.get('default_currency', 'SGD'),
+        })
+    return json.dumps(settings, sort_keys=True, default=str)
+
+
+class ExtractionCache:
+    """Persistent cache of raw extractions, keyed on image bytes + config.
+
+    Stored in SQLite so reruns (after a crash or a change to output
+    settings) do not pay for the same API call twice. Safe to share
+    between threads.
+    """
+    
+    def __init__(self, path: str, max_entries: int = 50000, max_age_days: int = 90,
+                 refresh: bool = False):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age_days = max_age_days
+        self.refresh = refresh
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS extractions ("
+            " key TEXT PRIMARY KEY,"
+            " data TEXT NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " last_used REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_extractions_last_used ON extractions(last_used)"
+        )
+        self._conn.commit()
+        self.evict()
+    
+    @staticmethod
+    def make_key(content_hash: str, config: Dict[str, Any],
+                 fingerprint: Optional[str] = None) -> str:
+        """Build the cache key for an image (by its file_hash) under the given config.
+
+        ``fingerprint`` overrides the one derived from ``config``, for results
+        produced under an earlier config (e.g. a batch submitted yesterday).
+        """
+        if fingerprint is None:
+            fingerprint = extraction_fingerprint(config)
+        digest = hashlib.sha256(content_hash.encode('ascii'))
+        digest.update(fingerprint.encode('utf-8'))
+        return digest.hexdigest()
+    
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Return a fresh copy of the cached extraction, or None."""
+        if self.refresh:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data FROM extractions WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute(
+                "UPDATE extractions SET last_used = ? WHERE key = ?", (time.time(), key)
+            )
+            self._conn.commit()
+        return json.loads(row[0])
+    
+    def put(self, key: str, data: Dict[str, Any]):
+        """Store an extraction (replacing any previous one for the key)."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO extractions (key, data, created_at, last_used) "
+                "VALUES (?, ?, ?, ?)",
+                (key, json.dumps(data, default=str), now, now)
+            )
+            self._conn.commit()
+    
+    def evict(self):
+        """Drop entries older than max_age_days, then least recently used ones."""
+        with self._lock:
+            if self.max_age_days:
+                cutoff = time.time() - self.max_age_days * 86400
+                self._conn.execute("DELETE FROM extractions WHERE created_at < ?", (cutoff,))
+            if self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM extractions WHERE key IN ("
+                    " SELECT key FROM extractions ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,)
+                )
+            self._conn.commit()
+    
+    def close(self):
+        """Apply eviction and close the database."""
+        self.evict()
+        with self._lock:
+            self._conn.close()
+
+
+def open_cache(config: Dict[str, Any], refresh: bool = False) -> Optional[ExtractionCache]:
+    """Open the extraction cache configured under ``cache:``, if enabled."""
+    cache_config = config.get('cache', {})
+    if not cache_config.get('enabled', True):
+        return None
+    output_folder = config.get('output_folder', './output')
+    path = cache_config.get('path') or os.path.join(output_folder, '.cache', 'extractions.sqlite')
+    return ExtractionCache(
+        path,
+        max_entries=cache_config.get('max_entries', 50000),
+        max_age_days=cache_config.get('max_age_days', 90),
+        refresh=refresh,
+    )
+
+
+# image_quality -> (longest side in pixels, JPEG quality)
+# ("adaptive" tries several of these in turn, see call_provider_adaptive)
+IMAGE_QUALITY = {"low": (1024, 80), "medium": (2048, 85), "high": (4096, 92)}
+
+CONFIDENCE_RANK = {'high': 3, 'medium': 2, 'low': 1}
+
 
+def encode_image(image_bytes: bytes) -> str:
+    """Encode image bytes to base64 for API calls."""
+    return base64.b64encode(image_bytes).decode('ascii')
 
-def resize_image(image_path: str, max_size: int = 4096, quality: str = "medium") -> str:
-    """Resize image if too large, return path to resized image."""
+
+def load_image(image_path: str, max_dim: int) -> "Image.Image":
+    """Open an image, decoding it at no more than about ``max_dim`` pixels.
+
+    JPEGs are decoded straight to a reduced scale (draft mode), other
+    formats are box-reduced by an integer factor, so 12+ MP photos never
+    have to be held in memory at full size.
+    """
+    from PIL import Image
+    
     img = Image.open(image_path)
+    jpeg = img.format == 'JPEG'
+    if jpeg:
+        img.draft('RGB', (max_dim, max_dim))
+    if img.mode not in ('RGB', 'L'):
+        # Before reduce(), which fails on palette, 1-bit and 16-bit images
+        img = img.convert('RGB')
+    if not jpeg:
+        factor = max(img.size) // max_dim
+        if factor >= 2:
+            img = img.reduce(factor)
+    return img
+
+
+def resize_image(image_path: str, max_size: int = 4096, quality: str = "medium") -> bytes:
+    """Downscale an image in memory and return it as JPEG bytes."""
+    from PIL import Image
     
-    # Quality settings
-    quality_map = {"low": 1024, "medium": 2048, "high": 4096}
-    target_size = quality_map.get(quality, 2048)
+    target_size, jpeg_quality = IMAGE_QUALITY.get(quality, IMAGE_QUALITY['medium'])
+    max_dim = min(max_size, target_size)
     
-    # Resize if needed
-    max_dim = max(img.size)
-    if max_dim > max_size:
-        ratio = max_size / max_dim
-        new_size = (int(img.size[0] * ratio), int(img.size[1] * ratio))
-        img = img.resize(new_size, Image.Resampling.LANCZOS)
+    img = load_image(image_path, max_dim)
+    if max(img.size) > max_dim:
+        img.thumbnail((max_dim, max_dim), Image.Resampling.LANCZOS)
     
-    # Save to temp
-    temp_dir = tempfile.gettempdir()
-    temp_path = os.path.join(temp_dir, f"resized_{os.path.basename(image_path)}")
-    img.save(temp_path, quality=95)
-    return temp_path
+    buffer = io.BytesIO()
+    img.save(buffer, format='JPEG', quality=jpeg_quality)
+    return buffer.getvalue()
+
+
+def prepare_image(image_path: str, config: Dict[str, Any],
+                  stats: Optional[Dict[str, Any]] = None) -> str:
+    """Return the base64 JPEG payload to send to a vision API.
+
+    Resize/encode time and image sizes are recorded in ``stats`` if given.
+    """
+    if stats is None:
+        stats = {}
+    with timed(stats, 'resize'):
+        image_bytes = resize_image(
+            image_path,
+            config.get('max_image_size', 4096),
+            config.get('image_quality', 'medium')
+        )
+    with timed(stats, 'encode'):
+        payload = encode_image(image_bytes)
+    # Resized/payload sizes add up if the receipt is sent more than once
+    stats['bytes_original'] = os.path.getsize(image_path)
+    stats['bytes_resized'] = stats.get('bytes_resized', 0) + len(image_bytes)
+    stats['bytes_payload'] = stats.get('bytes_payload', 0) + len(payload)
+    return payload
 
 
 def extract_text_tesseract(image_path: str) -> str:
     """Extract text from image using Tesseract OCR (local, no API)."""
+    import pytesseract
+    from PIL import Image
+    
     img = Image.open(image_path)
     text = pytesseract.image_to_string(img)
     return text
 
 
-def parse_with_openai(image_path: str, config: Dict[str, Any], api_key: str, verbose: bool = False) -> Dict[str, Any]:
-    """Parse receipt using OpenAI Vision API."""
-    client = openai.OpenAI(api_key=api_key)
-    
-    # Resize image
-    resized_path = resize_image(
-        image_path, 
-        config.get('max_image_size', 4096),
-        config.get('image_quality', 'medium')
-    )
-    base64_image = encode_image(resized_path)
-    
-    # Build category list
-    categories = config.get('categories', [])
-    category_list = ", ".join(categories)
+# Fields the vision model fills in: (short key, field name, JSON type, description).
+# The model answers with the short keys, which saves output tokens on every
+# receipt; expand_keys() maps them back to the field names used everywhere else.
+RECEIPT_FIELDS = [
+    ('v', 'vendor', 'string', 'vendor/merchant name'),
+    ('d', 'date', 'string', 'date of transaction, DD/MM/YYYY'),
+    ('c', 'category', 'string', 'expense category'),
+    ('i', 'items', 'array', 'items purchased'),
+    ('st', 'subtotal', 'number', 'subtotal before tax'),
+    ('tx', 'tax', 'number', 'tax amount (GST/VAT)'),
+    ('t', 'total', 'number', 'total amount'),
+    ('cur', 'currency', 'string', 'currency code (SGD, USD, etc.)'),
+    ('pm', 'payment_method', 'string', 'payment method (Cash, Visa, Mastercard, GrabPay, etc.)'),
+    ('no', 'receipt_number', 'string', 'receipt/transaction number if visible'),
+    ('cf', 'confidence', 'string',
+     'high=crystal clear, medium=readable but some ambiguity, low=hard to read or missing info'),
+]
+ITEM_FIELDS = [
+    ('d', 'description', 'string', 'item description'),
+    ('a', 'amount', 'number', 'item amount'),
+]
+
+# Name of the Anthropic tool the receipt is "recorded" with
+RECEIPT_TOOL = 'record_receipt'
+
+
+def build_prompt(config: Dict[str, Any]) -> str:
+    """Build the extraction instructions shared by all vision providers.
+
+    The text depends only on the config, never on the receipt, so it is
+    sent as a fixed prefix the providers can cache. The answer format is
+    enforced separately with receipt_schema().
+    """
+    categories = ", ".join(config.get('categories', []))
+    keys = "; ".join(f"{short}={description}" for short, _, _, description in RECEIPT_FIELDS)
+    item_keys = "; ".join(f"{short}={description}" for short, _, _, description in ITEM_FIELDS)
+    return f"""Extract the expense from the receipt (an image, or text from a PDF) and record it with the receipt schema.
+Keys: {keys}.
+Item keys: {item_keys}.
+Classify the expense into ONE of these categories: {categories}
+If a field is not visible use null (0 for amounts). Be precise with numbers."""
+
+
+def receipt_schema(config: Dict[str, Any]) -> Dict[str, Any]:
+    """Return the JSON schema of a reply, using the short keys."""
+    def properties(fields):
+        return {short: {'type': [json_type, 'null'], 'description': description}
+                for short, _, json_type, description in fields}
     
-    # Build prompt with confidence instruction
-    prompt = f"""Extract the following information from this receipt image:
-    
-1. Vendor/merchant name
-2. Date of transaction (format: DD/MM/YYYY)
-3. Items purchased (list with descriptions and amounts)
-4. Subtotal (before tax)
-5. Tax amount (GST/VAT)
-6. Total amount
-7. Currency (SGD, USD, etc.)
-8. Payment method (Cash, Visa, Mastercard, GrabPay, etc.)
-9. Receipt/transaction number if visible
-10. Confidence score (high/medium/low) based on clarity of extraction
-
-Classify the expense into ONE of these categories: {category_list}
-
-Return ONLY a JSON object with this exact structure:
-{{
-    "vendor": "string",
-    "date": "DD/MM/YYYY",
-    "category": "string",
-    "items": [
-        {{"description": "string", "amount": number}}
-    ],
-    "subtotal": number,
-    "tax": number,
-    "total": number,
-    "currency": "string",
-    "payment_method": "string",
-    "receipt_number": "string or null",
-    "confidence": "high|medium|low"
-}}
-
-If any field is not visible, use null or 0. Be precise with numbers.
-Set confidence based on: high=crystal clear, medium=readable but some ambiguity, low=hard to read or missing info."""
-
-    response = client.chat.completions.create(
-        model=config.get('model', 'gpt-4o-mini'),
-        temperature=config.get('temperature', 0.1),
-        messages=[
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": prompt},
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{base64_image}"
-                        }
-                    }
-                ]
-            }
+    item_schema = {
+        'type': 'object',
+        'properties': properties(ITEM_FIELDS),
+        'required': [short for short, *_ in ITEM_FIELDS],
+        'additionalProperties': False,
+    }
+    fields = properties(RECEIPT_FIELDS)
+    fields['c'] = {'type': 'string', 'enum': list(config.get('categories', [])),
+                   'description': 'expense category'}
+    fields['i'] = {'type': 'array', 'items': item_schema, 'description': 'items purchased'}
+    fields['cf']['type'] = 'string'
+    fields['cf']['enum'] = ['high', 'medium', 'low']
+    return {
+        'type': 'object',
+        'properties': fields,
+        'required': [short for short, *_ in RECEIPT_FIELDS],
+        'additionalProperties': False,
+    }
+
+
+def expand_keys(data: Dict[str, Any]) -> Dict[str, Any]:
+    """Map a reply's short keys back to field names; full names pass through."""
+    names = {short: name for short, name, *_ in RECEIPT_FIELDS}
+    item_names = {short: name for short, name, *_ in ITEM_FIELDS}
+    result = {names.get(key, key): value for key, value in data.items()}
+    if isinstance(result.get('items'), list):
+        result['items'] = [
+            {item_names.get(key, key): value for key, value in item.items()}
+            if isinstance(item, dict) else item
+            for item in result['items']
         ]
-    )
-    
-    # Parse JSON response
-    content = response.choices[0].message.content
+    return result
+
+
+def extract_json(content: str) -> Dict[str, Any]:
+    """Parse the JSON object in a model reply."""
     # Extract JSON from markdown code block if present
     if "```json" in content:
         content = content.split("```json")[1].split("```")[0]
@@ -164,113 +413,741 @@ Set confidence based on: high=crystal clear, medium=readable but some ambiguity,
     return json.loads(content.strip())
 
 
-def parse_with_anthropic(image_path: str, config: Dict[str, Any], api_key: str, verbose: bool = False) -> Dict[str, Any]:
-    """Parse receipt using Anthropic Claude Vision API."""
-    client = anthropic.Anthropic(api_key=api_key)
+def parse_reply(content: Optional[str]) -> Dict[str, Any]:
+    """Turn a model reply into receipt data with full field names."""
+    if not content:
+        # A refused or empty reply has no text at all
+        raise ValueError("The model returned no receipt data")
+    return expand_keys(extract_json(content))
+
+
+def anthropic_reply_text(content: Optional[List[Any]]) -> Optional[str]:
+    """Return the JSON text of an Anthropic reply (the receipt tool call, else the text)."""
+    for block in content or []:
+        if getattr(block, 'type', None) == 'tool_use':
+            return json.dumps(block.input)
+    for block in content or []:
+        if getattr(block, 'type', None) == 'text':
+            return block.text
+    return None
+
+
+def openai_reply_text(message: Any) -> Optional[str]:
+    """Return the JSON text of an OpenAI reply, raising if the model refused."""
+    refusal = getattr(message, 'refusal', None)
+    if refusal:
+        raise ValueError(f"The model refused: {refusal}")
+    return message.content
+
+
+def get_api_key(provider: str) -> str:
+    """Read the API key for a cloud provider from the environment."""
+    env_var = {'openai': 'OPENAI_API_KEY', 'anthropic': 'ANTHROPIC_API_KEY'}[provider]
+    api_key = os.getenv(env_var)
+    if not api_key:
+        raise ValueError(f"{env_var} environment variable not set")
+    return api_key
+
+
+def make_client(provider: str, config: Dict[str, Any], api_key: str):
+    """Create an SDK client, pointed at ``api_base_url`` if configured.
+
+    The client gets its own connection pool sized by the ``http`` config
+    section, keeps connections alive between receipts, speaks HTTP/2 when
+    the ``h2`` package is installed, and uses ``timeout`` for every call.
+    The SDK's own retries are off: receipt calls go through
+    send_with_retries(). Use get_client() to share one client across a run.
+    """
+    import httpx
     
-    # Resize and encode
-    resized_path = resize_image(
-        image_path,
-        config.get('max_image_size', 4096),
-        config.get('image_quality', 'medium')
+    base_url = config.get('api_base_url') or None
+    timeout = float(config.get('timeout', 30))
+    http = config.get('http') or {}
+    max_connections = int(http.get('max_connections', 16))
+    limits = httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=max_connections,
+        keepalive_expiry=float(http.get('keepalive_seconds', 30)),
     )
-    base64_image = encode_image(resized_path)
+    http2 = bool(http.get('http2', True)) and importlib.util.find_spec('h2') is not None
     
-    categories = config.get('categories', [])
-    category_list = ", ".join(categories)
+    # Only the SDK of the selected provider is ever imported
+    if provider == 'openai':
+        import openai as sdk
+    else:
+        import anthropic as sdk
+    http_client = sdk.DefaultHttpxClient(limits=limits, http2=http2, timeout=timeout)
+    client_class = sdk.OpenAI if provider == 'openai' else sdk.Anthropic
+    return client_class(api_key=api_key, base_url=base_url, timeout=timeout, max_retries=0,
+                        http_client=http_client)
+
+
+# Shared SDK clients: (provider, api key, base url, timeout, http settings) -> client
+_clients: Dict[Tuple, Any] = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(provider: str, config: Dict[str, Any], api_key: str):
+    """Return the shared SDK client for these settings, creating it on first use.
+
+    Reusing one client keeps its connections (and TLS sessions) open across
+    every receipt in a run or watch session instead of reconnecting each time.
+    """
+    http = config.get('http') or {}
+    key = (provider, api_key, config.get('api_base_url') or None, config.get('timeout', 30),
+           tuple(sorted(http.items())))
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = make_client(provider, config, api_key)
+            _clients[key] = client
+    return client
+
+
+def close_clients():
+    """Close every shared SDK client and its open connections."""
+    with _clients_lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
+
+
+class TokenBucket:
+    """Allows ``rate`` units per second on average, in bursts of up to ``capacity``.
+
+    take() reserves units straight away and returns how long the caller
+    must wait for them, so callers are served in the order they asked.
+    """
+    
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.level = capacity
+        self.updated = time.monotonic()
+    
+    def take(self, amount: float, now: float) -> float:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        self.level -= amount
+        return max(0.0, -self.level / self.rate)
+
+
+class RateLimiter:
+    """Requests-per-minute and tokens-per-minute limits for one provider and model.
+
+    Shared by every worker thread. A limit of None means no limit. When the
+    provider answers 429, pause() holds every caller back, not just the one
+    that was refused. Bursts are capped at ``burst_seconds`` of the limit,
+    as providers enforce per-minute limits over much shorter windows.
+    """
     
-    prompt = f"""Extract the following information from this receipt image:
-    
-1. Vendor/merchant name
-2. Date of transaction (format: DD/MM/YYYY)
-3. Items purchased (list with descriptions and amounts)
-4. Subtotal (before tax)
-5. Tax amount (GST/VAT)
-6. Total amount
-7. Currency (SGD, USD, etc.)
-8. Payment method (Cash, Visa, Mastercard, GrabPay, etc.)
-9. Receipt/transaction number if visible
-10. Confidence score (high/medium/low) based on clarity of extraction
-
-Classify the expense into ONE of these categories: {category_list}
-
-Return ONLY a JSON object with this exact structure:
-{{
-    "vendor": "string",
-    "date": "DD/MM/YYYY",
-    "category": "string",
-    "items": [
-        {{"description": "string", "amount": number}}
-    ],
-    "subtotal": number,
-    "tax": number,
-    "total": number,
-    "currency": "string",
-    "payment_method": "string",
-    "receipt_number": "string or null",
-    "confidence": "high|medium|low"
-}}
-
-If any field is not visible, use null or 0. Be precise with numbers.
-Set confidence based on: high=crystal clear, medium=readable but some ambiguity, low=hard to read or missing info."""
-
-    response = client.messages.create(
-        model=config.get('model', 'claude-3-5-haiku-20241022'),
-        max_tokens=4096,
-        temperature=config.get('temperature', 0.1),
-        messages=[
+    def __init__(self, requests_per_minute: Optional[float] = None,
+                 tokens_per_minute: Optional[float] = None, burst_seconds: float = 1.0):
+        self._lock = threading.Lock()
+        self._paused_until = 0.0
+        self.requests = self.tokens = None
+        if requests_per_minute:
+            rate = requests_per_minute / 60
+            self.requests = TokenBucket(rate, max(1.0, rate * burst_seconds))
+        if tokens_per_minute:
+            rate = tokens_per_minute / 60
+            self.tokens = TokenBucket(rate, rate * burst_seconds)
+    
+    def acquire(self, tokens: int) -> float:
+        """Wait until one request of about ``tokens`` tokens may be sent; return the wait."""
+        with self._lock:
+            now = time.monotonic()
+            wait = max(0.0, self._paused_until - now)
+            if self.requests is not None:
+                wait = max(wait, self.requests.take(1, now))
+            if self.tokens is not None:
+                wait = max(wait, self.tokens.take(tokens, now))
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+    
+    def settle(self, estimated: int, used: int):
+        """Correct the token bucket once a call's real usage is known."""
+        if self.tokens is not None and used:
+            with self._lock:
+                self.tokens.level -= used - estimated
+    
+    def pause(self, seconds: float):
+        """Send nothing for ``seconds`` (after a 429)."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+# Shared rate limiters: (provider, model, requests/min, tokens/min) -> RateLimiter
+_rate_limiters: Dict[Tuple, RateLimiter] = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(provider: str, model: str, config: Dict[str, Any]) -> RateLimiter:
+    """Return the shared limiter for a provider and model, from ``rate_limits``.
+
+    Limits are looked up as ``provider:model``, then ``provider``.
+    """
+    limits = config.get('rate_limits') or {}
+    settings = limits.get(f"{provider}:{model}") or limits.get(provider) or {}
+    key = (provider, model, settings.get('requests_per_minute'), settings.get('tokens_per_minute'))
+    with _rate_limiters_lock:
+        limiter = _rate_limiters.get(key)
+        if limiter is None:
+            limiter = RateLimiter(key[2], key[3])
+            _rate_limiters[key] = limiter
+    return limiter
+
+
+# Rough token counts for the token bucket; corrected with the real usage
+IMAGE_TOKEN_ESTIMATE = 765
+REPLY_TOKEN_ESTIMATE = 300
+
+
+def estimate_tokens(request: Dict[str, Any]) -> int:
+    """Guess a request's tokens: about four characters per token, plus images and reply."""
+    chars, images = 0, 0
+    pending = [request]
+    while pending:
+        value = pending.pop()
+        if isinstance(value, dict):
+            if value.get('type') in ('image', 'image_url'):
+                images += 1
+                continue
+            pending.extend(value.values())
+        elif isinstance(value, list):
+            pending.extend(value)
+        elif isinstance(value, str):
+            chars += len(value)
+    return chars // 4 + images * IMAGE_TOKEN_ESTIMATE + REPLY_TOKEN_ESTIMATE
+
+
+# HTTP statuses worth trying again: timeouts, conflicts, rate limits, server trouble
+RETRYABLE_STATUSES = (408, 409, 429)
+
+
+def retry_after_seconds(error: Exception) -> Optional[float]:
+    """Return how long the provider asked us to wait (``retry-after`` headers), if it did."""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        value = headers.get('retry-after')
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            from email.utils import parsedate_to_datetime
+            return max(0.0, (parsedate_to_datetime(value) - datetime.now().astimezone()).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retryable(error: Exception) -> bool:
+    """True for errors a later attempt can fix: 429, 408, 409, 5xx, timeouts, dropped connections."""
+    response = getattr(error, 'response', None)
+    should_retry = (getattr(response, 'headers', None) or {}).get('x-should-retry')
+    if should_retry in ('true', 'false'):
+        return should_retry == 'true'
+    if getattr(error, 'code', None) == 'insufficient_quota':
+        return False  # A 429 that waiting won't fix: the account is out of credit
+    status = getattr(error, 'status_code', None)
+    if status is not None:
+        return status in RETRYABLE_STATUSES or status >= 500
+    # Both SDKs raise APIConnectionError (and its APITimeoutError) when no answer came
+    return any(cls.__name__ == 'APIConnectionError' for cls in type(error).__mro__)
+
+
+def send_with_retries(provider: str, request: Dict[str, Any], send, config: Dict[str, Any],
+                      stats: Dict[str, Any]):
+    """Call ``send(**request)`` within the rate limits, retrying what can be retried.
+
+    Each attempt waits for the ``rate_limits`` token buckets and has the
+    client's ``timeout``. Failed attempts are retried up to ``max_retries``
+    times, after the provider's ``retry-after`` if it gave one, otherwise
+    after a jittered exponential backoff (``retry`` settings). Retries are
+    counted in ``stats['retries']``; waits are the ``rate_limit`` and
+    ``backoff`` stages. The last error is raised with ``stats['retryable']``
+    saying whether retrying could still help.
+    """
+    retry = config.get('retry') or {}
+    max_retries = max(0, int(config.get('max_retries', 3)))
+    backoff = float(retry.get('backoff_seconds', 1))
+    max_backoff = float(retry.get('max_backoff_seconds', 30))
+    limiter = get_rate_limiter(provider, request.get('model', ''), config)
+    estimated = estimate_tokens(request)
+    
+    for attempt in range(max_retries + 1):
+        with timed(stats, 'rate_limit'):
+            limiter.acquire(estimated)
+        try:
+            with timed(stats, 'provider'):
+                response = send(**request)
+        except Exception as e:
+            stats['retryable'] = is_retryable(e)
+            if not stats['retryable'] or attempt == max_retries:
+                raise
+            delay = retry_after_seconds(e)
+            if delay is None:
+                # "Full jitter": spread retries out so workers don't retry in step
+                delay = random.uniform(0, min(max_backoff, backoff * 2 ** attempt))
+            if getattr(e, 'status_code', None) == 429:
+                limiter.pause(delay)
+            stats['retries'] = stats.get('retries', 0) + 1
+            with timed(stats, 'backoff'):
+                time.sleep(delay)
+            continue
+        
+        usage = getattr(response, 'usage', None)
+        used = (getattr(usage, 'total_tokens', None)
+                or (getattr(usage, 'input_tokens', 0) or 0) + (getattr(usage, 'output_tokens', 0) or 0))
+        limiter.settle(estimated, used)
+        stats.pop('retryable', None)
+        return response
+
+
+def build_openai_request(image_path: str, config: Dict[str, Any],
+                         stats: Optional[Dict[str, Any]] = None,
+                         text: Optional[str] = None) -> Dict[str, Any]:
+    """Build the chat.completions.create arguments for a receipt.
+
+    The fixed instructions come first so OpenAI's automatic prompt caching
+    can reuse them, and the reply is constrained to receipt_schema().
+    If ``text`` is given (a PDF text layer) it is sent instead of the image.
+    """
+    if text is not None:
+        content = [{"type": "text", "text": f"Receipt text:\n{text}"}]
+    else:
+        # Resize and encode in memory
+        base64_image = prepare_image(image_path, config, stats)
+        content = [
             {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": prompt},
-                    {
-                        "type": "image",
-                        "source": {
-                            "type": "base64",
-                            "media_type": "image/jpeg",
-                            "data": base64_image
-                        }
-                    }
-                ]
+                "type": "image_url",
+                "image_url": {
+                    "url": f"data:image/jpeg;base64,{base64_image}"
+                }
             }
         ]
-    )
     
-    content = response.content[0].text
-    # Extract JSON from markdown if present
-    if "```json" in content:
-        content = content.split("```json")[1].split("```")[0]
-    elif "```" in content:
-        content = content.split("```")[1].split("```")[0]
+    return {
+        "model": config.get('model', 'gpt-4o-mini'),
+        "temperature": config.get('temperature', 0.1),
+        "response_format": {
+            "type": "json_schema",
+            "json_schema": {"name": "receipt", "strict": True, "schema": receipt_schema(config)}
+        },
+        "messages": [
+            {"role": "system", "content": build_prompt(config)},
+            {"role": "user", "content": content}
+        ]
+    }
+
+
+def anthropic_cache_minimum(model: str) -> int:
+    """Return the fewest prompt tokens Anthropic caches for ``model``."""
+    if 'haiku-4' in model:
+        return 4096
+    if 'haiku' in model:
+        return 2048
+    return 1024
+
+
+def build_anthropic_request(image_path: str, config: Dict[str, Any],
+                            stats: Optional[Dict[str, Any]] = None,
+                            text: Optional[str] = None) -> Dict[str, Any]:
+    """Build the messages.create arguments for a receipt.
+
+    The receipt is returned as a forced call to the RECEIPT_TOOL tool. The
+    tool definition plus instructions are marked for prompt caching only when
+    they are long enough to be cached; shorter ones would be a no-op.
+    If ``text`` is given (a PDF text layer) it is sent instead of the image.
+    """
+    if text is not None:
+        content = [{"type": "text", "text": f"Receipt text:\n{text}"}]
+    else:
+        # Resize and encode in memory
+        base64_image = prepare_image(image_path, config, stats)
+        content = [
+            {
+                "type": "image",
+                "source": {
+                    "type": "base64",
+                    "media_type": "image/jpeg",
+                    "data": base64_image
+                }
+            }
+        ]
     
-    return json.loads(content.strip())
+    model = config.get('model', 'claude-3-5-haiku-20241022')
+    tools = [{
+        "name": RECEIPT_TOOL,
+        "description": "Record the expense read from a receipt.",
+        "input_schema": receipt_schema(config),
+    }]
+    system = [{"type": "text", "text": build_prompt(config)}]
+    # The marker caches everything up to it: the tools, then the system prompt
+    if len(json.dumps(tools)) + len(system[0]['text']) >= 4 * anthropic_cache_minimum(model):
+        system[0]["cache_control"] = {"type": "ephemeral"}
+    
+    return {
+        "model": model,
+        "max_tokens": 4096,
+        "temperature": config.get('temperature', 0.1),
+        "tools": tools,
+        "tool_choice": {"type": "tool", "name": RECEIPT_TOOL},
+        "system": system,
+        "messages": [
+            {"role": "user", "content": content}
+        ]
+    }
+
+
+def add_usage(stats: Dict[str, Any], input_tokens: Optional[int], output_tokens: Optional[int],
+              cached_tokens: Optional[int]):
+    """Add one API call's token usage to ``stats``."""
+    stats['input_tokens'] = stats.get('input_tokens', 0) + (input_tokens or 0)
+    stats['output_tokens'] = stats.get('output_tokens', 0) + (output_tokens or 0)
+    stats['cached_tokens'] = stats.get('cached_tokens', 0) + (cached_tokens or 0)
+
+
+def parse_with_openai(image_path: str, config: Dict[str, Any], api_key: str, verbose: bool = False,
+                      stats: Optional[Dict[str, Any]] = None,
+                      text: Optional[str] = None) -> Dict[str, Any]:
+    """Parse receipt using OpenAI Vision API."""
+    if stats is None:
+        stats = {}
+    client = get_client('openai', config, api_key)
+    request = build_openai_request(image_path, config, stats, text)
+    response = send_with_retries('openai', request, client.chat.completions.create, config, stats)
+    
+    usage = getattr(response, 'usage', None)
+    if usage is not None:
+        details = getattr(usage, 'prompt_tokens_details', None)
+        add_usage(stats, usage.prompt_tokens, usage.completion_tokens,
+                  getattr(details, 'cached_tokens', 0))
+    
+    # Parse JSON response
+    with timed(stats, 'parse'):
+        return parse_reply(openai_reply_text(response.choices[0].message))
+
+
+def parse_with_anthropic(image_path: str, config: Dict[str, Any], api_key: str, verbose: bool = False,
+                         stats: Optional[Dict[str, Any]] = None,
+                         text: Optional[str] = None) -> Dict[str, Any]:
+    """Parse receipt using Anthropic Claude Vision API."""
+    if stats is None:
+        stats = {}
+    client = get_client('anthropic', config, api_key)
+    request = build_anthropic_request(image_path, config, stats, text)
+    response = send_with_retries('anthropic', request, client.messages.create, config, stats)
+    
+    usage = getattr(response, 'usage', None)
+    if usage is not None:
+        add_usage(stats, usage.input_tokens, usage.output_tokens,
+                  getattr(usage, 'cache_read_input_tokens', 0))
+    
+    with timed(stats, 'parse'):
+        return parse_reply(anthropic_reply_text(response.content))
+
+
+def parse_receipt(image_path: str, config: Dict[str, Any],
+                  cache: Optional[ExtractionCache] = None,
+                  stats: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Parse a single receipt using configured AI model.
+
+    When a cache is given, it is checked before the image is touched and
+    fresh extractions are stored in it. If ``stats`` is given, per-receipt
+    facts (such as ``cache: hit|miss``) are recorded in it.
+    """
+    if stats is None:
+        stats = {}
+    if cache is None:
+        return call_provider(image_path, config, stats)
+    
+    if 'content_hash' not in stats:
+        with timed(stats, 'hash'):
+            stats['content_hash'] = file_hash(image_path)
+    with timed(stats, 'cache'):
+        key = cache.make_key(stats['content_hash'], config)
+        data = cache.get(key)
+    if data is not None:
+        stats['cache'] = 'hit'
+        return data
+    
+    stats['cache'] = 'miss'
+    data = call_provider(image_path, config, stats)
+    with timed(stats, 'cache'):
+        cache.put(key, data)
+    return data
+
 
+def call_provider(image_path: str, config: Dict[str, Any],
+                  stats: Optional[Dict[str, Any]] = None,
+                  text: Optional[str] = None) -> Dict[str, Any]:
+    """Send a receipt to the configured provider (no caching).
 
-def parse_receipt(image_path: str, config: Dict[str, Any]) -> Dict[str, Any]:
-    """Parse a single receipt using configured AI model."""
+    If ``text`` is given (a PDF text layer) it is used instead of the image.
+    """
     provider = config.get('model_provider', 'openai')
     
+    if routing_tiers(config):
+        return call_provider_routed(image_path, config, stats, text)
+    if (config.get('image_quality') == 'adaptive' and provider in ('openai', 'anthropic')
+            and text is None):
+        return call_provider_adaptive(image_path, config, stats)
+    
     # Get API key from environment
     if provider == 'openai':
-        api_key = os.getenv('OPENAI_API_KEY')
-        if not api_key:
-            raise ValueError("OPENAI_API_KEY environment variable not set")
-        return parse_with_openai(image_path, config, api_key)
+        return parse_with_openai(image_path, config, get_api_key('openai'), stats=stats, text=text)
     
     elif provider == 'anthropic':
-        api_key = os.getenv('ANTHROPIC_API_KEY')
-        if not api_key:
-            raise ValueError("ANTHROPIC_API_KEY environment variable not set")
-        return parse_with_anthropic(image_path, config, api_key)
+        return parse_with_anthropic(image_path, config, get_api_key('anthropic'), stats=stats,
+                                    text=text)
     
     elif provider == 'local':
         # Use local OCR (Tesseract) - no API key needed
-        return parse_with_local_ocr(image_path, config)
+        if text is not None:
+            return parse_receipt_text(text, config)
+        if stats is None:
+            stats = {}
+        with timed(stats, 'ocr'):
+            return parse_with_local_ocr(image_path, config)
     
     else:
         raise ValueError(f"Unknown model provider: {provider}")
 
 
+def call_provider_adaptive(image_path: str, config: Dict[str, Any],
+                           stats: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Send the smallest image first and re-send larger ones only when needed.
+
+    Each tier in ``adaptive_quality.tiers`` (an ``image_quality`` level) is
+    tried in turn until the answer has at least ``min_confidence`` and no
+    validate_receipt() warnings; the last tier's answer is used regardless.
+    The tiers tried are recorded in ``stats['quality_tiers']``.
+    """
+    if stats is None:
+        stats = {}
+    adaptive = config.get('adaptive_quality') or {}
+    tiers = adaptive.get('tiers') or ['low', 'medium', 'high']
+    min_confidence = CONFIDENCE_RANK.get(adaptive.get('min_confidence', 'medium'), 2)
+    
+    tried = stats.setdefault('quality_tiers', [])
+    for tier in tiers:
+        tried.append(tier)
+        data = call_provider(image_path, dict(config, image_quality=tier), stats)
+        if (CONFIDENCE_RANK.get(data.get('confidence'), 2) >= min_confidence
+                and not validate_receipt(data, config)):
+            break
+    return data
+
+
+def routing_tiers(config: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Return the configured routing tiers (empty when routing is off)."""
+    return (config.get('routing') or {}).get('tiers') or []
+
+
+def tier_name(tier: Dict[str, Any]) -> str:
+    """Short label for a routing tier, e.g. ``openai:gpt-4o-mini`` or ``local``."""
+    if tier.get('name'):
+        return tier['name']
+    if tier.get('model'):
+        return f"{tier['provider']}:{tier['model']}"
+    return tier['provider']
+
+
+def check_arithmetic(data: Dict[str, Any], tolerance: float = 0.05) -> List[str]:
+    """Return the ways the receipt's amounts fail to add up (empty if they do).
+
+    Items must sum to the subtotal (or to the total on tax-inclusive
+    receipts), and subtotal + tax must equal the total.
+    """
+    problems = []
+    total = data.get('total') or 0
+    subtotal = data.get('subtotal') or 0
+    tax = data.get('tax') or 0
+    
+    amounts = [item.get('amount') or 0 for item in data.get('items') or [] if isinstance(item, dict)]
+    if amounts and subtotal:
+        items_sum = sum(amounts)
+        if abs(items_sum - subtotal) > tolerance and abs(items_sum - total) > tolerance:
+            problems.append(f"Items add up to {items_sum:.2f}, not the subtotal {subtotal:.2f}")
+    
+    if total and subtotal:
+        if abs(subtotal + tax - total) > tolerance and abs(subtotal - total) > tolerance:
+            problems.append(f"Subtotal {subtotal:.2f} + tax {tax:.2f} is not the total {total:.2f}")
+    return problems
+
+
+def escalation_reason(data: Dict[str, Any], config: Dict[str, Any],
+                      rules: Dict[str, Any]) -> Optional[str]:
+    """Return why an answer should go to the next routing tier, or None to keep it."""
+    min_confidence = rules.get('min_confidence', 'medium')
+    if CONFIDENCE_RANK.get(data.get('confidence'), 2) < CONFIDENCE_RANK.get(min_confidence, 2):
+        return f"{data.get('confidence')} confidence"
+    
+    if rules.get('missing_fields', True):
+        required = config.get('validation', {}).get('required_fields', [])
+        missing = [field for field in required if not data.get(field)]
+        if missing:
+            return f"missing {', '.join(missing)}"
+    
+    if rules.get('arithmetic', True):
+        problems = check_arithmetic(data, rules.get('tolerance', 0.05))
+        if problems:
+            return problems[0]
+    return None
+
+
+def call_provider_routed(image_path: str, config: Dict[str, Any],
+                         stats: Optional[Dict[str, Any]] = None,
+                         text: Optional[str] = None) -> Dict[str, Any]:
+    """Try the ``routing.tiers`` in order, escalating only when an answer is not good enough.
+
+    Each tier is a provider (and optionally a model or image_quality) and
+    may override any ``routing.escalate_when`` rule. A tier that fails with
+    an error also escalates; the last tier's answer (or error) is final.
+    The tiers tried are recorded in ``stats['route']``, with the reason
+    each one escalated in ``stats['escalations']``, and each tier's wall
+    time as a ``route_<tier>`` stage.
+    """
+    if stats is None:
+        stats = {}
+    routing = config.get('routing') or {}
+    tiers = routing_tiers(config)
+    route = stats.setdefault('route', [])
+    escalations = stats.setdefault('escalations', [])
+    
+    for position, tier in enumerate(tiers):
+        name = tier_name(tier)
+        route.append(name)
+        tier_config = dict(config, routing=None, model_provider=tier['provider'])
+        if tier['provider'] != config.get('model_provider'):
+            tier_config.pop('model', None)  # Use the provider's default model
+        for key in ('model', 'image_quality'):
+            if key in tier:
+                tier_config[key] = tier[key]
+        last = position == len(tiers) - 1
+        
+        try:
+            with timed(stats, f"route_{name}"):
+                data = call_provider(image_path, tier_config, stats, text)
+        except Exception as e:
+            if last:
+                raise
+            escalations.append(f"{name}: {e}")
+            continue
+        
+        rules = dict(routing.get('escalate_when') or {})
+        rules.update({key: value for key, value in tier.items()
+                      if key in ('min_confidence', 'missing_fields', 'arithmetic', 'tolerance')})
+        reason = None if last else escalation_reason(data, config, rules)
+        if reason is None:
+            return data
+        escalations.append(f"{name}: {reason}")
+
+
+class KeywordClassifier:
+    """Aho-Corasick automaton over ``category_keywords``.
+
+    Built once; scans text in a single pass no matter how many keywords
+    there are. Keywords only count as whole words ("pen" does not match
+    "open"). Each hit adds the keyword's weight to its category, and the
+    highest total wins, so "grab food" (2 words) beats "grab" (1 word).
+    Keywords may be a list (weight = number of words) or a
+    ``{keyword: weight}`` mapping.
+    """
+    
+    def __init__(self, category_keywords: Dict[str, Any]):
+        self.categories = list(category_keywords)
+        # Trie as parallel lists: transitions, failure links, outputs
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]
+        for cat_index, cat in enumerate(self.categories):
+            keywords = category_keywords[cat] or []
+            if not isinstance(keywords, dict):
+                keywords = {kw: None for kw in keywords}
+            for kw, weight in keywords.items():
+                kw = unicodedata.normalize('NFKC', str(kw)).casefold().strip()
+                if not kw:
+                    continue
+                if weight is None:
+                    weight = len(kw.split())
+                self._add(kw, (len(kw), cat_index, float(weight)))
+        self._link()
+    
+    def _add(self, keyword: str, output: Tuple[int, int, float]):
+        node = 0
+        for ch in keyword:
+            nxt = self._goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[node][ch] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+            node = nxt
+        self._out[node].append(output)
+    
+    def _link(self):
+        # Breadth-first: each node's failure link points at the longest
+        # proper suffix that is also in the trie
+        queue = list(self._goto[0].values())
+        for node in queue:
+            for ch, nxt in self._goto[node].items():
+                queue.append(nxt)
+                fail = self._fail[node]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(ch, 0)
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+    
+    def scores(self, text: str) -> Dict[str, float]:
+        """Return the weighted keyword score of each matching category."""
+        text = unicodedata.normalize('NFKC', text).casefold()
+        goto, fail, out = self._goto, self._fail, self._out
+        totals = {}
+        node = 0
+        last = len(text) - 1
+        for i, ch in enumerate(text):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            for length, cat_index, weight in out[node]:
+                start = i - length + 1
+                if start > 0 and text[start - 1].isalnum():
+                    continue
+                if i < last and text[i + 1].isalnum():
+                    continue
+                totals[cat_index] = totals.get(cat_index, 0.0) + weight
+        return {self.categories[c]: score for c, score in sorted(totals.items())}
+    
+    def classify(self, text: str, default: str = "Others") -> str:
+        """Return the best-scoring category (earlier categories win ties)."""
+        scores = self.scores(text)
+        if not scores:
+            return default
+        return max(scores, key=lambda cat: (scores[cat], -self.categories.index(cat)))
+
+
+# Compiled lookup structures, keyed by name; each entry keeps the config
+# section it was built from so a reloaded config is recompiled.
+_compiled: Dict[str, Tuple[Any, Any]] = {}
+
+
+def get_keyword_classifier(config: Dict[str, Any]) -> KeywordClassifier:
+    """Return the KeywordClassifier for this config, compiling it once."""
+    category_keywords = config.get('category_keywords') or {}
+    source, classifier = _compiled.get('keyword_classifier', (None, None))
+    if source is not category_keywords:
+        classifier = KeywordClassifier(category_keywords)
+        _compiled['keyword_classifier'] = (category_keywords, classifier)
+    return classifier
+
+
 def parse_with_local_ocr(image_path: str, config: Dict[str, Any]) -> Dict[str, Any]:
     """Parse receipt using local Tesseract OCR (no API key required)."""
     # Extract text using Tesseract
@@ -279,6 +1156,11 @@ def parse_with_local_ocr(image_path: str, config: Dict[str, Any]) -> Dict[str, A
     if not raw_text.strip():
         raise ValueError("No text could be extracted from the image")
     
+    return parse_receipt_text(raw_text, config)
+
+
+def parse_receipt_text(raw_text: str, config: Dict[str, Any]) -> Dict[str, Any]:
+    """Rule-based extraction from receipt text (OCR output or a PDF text layer)."""
     # Build category list
     categories = config.get('categories', [])
     category_list = ", ".join(categories)
@@ -314,13 +1196,7 @@ def parse_with_local_ocr(image_path: str, config: Dict[str, Any]) -> Dict[str, A
             break
     
     # Guess category based on keywords
-    category = "Others"
-    text_lower = raw_text.lower()
-    category_keywords = config.get('category_keywords', {})
-    for cat, keywords in category_keywords.items():
-        if any(kw in text_lower for kw in keywords):
-            category = cat
-            break
+    category = get_keyword_classifier(config).classify(raw_text)
     
     # Calculate GST if applicable
     tax_rate = config.get('tax_rate', 0.09)
@@ -348,20 +1224,148 @@ def parse_with_local_ocr(image_path: str, config: Dict[str, Any]) -> Dict[str, A
     }
 
 
+def normalize_key(text: str) -> str:
+    """Casefold a name and strip punctuation, store numbers and extra spaces.
+
+    "STARBUCKS COFFEE #123" and "Starbucks Coffee" give the same key.
+    """
+    text = unicodedata.normalize('NFKC', text).casefold()
+    text = re.sub(r"['’`]", '', text)
+    text = re.sub(r'#\s*\d+', ' ', text)
+    text = re.sub(r'[^\w\s]|_', ' ', text)
+    return ' '.join(text.split())
+
+
+def trigrams(key: str) -> set:
+    """Character trigrams of a normalized name, padded at the word edges."""
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def words_match(key: str, other: str, threshold: float) -> bool:
+    """True if every word of each normalized name has a look-alike in the other.
+
+    A word matches a similar word (difflib ratio of at least ``threshold``)
+    or a run of the other name's letters, so "fair price" matches
+    "fairprice" but "starbucks reserve" does not match "starbucks".
+    """
+    from difflib import SequenceMatcher
+    
+    def similar(word: str, candidate: str) -> bool:
+        matcher = SequenceMatcher(None, word, candidate)
+        # Cheap upper bounds first
+        return (matcher.real_quick_ratio() >= threshold and matcher.quick_ratio() >= threshold
+                and matcher.ratio() >= threshold)
+    
+    def covered(words: List[str], other_words: List[str]) -> bool:
+        joined = ''.join(other_words)
+        return all(word in joined or any(similar(word, candidate) for candidate in other_words)
+                   for word in words)
+    
+    return covered(key.split(), other.split()) and covered(other.split(), key.split())
+
+
+class VendorIndex:
+    """Precompiled lookup of vendor aliases with fuzzy matching.
+
+    Built once from ``vendor_aliases``. Lookups try, in order: the exact
+    alias, its normalized key, then trigram similarity (Dice coefficient)
+    against every alias and canonical name, so OCR noise such as
+    "NTUC FalrPrice" still matches. A fuzzy match must also pass
+    words_match(), so a name with an extra word ("Starbucks Reserve")
+    is a different vendor.
+    """
+    
+    MEMO_SIZE = 100000
+    
+    def __init__(self, aliases: Dict[str, str], threshold: float = 0.7):
+        self.aliases = aliases
+        self.threshold = threshold
+        # normalized key -> (canonical name, alias that produced the key)
+        self.exact = {}
+        for alias, canonical in aliases.items():
+            self.exact.setdefault(normalize_key(str(alias)), (canonical, alias))
+        for canonical in aliases.values():
+            self.exact.setdefault(normalize_key(str(canonical)), (canonical, canonical))
+        self.exact.pop('', None)
+        
+        # Inverted trigram index for fuzzy lookups
+        self.keys = list(self.exact)
+        self.key_sizes = []
+        self.postings = {}
+        for i, key in enumerate(self.keys):
+            grams = trigrams(key)
+            self.key_sizes.append(len(grams))
+            for gram in grams:
+                self.postings.setdefault(gram, []).append(i)
+        self._memo = {}
+    
+    def match(self, vendor: str) -> Tuple[str, Optional[str], float]:
+        """Return (vendor name, alias matched or None, similarity score)."""
+        if not vendor:
+            return vendor, None, 0.0
+        
+        vendor_clean = vendor.strip()
+        # Check for exact match
+        if vendor_clean in self.aliases:
+            return self.aliases[vendor_clean], vendor_clean, 1.0
+        
+        result = self._memo.get(vendor_clean)
+        if result is None:
+            result = self._lookup(vendor_clean)
+            if len(self._memo) >= self.MEMO_SIZE:
+                self._memo.clear()
+            self._memo[vendor_clean] = result
+        return result
+    
+    def _lookup(self, vendor_clean: str) -> Tuple[str, Optional[str], float]:
+        key = normalize_key(vendor_clean)
+        if key in self.exact:
+            canonical, alias = self.exact[key]
+            return canonical, alias, 1.0
+        
+        if not self.threshold or not self.keys:
+            return vendor_clean, None, 0.0
+        
+        # Fuzzy: count shared trigrams with every candidate in one pass
+        grams = trigrams(key)
+        shared = {}
+        for gram in grams:
+            for i in self.postings.get(gram, ()):
+                shared[i] = shared.get(i, 0) + 1
+        size = len(grams)
+        best_score, candidates = 0.0, []
+        for i, common in shared.items():
+            score = 2.0 * common / (size + self.key_sizes[i])
+            if score > best_score:
+                best_score = score
+            if score >= self.threshold:
+                candidates.append((score, i))
+        for score, i in sorted(candidates, reverse=True):
+            if words_match(key, self.keys[i], self.threshold):
+                canonical, alias = self.exact[self.keys[i]]
+                return canonical, alias, round(score, 3)
+        return vendor_clean, None, round(best_score, 3)
+
+
+def vendor_index(aliases: Dict[str, str], threshold: float = 0.7) -> VendorIndex:
+    """Return the VendorIndex for these aliases, compiling it once."""
+    source, index = _compiled.get('vendor_index', (None, None))
+    if source is not aliases or index.threshold != threshold:
+        index = VendorIndex(aliases, threshold)
+        _compiled['vendor_index'] = (aliases, index)
+    return index
+
+
+def get_vendor_index(config: Dict[str, Any]) -> VendorIndex:
+    """Return the VendorIndex for this config's ``vendor_aliases``."""
+    return vendor_index(config.get('vendor_aliases') or {},
+                        config.get('vendor_match_threshold', 0.7))
+
+
 def normalize_vendor(vendor: str, aliases: Dict[str, str]) -> str:
     """Normalize vendor name using aliases."""
-    if not vendor:
-        return vendor
-    
-    vendor_clean = vendor.strip()
-    # Check for exact match
-    if vendor_clean in aliases:
-        return aliases[vendor_clean]
-    # Check case-insensitive
-    for alias, full_name in aliases.items():
-        if vendor_clean.lower() == alias.lower():
-            return full_name
-    return vendor_clean
+    return vendor_index(aliases).match(vendor)[0]
 
 
 def validate_receipt(data: Dict[str, Any], config: Dict[str, Any]) -> List[str]:
@@ -377,100 +1381,1092 @@ def validate_receipt(data: Dict[str, Any], config: Dict[str, Any]) -> List[str]:
     
     # Check max amount
     max_amount = validation.get('max_amount', 10000)
-    if data.get('total', 0) > max_amount:
+    if (data.get('total') or 0) > max_amount:
         warnings.append(f"Total exceeds {max_amount}: {data['total']}")
     
     # Check date
-    if validation.get('no_future_dates', True):
+    date = data.get('date')
+    if date:
         try:
-            receipt_date = datetime.strptime(data.get('date', ''), '%d/%m/%Y')
-            if receipt_date > datetime.now():
+            receipt_date = datetime.strptime(str(date), '%d/%m/%Y')
+        except ValueError:
+            warnings.append(f"Date is not DD/MM/YYYY: {date}")
+        else:
+            if validation.get('no_future_dates', True) and receipt_date > datetime.now():
                 warnings.append("Date is in the future")
-        except:
-            pass
     
     return warnings
 
 
-def format_output(data: Dict[str, Any], config: Dict[str, Any], filename: str) -> Dict[str, Any]:
-    """Format parsed data for output."""
-    # Normalize vendor
-    aliases = config.get('vendor_aliases', {})
-    data['vendor'] = normalize_vendor(data.get('vendor', ''), aliases)
-    
-    # Add metadata
-    data['file_name'] = filename
-    data['processed_at'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    data['items_count'] = len(data.get('items', []))
-    
-    # Set default currency if missing
-    if not data.get('currency'):
-        data['currency'] = config.get('default_currency', 'SGD')
+# Checks run by validate_batch(), with what each one means for the report
+BATCH_CHECKS = {
+    'missing_fields': "missing a required field",
+    'max_amount': "total over max_amount",
+    'bad_date': "date is not DD/MM/YYYY",
+    'future_date': "dated in the future",
+    'too_old': "older than max_age_days",
+    'items_sum': "items don't add up to the subtotal",
+    'total_mismatch': "subtotal + tax is not the total",
+    'tax_rate': "tax is not tax_rate of the subtotal",
+    'duplicate': "same receipt number, vendor, date and total as another receipt",
+}
+
+
+def duplicate_keys(receipt_number: "pd.Series", vendor: "pd.Series", date_iso: "pd.Series",
+                   total: "pd.Series") -> "pd.Series":
+    """64-bit hash of each receipt's (receipt number, vendor, date, total)."""
+    import pandas as pd
     
-    return data
+    return pd.util.hash_pandas_object(pd.DataFrame({
+        'receipt_number': receipt_number.fillna('').astype(str).str.strip().str.upper(),
+        'vendor': vendor.fillna('').astype(str).str.strip().str.lower(),
+        'date': date_iso.fillna('').astype(str),
+        'total': pd.to_numeric(total, errors='coerce').round(2),
+    }), index=False)
 
 
-def save_output(records: List[Dict[str, Any]], config: Dict[str, Any]):
-    """Save parsed records to file."""
+def batch_frame(records: Iterable[Dict[str, Any]], config: Dict[str, Any],
+                chunk_size: int = 1000) -> "pd.DataFrame":
+    """Keep only the columns validate_batch() and the run summary need, one row per record.
+
+    Records are read ``chunk_size`` at a time and each chunk's items are
+    reduced to their sum, so a run or ledger streamed from disk is never
+    held in memory whole.
+    """
+    from itertools import islice
+    import pandas as pd
+    
+    columns = ['content_hash', 'receipt_number', 'vendor', 'date', 'subtotal', 'tax', 'total',
+               'file_name', 'confidence']
+    columns += [field for field in config.get('validation', {}).get('required_fields', [])
+                if field not in columns]
+    records = iter(records)
+    chunks = []
+    while True:
+        chunk = list(islice(records, chunk_size))
+        if not chunk:
+            break
+        df = pd.DataFrame(chunk, columns=columns)
+        items = pd.Series([record.get('items') for record in chunk]).explode()
+        amounts = items.str.get('amount') if items.dtype == object else items
+        df['items_sum'] = pd.to_numeric(amounts, errors='coerce').groupby(level=0).sum(min_count=1)
+        chunks.append(df)
+    if not chunks:
+        return pd.DataFrame(columns=columns + ['items_sum'])
+    return pd.concat(chunks, ignore_index=True)
+
+
+def validate_batch(records: Iterable[Dict[str, Any]], config: Dict[str, Any],
+                   ledger: Optional["Ledger"] = None) -> "pd.DataFrame":
+    """Run the BATCH_CHECKS over many records at once; one True/False column per check.
+
+    Column-wise, so checking a whole run (or the whole ledger) costs about
+    as much as building a DataFrame of it. ``records`` may also be a
+    batch_frame() of them. With a ``ledger``, a receipt is also a duplicate
+    of any stored receipt from a different file.
+    """
+    import pandas as pd
+    
+    validation = config.get('validation', {})
+    tolerance = validation.get('tolerance', 0.05)
+    tax_rate = config.get('tax_rate', 0.09)
+    df = records if isinstance(records, pd.DataFrame) else batch_frame(records, config)
+    checks = pd.DataFrame(index=df.index)
+    if df.empty:
+        return checks.reindex(columns=list(BATCH_CHECKS)).astype(bool)
+    
+    required = validation.get('required_fields', [])
+    checks['missing_fields'] = df[required].isna().any(axis=1)
+    
+    total = pd.to_numeric(df['total'], errors='coerce').fillna(0.0)
+    subtotal = pd.to_numeric(df['subtotal'], errors='coerce').fillna(0.0)
+    tax = pd.to_numeric(df['tax'], errors='coerce').fillna(0.0)
+    checks['max_amount'] = total > validation.get('max_amount', 10000)
+    
+    # Dates
+    dates = pd.to_datetime(df['date'], format='%d/%m/%Y', errors='coerce')
+    checks['bad_date'] = dates.isna() & df['date'].notna() & (df['date'].astype(str) != '')
+    now = pd.Timestamp.now()
+    checks['future_date'] = (dates > now) & bool(validation.get('no_future_dates', True))
+    max_age_days = validation.get('max_age_days')
+    if max_age_days:
+        checks['too_old'] = dates < now.normalize() - pd.Timedelta(days=max_age_days)
+    else:
+        checks['too_old'] = False
+    
+    # Arithmetic, as in check_arithmetic()
+    items_sum = pd.to_numeric(df['items_sum'], errors='coerce')
+    checks['items_sum'] = (items_sum.notna() & (subtotal != 0)
+                           & ((items_sum - subtotal).abs() > tolerance)
+                           & ((items_sum - total).abs() > tolerance))
+    checks['total_mismatch'] = ((total != 0) & (subtotal != 0)
+                                & ((subtotal + tax - total).abs() > tolerance)
+                                & ((subtotal - total).abs() > tolerance))
+    # GST added to the subtotal, or included in a tax-inclusive total
+    checks['tax_rate'] = ((tax > 0) & (subtotal > 0)
+                          & ((tax - subtotal * tax_rate).abs() > tolerance)
+                          & ((tax - total * tax_rate / (1 + tax_rate)).abs() > tolerance))
+    
+    # Duplicates: a hash per receipt, looked up in a hash table of earlier ones
+    keyed = dates.notna() & (total != 0)
+    keys = duplicate_keys(df['receipt_number'], df['vendor'], dates.dt.strftime('%Y-%m-%d'),
+                          total)[keyed]
+    hashes = df['content_hash'][keyed]
+    # The same file twice in a run is one receipt, not a duplicate
+    duplicate = keys.duplicated() & ~pd.DataFrame({'key': keys, 'file': hashes}).duplicated()
+    if ledger is not None:
+        stored = pd.DataFrame(ledger.duplicate_keys(),
+                              columns=['content_hash', 'receipt_number', 'vendor', 'date_iso', 'total'])
+        stored = stored[~stored['content_hash'].isin(hashes.dropna())
+                        & stored['date_iso'].notna() & (stored['total'].fillna(0) != 0)]
+        stored_keys = duplicate_keys(stored['receipt_number'], stored['vendor'],
+                                     stored['date_iso'], stored['total'])
+        duplicate |= keys.isin(stored_keys)
+    checks['duplicate'] = duplicate.reindex(df.index, fill_value=False)
+    
+    return checks[list(BATCH_CHECKS)]
+
+
+def print_batch_checks(checks: "pd.DataFrame", file_names: "pd.Series", limit: int = 5):
+    """Print how many receipts failed each batch check, naming the first few files."""
+    flagged = int(checks.any(axis=1).sum())
+    if not flagged:
+        print(f"🔎 Checks: all {len(checks)} receipt(s) passed")
+        return
+    print(f"🔎 Checks: {flagged} of {len(checks)} receipt(s) flagged")
+    for check, failed in checks.items():
+        positions = failed.to_numpy().nonzero()[0]
+        if not len(positions):
+            continue
+        names = [file_names.iloc[i] or 'unknown' for i in positions[:limit]]
+        more = f", +{len(positions) - limit} more" if len(positions) > limit else ''
+        print(f"  ⚠ {BATCH_CHECKS[check]}: {len(positions)} ({', '.join(names)}{more})")
+
+
+def format_output(data: Dict[str, Any], config: Dict[str, Any], filename: str) -> Dict[str, Any]:
+    """Format parsed data for output."""
+    # Normalize vendor, remembering which alias (if any) matched
+    vendor, alias, _ = get_vendor_index(config).match(data.get('vendor', ''))
+    data['vendor'] = vendor
+    data['vendor_alias'] = alias
+    
+    # Add metadata
+    data['file_name'] = filename
+    data['processed_at'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    data['items_count'] = len(data.get('items', []))
+    
+    # Set default currency if missing
+    if not data.get('currency'):
+        data['currency'] = config.get('default_currency', 'SGD')
+    
+    return data
+
+
+def to_iso_date(value: Any) -> Optional[str]:
+    """Convert a DD/MM/YYYY receipt date to YYYY-MM-DD (None if unparseable)."""
+    try:
+        return datetime.strptime(str(value), '%d/%m/%Y').strftime('%Y-%m-%d')
+    except (TypeError, ValueError):
+        return None
+
+
+class Ledger:
+    """Indexed SQLite store of every parsed receipt (the system of record).
+
+    Receipts are keyed on the SHA-256 of the source file, so reprocessing
+    the same receipt updates its row instead of adding a duplicate. The
+    Excel/CSV/JSON files are exports built from this table.
+    """
+    
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS receipts ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " content_hash TEXT NOT NULL UNIQUE,"
+            " receipt_number TEXT,"
+            " date_iso TEXT,"
+            " vendor TEXT,"
+            " total REAL,"
+            " file_name TEXT,"
+            " processed_at TEXT NOT NULL,"
+            " data TEXT NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS idx_receipts_receipt_number ON receipts(receipt_number);"
+            "CREATE INDEX IF NOT EXISTS idx_receipts_date ON receipts(date_iso);"
+            "CREATE INDEX IF NOT EXISTS idx_receipts_vendor ON receipts(vendor);"
+            "CREATE INDEX IF NOT EXISTS idx_receipts_processed_at ON receipts(processed_at);"
+            "CREATE INDEX IF NOT EXISTS idx_receipts_file_name ON receipts(file_name);"
+            "CREATE TABLE IF NOT EXISTS exports ("
+            " path TEXT PRIMARY KEY,"
+            " size INTEGER NOT NULL,"
+            " mtime REAL NOT NULL);"
+        )
+        self._conn.commit()
+    
+    def upsert(self, records: List[Dict[str, Any]]) -> Tuple[int, int]:
+        """Insert new receipts and refresh changed ones; return (inserted, updated)."""
+        inserted = updated = 0
+        with self._lock:
+            for record in records:
+                content_hash = record.get('content_hash')
+                if not content_hash:
+                    continue
+                data = json.dumps(record, default=str, sort_keys=True)
+                existing = self._conn.execute(
+                    "SELECT data FROM receipts WHERE content_hash = ?", (content_hash,)
+                ).fetchone()
+                if existing is not None and existing[0] == data:
+                    continue
+                self._conn.execute(
+                    "INSERT INTO receipts (content_hash, receipt_number, date_iso, vendor, total,"
+                    " file_name, processed_at, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+                    " ON CONFLICT(content_hash) DO UPDATE SET"
+                    " receipt_number = excluded.receipt_number, date_iso = excluded.date_iso,"
+                    " vendor = excluded.vendor, total = excluded.total,"
+                    " file_name = excluded.file_name, processed_at = excluded.processed_at,"
+                    " data = excluded.data",
+                    (
+                        content_hash,
+                        record.get('receipt_number'),
+                        to_iso_date(record.get('date')),
+                        record.get('vendor'),
+                        record.get('total'),
+                        record.get('file_name'),
+                        record.get('processed_at') or datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                        data,
+                    )
+                )
+                if existing is None:
+                    inserted += 1
+                else:
+                    updated += 1
+            self._conn.commit()
+        return inserted, updated
+    
+    def mark_duplicates(self, duplicate_of: Dict[str, str]):
+        """Set ``duplicate_of`` on stored receipts, given {content_hash: file name}."""
+        with self._lock:
+            for content_hash, other in duplicate_of.items():
+                row = self._conn.execute(
+                    "SELECT data FROM receipts WHERE content_hash = ?", (content_hash,)
+                ).fetchone()
+                if row is not None:
+                    data = dict(json.loads(row[0]), duplicate_of=other)
+                    self._conn.execute("UPDATE receipts SET data = ? WHERE content_hash = ?",
+                                       (json.dumps(data, default=str, sort_keys=True), content_hash))
+            self._conn.commit()
+    
+    def import_rows(self, rows: Iterable[Dict[str, Any]]) -> Tuple[int, int]:
+        """Store rows read back from an output file; return (inserted, updated).
+
+        A row updates the receipt it was exported from, matched on content
+        hash or else on file name and processing time, keeping the fields
+        the file does not have (items, ...). A row for a file processed
+        again since is left to the newer extraction. Other rows (e.g. from
+        a file written before the ledger existed) are added as receipts of
+        their own.
+        """
+        records = []
+        for row in rows:
+            record = {}
+            for key, value in row.items():
+                if value is None or value != value:  # Blank cells read back as NaN
+                    value = None
+                elif isinstance(value, datetime):
+                    value = value.strftime('%d/%m/%Y' if key == 'date' else '%Y-%m-%d %H:%M:%S')
+                record[key] = value
+            content_hash = record.get('content_hash')
+            file_name, processed_at = record.get('file_name'), record.get('processed_at')
+            with self._lock:
+                if content_hash:
+                    stored = self._conn.execute(
+                        "SELECT content_hash, processed_at, data FROM receipts WHERE content_hash = ?",
+                        (content_hash,)
+                    ).fetchall()
+                else:
+                    stored = self._conn.execute(
+                        "SELECT content_hash, processed_at, data FROM receipts WHERE file_name = ?"
+                        " ORDER BY processed_at DESC", (file_name,)
+                    ).fetchall()
+            match = next((row for row in stored if content_hash or row[1] == processed_at), None)
+            if match is None and stored and processed_at and stored[0][1] > str(processed_at):
+                continue
+            if match is not None:
+                data = json.loads(match[2])
+                # Only changed cells are edits (11 read back for 11.0 is not, nor a
+                # blank cell for a field the receipt never had)
+                record = dict(data, **{key: value for key, value in record.items()
+                                       if value != data.get(key)},
+                              content_hash=match[0])
+            elif not content_hash:
+                record['content_hash'] = hashlib.sha256(
+                    f"{file_name}|{processed_at}".encode('utf-8')).hexdigest()
+            records.append(record)
+        return self.upsert(records)
+    
+    def output_changed(self, path: str) -> bool:
+        """Return True if ``path`` exists and is not the file record_output() last saw."""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT size, mtime FROM exports WHERE path = ?", (os.path.abspath(path),)
+            ).fetchone()
+        return row is None or tuple(row) != (stat.st_size, stat.st_mtime)
+    
+    def record_output(self, path: str):
+        """Remember an output file just exported from the ledger (see output_changed())."""
+        if not os.path.isfile(path):
+            return
+        stat = os.stat(path)
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO exports (path, size, mtime) VALUES (?, ?, ?)"
+                " ON CONFLICT(path) DO UPDATE SET size = excluded.size, mtime = excluded.mtime",
+                (os.path.abspath(path), stat.st_size, stat.st_mtime)
+            )
+            self._conn.commit()
+    
+    def contains(self, content_hash: str) -> bool:
+        """Return True if a receipt with this content hash is stored."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM receipts WHERE content_hash = ?", (content_hash,)
+            ).fetchone()
+        return row is not None
+    
+    def duplicate_keys(self) -> List[Tuple[str, Optional[str], Optional[str], Optional[str],
+                                          Optional[float]]]:
+        """Return (content_hash, receipt_number, vendor, date_iso, total) for every receipt.
+
+        Read from the indexed columns only, without decoding each receipt.
+        """
+        with self._lock:
+            return self._conn.execute(
+                "SELECT content_hash, receipt_number, vendor, date_iso, total FROM receipts"
+            ).fetchall()
+    
+    def fetch(self, processed_from: Optional[str] = None,
+              processed_to: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Return receipts processed in [processed_from, processed_to), oldest first."""
+        return list(self.iterate(processed_from, processed_to))
+    
+    def fetch_dated(self, date_from: str, date_to: str) -> List[Dict[str, Any]]:
+        """Return receipts dated in [date_from, date_to) (YYYY-MM-DD), via the date index."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT data FROM receipts WHERE date_iso >= ? AND date_iso < ? ORDER BY date_iso, id",
+                (date_from, date_to)
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+    
+    def iterate(self, processed_from: Optional[str] = None, processed_to: Optional[str] = None,
+                batch_size: int = 1000) -> Iterator[Dict[str, Any]]:
+        """Yield the receipts fetch() would return, reading ``batch_size`` rows at a time."""
+        last_id = 0
+        while True:
+            clauses, params = ["id > ?"], [last_id]
+            if processed_from:
+                clauses.append("processed_at >= ?")
+                params.append(processed_from)
+            if processed_to:
+                clauses.append("processed_at < ?")
+                params.append(processed_to)
+            query = ("SELECT id, data FROM receipts WHERE " + " AND ".join(clauses)
+                     + " ORDER BY id LIMIT ?")
+            with self._lock:
+                rows = self._conn.execute(query, params + [batch_size]).fetchall()
+            if not rows:
+                return
+            for _, data in rows:
+                yield json.loads(data)
+            last_id = rows[-1][0]
+    
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def open_ledger(config: Dict[str, Any]) -> Optional[Ledger]:
+    """Open the receipt ledger configured under ``ledger:``, if enabled."""
+    ledger_config = config.get('ledger', {})
+    if not ledger_config.get('enabled', True):
+        return None
     output_folder = config.get('output_folder', './output')
-    os.makedirs(output_folder, exist_ok=True)
+    return Ledger(ledger_config.get('path') or os.path.join(output_folder, 'ledger.sqlite'))
+
+
+def image_dhash(image_path: str) -> int:
+    """Return the 64-bit difference hash ("dHash") of how an image looks.
+
+    The image is shrunk to 9x8 greyscale and each bit records whether a
+    pixel is brighter than its right-hand neighbour, so re-encoding,
+    resizing and small lighting changes flip few or no bits.
+    """
+    from PIL import Image
     
-    # Determine filename based on merge strategy
-    merge_strategy = config.get('merge_files', 'daily')
-    date_format = config.get('date_format', 'DD/MM/YYYY')
+    img = load_image(image_path, 64).convert('L').resize((9, 8), Image.Resampling.LANCZOS)
+    pixels = img.tobytes()  # One byte per pixel in mode "L"
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return value
+
+
+class DuplicateIndex:
+    """Persistent index of image dHashes for finding near-duplicate receipts.
+
+    Uses multi-index hashing: each 64-bit hash is split into
+    ``max_distance + 1`` bands, and any hash within ``max_distance`` bits
+    of a stored one must match it exactly in at least one band (pigeonhole
+    principle). A lookup therefore only compares the few hashes sharing a
+    band value, not every stored hash. Hashes are kept in SQLite so the
+    index survives across runs; rows added by other processes are picked
+    up at the next lookup.
+    
+    Receipts from the same shop or app can look alike, so each image's
+    extracted total and date are stored too and used to confirm a match
+    once the run is over (see resolve_duplicates()).
+    """
+    
+    def __init__(self, path: str, max_distance: int = 4):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self.max_distance = max_distance
+        bands = max_distance + 1
+        self._bands = []
+        shift = 0
+        for band in range(bands):
+            width = 64 // bands + (1 if band < 64 % bands else 0)
+            self._bands.append((shift, (1 << width) - 1))
+            shift += width
+        self._tables = [defaultdict(list) for _ in self._bands]
+        self._values: Dict[str, int] = {}  # content_hash -> dHash, to find its buckets
+        self._last_id = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS image_hashes ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " dhash TEXT NOT NULL,"
+            " content_hash TEXT NOT NULL UNIQUE,"
+            " file_name TEXT,"
+            " total REAL,"
+            " date TEXT,"
+            " added_at TEXT NOT NULL)"
+        )
+        self._conn.commit()
+        self._sync()
+    
+    def _sync(self):
+        """Load rows added since the last sync into the in-memory band tables."""
+        rows = self._conn.execute(
+            "SELECT id, dhash, content_hash, file_name FROM image_hashes WHERE id > ? ORDER BY id",
+            (self._last_id,)
+        ).fetchall()
+        for row_id, dhash, content_hash, file_name in rows:
+            entry = (int(dhash, 16), content_hash, file_name)
+            for table, (shift, mask) in zip(self._tables, self._bands):
+                table[(entry[0] >> shift) & mask].append(entry)
+            self._values[content_hash] = entry[0]
+            self._last_id = row_id
+    
+    def find(self, value: int, content_hash: Optional[str] = None) -> Optional[Tuple[str, str, int]]:
+        """Return (content_hash, file_name, distance) of the closest other image, or None."""
+        best = None
+        for table, (shift, mask) in zip(self._tables, self._bands):
+            for other, other_hash, file_name in table.get((value >> shift) & mask, ()):
+                if other_hash == content_hash:
+                    continue  # The same file seen again is not a duplicate
+                distance = bin(value ^ other).count('1')
+                if distance <= self.max_distance and (best is None or distance < best[2]):
+                    best = (other_hash, file_name, distance)
+        return best
+    
+    def _insert(self, value: int, content_hash: str, file_name: str) -> bool:
+        cursor = self._conn.execute(
+            "INSERT OR IGNORE INTO image_hashes (dhash, content_hash, file_name, added_at)"
+            " VALUES (?, ?, ?, ?)",
+            (f"{value:016x}", content_hash, file_name,
+             datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        )
+        self._conn.commit()
+        self._sync()
+        return cursor.rowcount > 0
+    
+    def check_and_add(self, value: int, content_hash: str,
+                      file_name: str) -> Tuple[Optional[Tuple[str, str, int]], bool]:
+        """Look an image up, then store it; return (closest match, whether it was new).
+
+        Look-alikes are stored too, so a later copy can match either of them.
+        """
+        with self._lock:
+            self._sync()
+            match = self.find(value, content_hash)
+            return match, self._insert(value, content_hash, file_name)
+    
+    def file_name_of(self, content_hash: str) -> Optional[str]:
+        """Return the file name an image with exactly this content was stored under."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT file_name FROM image_hashes WHERE content_hash = ?", (content_hash,)
+            ).fetchone()
+        return row[0] if row else None
+    
+    def set_amounts(self, content_hash: str, total: Any, date: Any):
+        """Remember the extracted total and date of a stored image."""
+        with self._lock:
+            self._conn.execute("UPDATE image_hashes SET total = ?, date = ? WHERE content_hash = ?",
+                               (total, date, content_hash))
+            self._conn.commit()
+    
+    def amounts(self, content_hash: str) -> Optional[Tuple[Any, Any]]:
+        """Return the (total, date) stored for an image, if any."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT total, date FROM image_hashes WHERE content_hash = ?", (content_hash,)
+            ).fetchone()
+    
+    def discard(self, content_hash: str):
+        """Forget an image (e.g. because it failed to process)."""
+        with self._lock:
+            self._conn.execute("DELETE FROM image_hashes WHERE content_hash = ?", (content_hash,))
+            self._conn.commit()
+            value = self._values.pop(content_hash, None)
+            if value is None:
+                return
+            # Only the one bucket per band holding this hash needs changing
+            for table, (shift, mask) in zip(self._tables, self._bands):
+                key = (value >> shift) & mask
+                entries = [entry for entry in table.get(key, ()) if entry[1] != content_hash]
+                if entries:
+                    table[key] = entries
+                else:
+                    table.pop(key, None)
+    
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM image_hashes").fetchone()[0]
+    
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+# Open duplicate indexes, one per (path, max_distance) per process
+_duplicate_indexes: Dict[Tuple[str, int], DuplicateIndex] = {}
+_duplicate_indexes_lock = threading.Lock()
+
+
+def get_duplicate_index(config: Dict[str, Any]) -> Optional[DuplicateIndex]:
+    """Return the near-duplicate index configured under ``duplicates:``, if enabled."""
+    duplicates_config = config.get('duplicates') or {}
+    if not duplicates_config.get('enabled', True):
+        return None
+    output_folder = config.get('output_folder', './output')
+    path = duplicates_config.get('path') or os.path.join(output_folder, 'duplicates.sqlite')
+    key = (path, int(duplicates_config.get('max_distance', 4)))
+    with _duplicate_indexes_lock:
+        if key not in _duplicate_indexes:
+            _duplicate_indexes[key] = DuplicateIndex(*key)
+        return _duplicate_indexes[key]
+
+
+class Journal:
+    """Remembers which input files were processed, so reruns can skip them.
+
+    One row per input file: its size, modification time and content hash
+    when last processed, the outcome (ok, error or skipped) and the output
+    file it went into. A file whose size and mtime are unchanged is not read
+    again; if they changed, it is hashed and only counts as changed if its
+    content did too.
+    """
+    
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # One commit per file; NORMAL survives a crash of this program, just
+        # not a power cut, and saves an fsync per file
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            " path TEXT PRIMARY KEY,"
+            " size INTEGER NOT NULL,"
+            " mtime REAL NOT NULL,"
+            " content_hash TEXT,"
+            " outcome TEXT NOT NULL,"
+            " output TEXT,"
+            " error TEXT,"
+            " processed_at TEXT NOT NULL)"
+        )
+        self._conn.commit()
+    
+    def plan(self, found: Dict[str, Tuple[int, float]],
+             retry_failed: bool = False) -> Tuple[List[str], Dict[str, int]]:
+        """Return the files that need processing, and how many are in each state.
+
+        ``found`` is {path: (size, mtime)} from scan_receipts(). New, changed
+        and previously failed files are returned; with ``retry_failed`` only
+        the previously failed ones.
+        """
+        with self._lock:
+            known = {row[0]: row[1:] for row in self._conn.execute(
+                "SELECT path, size, mtime, content_hash, outcome FROM files")}
+        
+        todo, touched = [], []
+        counts = {'new': 0, 'changed': 0, 'failed': 0, 'unchanged': 0}
+        for path, (size, mtime) in found.items():
+            entry = known.get(path)
+            if entry is None:
+                state = 'new'
+            elif entry[3] == 'error':
+                state = 'failed'
+            elif (size, mtime) == (entry[0], entry[1]):
+                state = 'unchanged'
+            elif entry[2] is not None and file_hash(path) == entry[2]:
+                # Copied or touched, but the same content
+                state = 'unchanged'
+                touched.append((size, mtime, path))
+            else:
+                state = 'changed'
+            counts[state] += 1
+            if state == 'failed' or (state != 'unchanged' and not retry_failed):
+                todo.append(path)
+        
+        if touched:
+            with self._lock:
+                self._conn.executemany("UPDATE files SET size = ?, mtime = ? WHERE path = ?", touched)
+                self._conn.commit()
+        return sorted(todo), counts
+    
+    def record(self, path: str, size: int, mtime: float, content_hash: Optional[str],
+               outcome: str, error: Optional[str] = None, output: Optional[str] = None):
+        """Store the outcome of processing one input file."""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO files (path, size, mtime, content_hash, outcome, output,"
+                " error, processed_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (path, size, mtime, content_hash, outcome, output, error,
+                 datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+            )
+            self._conn.commit()
+    
+    def set_output(self, output: str, processed_from: str):
+        """Record the output file of every file processed successfully since ``processed_from``."""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE files SET output = ? WHERE outcome = 'ok' AND processed_at >= ?",
+                (output, processed_from)
+            )
+            self._conn.commit()
+    
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def open_journal(config: Dict[str, Any]) -> Optional[Journal]:
+    """Open the run journal configured under ``journal:``, if enabled."""
+    journal_config = config.get('journal') or {}
+    if not journal_config.get('enabled', True):
+        return None
+    path = journal_config.get('path') or os.path.join(
+        config.get('output_folder', './output'), 'journal.sqlite')
+    return Journal(path)
+
+
+def export_period(merge_strategy: str, now: Optional[datetime] = None) -> Tuple[str, Optional[str], Optional[str]]:
+    """Return (filename, processed_from, processed_to) for a merge strategy.
+
+    The range bounds ``processed_at`` for receipts belonging in the file;
+    None means unbounded.
+    """
+    now = now or datetime.now()
+    day = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    fmt = '%Y-%m-%d %H:%M:%S'
     
     if merge_strategy == 'single':
-        filename = 'expenses_all.xlsx'
+        return 'expenses_all.xlsx', None, None
     elif merge_strategy == 'daily':
-        filename = f"expenses_{datetime.now().strftime('%Y-%m-%d')}.xlsx"
+        start = day
+        end = start + timedelta(days=1)
+        return f"expenses_{now.strftime('%Y-%m-%d')}.xlsx", start.strftime(fmt), end.strftime(fmt)
     elif merge_strategy == 'weekly':
-        filename = f"expenses_week_{datetime.now().strftime('%Y-W%U')}.xlsx"
+        # %U weeks start on Sunday
+        start = day - timedelta(days=(day.weekday() + 1) % 7)
+        end = start + timedelta(days=7)
+        return f"expenses_week_{now.strftime('%Y-W%U')}.xlsx", start.strftime(fmt), end.strftime(fmt)
     elif merge_strategy == 'monthly':
-        filename = f"expenses_{datetime.now().strftime('%Y-%m')}.xlsx"
+        start = day.replace(day=1)
+        end = (start + timedelta(days=32)).replace(day=1)
+        return f"expenses_{now.strftime('%Y-%m')}.xlsx", start.strftime(fmt), end.strftime(fmt)
     else:
         # For 'false' or any other value, use timestamp to avoid overwriting
-        filename = f"expenses_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.xlsx"
+        return f"expenses_{now.strftime('%Y-%m-%d_%H-%M-%S')}.xlsx", None, None
+
+
+def save_output(records: List[Dict[str, Any]], config: Dict[str, Any],
+                ledger: Optional[Ledger] = None, stats: Optional[Dict[str, Any]] = None):
+    """Save parsed records to file.
+
+    With a ledger, the new records are upserted into it and the output file
+    for the current merge period is rebuilt from the ledger. Without one,
+    the existing output file is read back and merged. Stage timings are
+    recorded in ``stats`` if given.
+    """
+    if stats is None:
+        stats = {}
+    if ledger is not None:
+        with timed(stats, 'save_ledger'):
+            inserted, updated = ledger.upsert(records)
+        print(f"  Ledger: {inserted} new, {updated} updated receipt(s) in {ledger.path}")
+    return export_output(records, config, ledger, stats)
+
+
+def export_output(records: Iterable[Dict[str, Any]], config: Dict[str, Any],
+                  ledger: Optional[Ledger] = None, stats: Optional[Dict[str, Any]] = None):
+    """Write the output file for the current merge period.
+
+    ``records`` are this run's receipts; with a ledger they must already be
+    in it, and the file is rebuilt from the ledger.
+    """
+    if stats is None:
+        stats = {}
+    output_folder = config.get('output_folder', './output')
+    os.makedirs(output_folder, exist_ok=True)
     
+    # Determine filename based on merge strategy
+    merge_strategy = str(config.get('merge_files', 'daily')).lower()
+    filename, processed_from, processed_to = export_period(merge_strategy)
     output_path = os.path.join(output_folder, filename)
     
+    if ledger is not None:
+        if not config.get('ledger', {}).get('export_on_save', True):
+            return ledger.path
+        merged = None
+        if merge_strategy != 'false' and ledger.output_changed(output_file_path(config, output_path)):
+            # Written before the ledger existed, or edited since: keep its rows
+            with timed(stats, 'save_merge'):
+                inserted, updated = ledger.import_rows(read_output_rows(config, output_path) or [])
+            if inserted or updated:
+                print(f"  Ledger: {inserted} new, {updated} edited receipt(s) taken from "
+                      f"{output_file_path(config, output_path)}")
+    else:
+        with timed(stats, 'save_merge'):
+            merged = merge_existing_output(records, config, output_path, merge_strategy)
+    
+    def all_records() -> Iterable[Dict[str, Any]]:
+        """The receipts belonging in the file, streamed from the ledger if there is one."""
+        if merged is not None:
+            return merged
+        if merge_strategy == 'false':
+            return records
+        return ledger.iterate(processed_from, processed_to)
+    
+    with timed(stats, 'save_export'):
+        output_path, total = write_export(all_records(), config, output_path,
+                                          sidecar=ledger is None)
+    if ledger is not None:
+        ledger.record_output(output_path)
+    print(f"✓ Saved {len(records)} receipts ({total} total) to: {output_path}")
+    
+    # Generate IRAS export if enabled
+    iras_config = config.get('iras_export', {})
+    if iras_config.get('enabled', False):
+        with timed(stats, 'save_iras'):
+            iras_path, summary_path = save_iras_export(list(all_records()), config, output_folder)
+        print(f"✓ IRAS GST export: {iras_path} (F5 summary: {summary_path})")
+    
+    return output_path
+
+
+def output_file_path(config: Dict[str, Any], output_path: str) -> str:
+    """The file write_export() writes for ``output_path`` (its rows sidecar for Parquet)."""
+    output_format = config.get('output_format', 'excel')
+    if output_format in ('csv', 'json'):
+        return output_path.replace('.xlsx', f'.{output_format}')
+    if output_format == 'parquet':
+        return rows_sidecar_path(output_path)
+    return output_path
+
+
+def read_output_rows(config: Dict[str, Any], output_path: str) -> Optional[List[Dict[str, Any]]]:
+    """Read back the rows of an existing output file (None if there is none)."""
+    output_format = config.get('output_format', 'excel')
+    rows_path = rows_sidecar_path(output_path)
+    if output_format == 'parquet':
+        if not os.path.exists(rows_path):
+            return None
+        with open(rows_path, encoding='utf-8') as f:
+            return [json.loads(line) for line in f if line.strip()]
+    if not os.path.exists(output_file_path(config, output_path)):
+        return None
+    try:
+        if (output_format == 'excel' and os.path.exists(rows_path)
+                and os.path.getmtime(rows_path) >= os.path.getmtime(output_path)):
+            # Rows saved alongside the workbook, much faster than parsing it
+            with open(rows_path, encoding='utf-8') as f:
+                return [json.loads(line) for line in f if line.strip()]
+        elif output_format == 'excel':
+            # Written by an older version, or edited by hand since
+            import pandas as pd
+            return pd.read_excel(output_path, sheet_name='Expenses').to_dict('records')
+        elif output_format == 'csv':
+            import pandas as pd
+            return pd.read_csv(output_file_path(config, output_path)).to_dict('records')
+        elif output_format == 'json':
+            with open(output_file_path(config, output_path), 'r') as f:
+                return json.load(f)
+    except Exception as e:
+        print(f"  Warning: Could not read existing file: {e}")
+    return None
+
+
+def merge_existing_output(records: Iterable[Dict[str, Any]], config: Dict[str, Any],
+                          output_path: str, merge_strategy: str) -> List[Dict[str, Any]]:
+    """Merge new records with an existing output file (used without a ledger)."""
     # Check if file exists and merge is enabled (not false)
     existing_records = []
-    if merge_strategy != 'false' and os.path.exists(output_path):
-        try:
-            output_format = config.get('output_format', 'excel')
-            if output_format == 'excel':
-                existing_df = pd.read_excel(output_path, sheet_name='Expenses')
-                existing_records = existing_df.to_dict('records')
-            elif output_format == 'csv':
-                csv_path = output_path.replace('.xlsx', '.csv')
-                if os.path.exists(csv_path):
-                    existing_df = pd.read_csv(csv_path)
-                    existing_records = existing_df.to_dict('records')
-            elif output_format == 'json':
-                json_path = output_path.replace('.xlsx', '.json')
-                if os.path.exists(json_path):
-                    with open(json_path, 'r') as f:
-                        existing_records = json.load(f)
+    if merge_strategy != 'false':
+        existing_records = read_output_rows(config, output_path)
+        if existing_records is not None:
             print(f"  Found {len(existing_records)} existing receipts, merging...")
-        except Exception as e:
-            print(f"  Warning: Could not read existing file: {e}")
+        existing_records = existing_records or []
     
     # Combine existing and new records
-    all_records = existing_records + records
+    all_records = existing_records + list(records)
     
-    # Remove duplicates based on file_name and processed_at (if same receipt processed twice)
-    seen = set()
-    unique_records = []
+    # Remove duplicates: the same source file (by content hash) keeps its
+    # latest extraction; older rows without a hash fall back to file name
+    # and processing time
+    latest = {}
     for record in all_records:
-        key = (record.get('file_name'), record.get('processed_at'))
-        if key not in seen:
-            seen.add(key)
-            unique_records.append(record)
+        key = record.get('content_hash') or (record.get('file_name'), record.get('processed_at'))
+        latest.pop(key, None)
+        latest[key] = record
+    
+    return list(latest.values())
+
+
+def rows_sidecar_path(output_path: str) -> str:
+    """Hidden file next to an export holding the full rows written to it."""
+    folder, name = os.path.split(output_path)
+    return os.path.join(folder, f".{os.path.splitext(name)[0]}.rows.jsonl")
+
+
+@contextmanager
+def rows_sidecar(output_path: str, enabled: bool = True):
+    """Open the rows_sidecar_path() file of an export for writing (None if not ``enabled``).
+
+    The file is put in place only when the block ends, after the export
+    itself, so it is never older than the export. A disabled sidecar is
+    removed, as it would no longer match the export.
+    """
+    path = rows_sidecar_path(output_path)
+    if not enabled:
+        yield None
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        yield f
+    os.replace(path + '.tmp', path)
+
+
+def write_excel(records: Iterable[Dict[str, Any]], columns: List[str], output_path: str,
+                sidecar: bool = False) -> int:
+    """Stream records into an .xlsx file; return the number of rows written.
+
+    Uses xlsxwriter's constant_memory mode, so each row goes to disk as it
+    is written and memory stays flat however many receipts there are.
+    Column widths are worked out along the way. Without ``columns``, the
+    first record's keys are used. With ``sidecar``, the full records are
+    also saved to rows_sidecar_path() for merge_existing_output().
+    """
+    import xlsxwriter
+    
+    widths = None
+    count = 0
+    with rows_sidecar(output_path, sidecar) as rows_file:
+        workbook = xlsxwriter.Workbook(output_path, {'constant_memory': True})
+        worksheet = workbook.add_worksheet('Expenses')
+        try:
+            for record in records:
+                if widths is None:
+                    columns = list(columns) or list(record)
+                    worksheet.write_row(0, 0, columns)
+                    widths = [len(str(c)) for c in columns]
+                count += 1
+                for col, key in enumerate(columns):
+                    value = record.get(key)
+                    if value is None or value != value:  # Leave None and NaN blank
+                        continue
+                    if isinstance(value, bool):
+                        worksheet.write_boolean(count, col, value)
+                    elif isinstance(value, (int, float)):
+                        worksheet.write_number(count, col, value)
+                    else:
+                        if not isinstance(value, str):
+                            value = json.dumps(value, default=str)
+                        worksheet.write_string(count, col, value)
+                    widths[col] = max(widths[col], len(str(value)))
+                if rows_file is not None:
+                    rows_file.write(json.dumps(record, default=str) + "\n")
+            
+            if widths is None and columns:
+                worksheet.write_row(0, 0, columns)
+                widths = [len(str(c)) for c in columns]
+            for col, width in enumerate(widths or []):
+                worksheet.set_column(col, col, min(width + 2, 50))
+        finally:
+            workbook.close()
+    return count
+
+
+def import_pyarrow():
+    """Import pyarrow and pyarrow.parquet, which are only needed for Parquet output."""
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("Parquet output needs pyarrow. Run: pip install pyarrow") from None
+    return pyarrow, pyarrow.parquet
+
+
+def gst_code(record: Dict[str, Any], config: Dict[str, Any]) -> str:
+    """IRAS GST code of a receipt, from ``iras_export.category_gst_codes``."""
+    iras_config = config.get('iras_export', {})
+    return iras_config.get('category_gst_codes', {}).get(
+        record.get('category', 'Others'), iras_config.get('default_gst_code', 'TX'))
+
+
+def as_float(value: Any) -> Optional[float]:
+    """A number from a record, or None for blanks, NaN and text."""
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return None if value != value else value
+
+
+# Repeated text in the Parquet tables, stored once per file with small integer codes
+PARQUET_DICTIONARY_COLUMNS = ('vendor', 'category', 'currency', 'gst_code', 'payment_method',
+                              'confidence')
+
+
+def write_parquet(records: Iterable[Dict[str, Any]], config: Dict[str, Any], output_path: str,
+                  sidecar: bool = False) -> Tuple[str, int]:
+    """Write records as Parquet tables; return the dataset folder and receipt count.
+
+    Two tables go under ``parquet/`` next to ``output_path``: ``receipts``
+    (one row per receipt) and ``line_items`` (one row per item, with the
+    ``receipt_id`` of its receipt, which is its content hash). Both are
+    partitioned into ``month=YYYY-MM`` folders by receipt date. Each export
+    period writes one file per month folder, named after ``output_path``,
+    replacing that period's files from the previous export.
+    """
+    pa, pq = import_pyarrow()
+    import pyarrow.compute as pc
     
-    all_records = unique_records
+    text = pa.dictionary(pa.int32(), pa.string())
+    receipt_types = {
+        'receipt_id': pa.string(), 'date': pa.date32(), 'vendor': text, 'category': text,
+        'description': pa.string(), 'subtotal': pa.float64(), 'tax': pa.float64(),
+        'total': pa.float64(), 'currency': text, 'gst_code': text, 'payment_method': text,
+        'receipt_number': pa.string(), 'items_count': pa.int32(), 'confidence': text,
+        'file_name': pa.string(), 'processed_at': pa.timestamp('s'), 'month': pa.string(),
+    }
+    item_types = {
+        'receipt_id': pa.string(), 'line': pa.int32(), 'description': pa.string(),
+        'amount': pa.float64(), 'month': pa.string(),
+    }
+    receipts = {name: [] for name in receipt_types}
+    items = {name: [] for name in item_types}
+    count = 0
+    
+    with rows_sidecar(output_path, sidecar) as rows_file:
+        for record in records:
+            count += 1
+            date_iso = to_iso_date(record.get('date'))
+            month = date_iso[:7] if date_iso else 'unknown'
+            receipt_id = record.get('content_hash') or hashlib.sha256(
+                json.dumps(record, default=str, sort_keys=True).encode()).hexdigest()
+            try:
+                processed_at = datetime.strptime(str(record.get('processed_at')), '%Y-%m-%d %H:%M:%S')
+            except ValueError:
+                processed_at = None
+            row = dict(record, receipt_id=receipt_id, month=month, processed_at=processed_at,
+                       gst_code=gst_code(record, config),
+                       date=datetime.strptime(date_iso, '%Y-%m-%d').date() if date_iso else None)
+            for name in ('subtotal', 'tax', 'total'):
+                row[name] = as_float(row.get(name))
+            for name, values in receipts.items():
+                value = row.get(name)
+                if receipt_types[name] in (pa.string(), text) and value is not None:
+                    value = str(value)
+                values.append(value)
+            
+            for line, item in enumerate(record.get('items') or []):
+                if not isinstance(item, dict):
+                    continue
+                items['receipt_id'].append(receipt_id)
+                items['line'].append(line + 1)
+                items['description'].append(item.get('description'))
+                items['amount'].append(as_float(item.get('amount')))
+                items['month'].append(month)
+            if rows_file is not None:
+                rows_file.write(json.dumps(record, default=str) + "\n")
+        
+        root = os.path.join(os.path.dirname(output_path), 'parquet')
+        file_name = os.path.splitext(os.path.basename(output_path))[0] + '.parquet'
+        for table_name, columns, types in (('receipts', receipts, receipt_types),
+                                           ('line_items', items, item_types)):
+            table = pa.table({name: pa.array(values, type=types[name])
+                              for name, values in columns.items()})
+            # Replace this period's files (a receipt's month may have changed)
+            for old in Path(root, table_name).glob(f"month=*/{file_name}"):
+                old.unlink()
+            for month in pc.unique(table['month']).to_pylist():
+                folder = os.path.join(root, table_name, f"month={month}")
+                os.makedirs(folder, exist_ok=True)
+                part = table.filter(pc.equal(table['month'], month)).drop_columns(['month'])
+                pq.write_table(part, os.path.join(folder, file_name), compression='zstd',
+                               use_dictionary=[c for c in PARQUET_DICTIONARY_COLUMNS
+                                               if c in part.column_names])
+    return root, count
+
+
+def write_export(records: Iterable[Dict[str, Any]], config: Dict[str, Any], output_path: str,
+                 sidecar: bool = False) -> Tuple[str, int]:
+    """Write records to the configured output format; return the path written and row count.
+
+    Excel and Parquet are written with write_excel() and write_parquet()
+    (``sidecar`` is passed on to them); CSV and JSON are built in memory.
+    """
+    # Save based on format
+    output_format = config.get('output_format', 'excel')
+    if output_format == 'excel':
+        return output_path, write_excel(records, config.get('output_columns', []),
+                                        output_path, sidecar)
+    if output_format == 'parquet':
+        return write_parquet(records, config, output_path, sidecar)
+    
+    import pandas as pd
     
     # Create DataFrame
-    df = pd.DataFrame(all_records)
+    records = list(records)
+    df = pd.DataFrame(records)
     
     # Reorder columns based on config
     columns = config.get('output_columns', [])
@@ -479,82 +2475,1388 @@ def save_output(records: List[Dict[str, Any]], config: Dict[str, Any]):
         available_cols = [c for c in columns if c in df.columns]
         df = df[available_cols]
     
-    # Save based on format
-    output_format = config.get('output_format', 'excel')
-    
-    if output_format == 'excel':
-        # Use xlsxwriter for better formatting
-        with pd.ExcelWriter(output_path, engine='xlsxwriter') as writer:
-            df.to_excel(writer, sheet_name='Expenses', index=False)
-            
-            # Auto-adjust column widths
-            worksheet = writer.sheets['Expenses']
-            for i, col in enumerate(df.columns):
-                # Handle NaN values by filling with empty string first
-                col_values = df[col].fillna('').astype(str)
-                max_data_len = col_values.map(len).max()
-                max_len = max(max_data_len, len(col)) + 2
-                worksheet.set_column(i, i, min(max_len, 50))
-    
-    elif output_format == 'csv':
+    if output_format == 'csv':
         output_path = output_path.replace('.xlsx', '.csv')
         df.to_csv(output_path, index=False)
     
     elif output_format == 'json':
         output_path = output_path.replace('.xlsx', '.json')
         with open(output_path, 'w') as f:
-            json.dump(all_records, f, indent=2)
+            json.dump(records, f, indent=2)
     
-    print(f"✓ Saved {len(records)} receipts ({len(all_records)} total) to: {output_path}")
+    return output_path, len(records)
+
+
+# GST F5 boxes filled from purchases: box 5 is the value of taxable purchases
+# (standard- and zero-rated), box 7 the input tax claimed on them
+F5_TAXABLE_PURCHASE_CODES = ('TX', 'ZP')
+F5_CLAIMABLE_CODES = ('TX',)
+
+
+def gst_quarter(dates: "pd.Series", start_month: int = 1) -> "pd.Series":
+    """Label dates with their GST filing quarter, e.g. ``2025-Q1``.
+
+    ``start_month`` is the first month of the first quarter (1 = Jan-Mar,
+    4 = Apr-Jun); the year is the year the first quarter starts in.
+    """
+    shifted = (dates.dt.month - start_month) % 12
+    year = dates.dt.year - (dates.dt.month < start_month).astype(int)
+    labels = year.astype('Int64').astype(str) + '-Q' + (shifted // 3 + 1).astype('Int64').astype(str)
+    return labels.where(dates.notna(), 'undated')
+
+
+def quarter_range(label: str, start_month: int = 1) -> Tuple[str, str]:
+    """Return the [from, to) YYYY-MM-DD dates of a gst_quarter() label like ``2025-Q1``."""
+    match = re.fullmatch(r'(\d{4})-?Q([1-4])', label.strip().upper())
+    if not match:
+        raise ValueError(f"Quarter must look like 2025-Q1, not {label!r}")
+    months = int(match.group(1)) * 12 + (start_month - 1) + (int(match.group(2)) - 1) * 3
+    start = datetime(months // 12, months % 12 + 1, 1)
+    end = datetime((months + 3) // 12, (months + 3) % 12 + 1, 1)
+    return start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')
+
+
+def iras_frame(records: List[Dict[str, Any]], config: Dict[str, Any]) -> "pd.DataFrame":
+    """Records in IRAS GST F5-compatible columns, plus their filing ``Period``."""
+    import pandas as pd
     
-    # Generate IRAS export if enabled
     iras_config = config.get('iras_export', {})
-    if iras_config.get('enabled', False):
-        iras_path = save_iras_export(all_records, config, output_folder)
-        print(f"✓ IRAS GST export: {iras_path}")
+    category_codes = iras_config.get('category_gst_codes', {})
+    columns = ['date', 'vendor', 'description', 'category', 'subtotal', 'tax', 'total',
+               'receipt_number']
+    df = pd.DataFrame(records, columns=columns)
+    
+    codes = df['category'].fillna('Others').map(category_codes).fillna(
+        iras_config.get('default_gst_code', 'TX'))
+    total = pd.to_numeric(df['total'], errors='coerce').fillna(0.0)
+    subtotal = pd.to_numeric(df['subtotal'], errors='coerce')
+    # No GST on zero-rated or out-of-scope purchases
+    tax = pd.to_numeric(df['tax'], errors='coerce').fillna(0.0).mask(codes.isin(['ZP', 'OS']), 0.0)
+    dates = pd.to_datetime(df['date'], format='%d/%m/%Y', errors='coerce')
+    
+    return pd.DataFrame({
+        'Date': df['date'].fillna(''),
+        'Supplier Name': df['vendor'].fillna(''),
+        'Supplier GST Reg No': '',  # Would need to be extracted or mapped
+        'Description': df['description'].fillna(''),
+        'Value Excl GST': subtotal.mask(subtotal.isna() | (subtotal == 0), total),
+        'GST Amount': tax,
+        'Total Amount': total,
+        'GST Code': codes,
+        'Receipt Reference': df['receipt_number'].fillna(''),
+        'Period': gst_quarter(dates, int(iras_config.get('quarter_start_month', 1))),
+    })
+
+
+def f5_summary(iras: "pd.DataFrame") -> "pd.DataFrame":
+    """Totals by filing period and GST code, with each code's part of F5 boxes 5 and 7.
+
+    An ``All`` row per period holds the period's totals, i.e. the box values.
+    """
+    import pandas as pd
+    
+    iras = iras.assign(**{
+        'F5 Box 5': iras['Value Excl GST'].where(iras['GST Code'].isin(F5_TAXABLE_PURCHASE_CODES), 0.0),
+        'F5 Box 7': iras['GST Amount'].where(iras['GST Code'].isin(F5_CLAIMABLE_CODES), 0.0),
+    })
+    sums = ['Value Excl GST', 'GST Amount', 'Total Amount', 'F5 Box 5', 'F5 Box 7']
+    by_code = iras.groupby(['Period', 'GST Code'])[sums].sum()
+    by_code.insert(0, 'Receipts', iras.groupby(['Period', 'GST Code']).size())
+    by_period = by_code.groupby(level='Period').sum()
+    by_period['GST Code'] = 'All'
+    by_period = by_period.set_index('GST Code', append=True)
+    summary = pd.concat([by_code, by_period]).round(2).reset_index()
+    summary['_all'] = summary['GST Code'] == 'All'
+    return summary.sort_values(['Period', '_all', 'GST Code']).drop(columns='_all')
+
+
+def save_iras_export(records: List[Dict[str, Any]], config: Dict[str, Any], output_folder: str,
+                     label: Optional[str] = None) -> Tuple[str, str]:
+    """Save records in IRAS GST F5-compatible format, plus an F5 summary.
+
+    Returns the paths of the export and summary CSVs, named after ``label``
+    (e.g. a filing quarter) or today's date.
+    """
+    label = label or datetime.now().strftime('%Y-%m-%d')
+    iras = iras_frame(records, config)
+    
+    iras_path = os.path.join(output_folder, f"iras_gst_export_{label}.csv")
+    iras.drop(columns=['Period']).to_csv(iras_path, index=False)
+    summary_path = os.path.join(output_folder, f"iras_gst_f5_summary_{label}.csv")
+    f5_summary(iras).to_csv(summary_path, index=False)
+    return iras_path, summary_path
+
+
+# PDF pages with at least this much embedded text are read from their text
+# layer instead of being rendered for OCR or a vision model
+MIN_PDF_TEXT_CHARS = 20
+
+
+def import_pymupdf():
+    """Import PyMuPDF, which is only needed for PDF receipts."""
+    try:
+        import pymupdf
+    except ImportError:
+        try:
+            import fitz as pymupdf  # PyMuPDF before 1.24.3
+        except ImportError:
+            raise ImportError("PDF receipts need PyMuPDF. Run: pip install pymupdf") from None
+    return pymupdf
+
+
+def pdf_page_count(pdf_path: str) -> int:
+    """Return the number of pages in a PDF."""
+    pymupdf = import_pymupdf()
+    with pymupdf.open(pdf_path) as doc:
+        return doc.page_count
+
+
+@functools.lru_cache(maxsize=64)
+def pdf_file_hash(pdf_path: str, size: int, mtime: float) -> str:
+    """file_hash() of a PDF, computed once per process rather than once per page."""
+    return file_hash(pdf_path)
+
+
+def render_size(config: Dict[str, Any]) -> int:
+    """Longest side in pixels to render PDF pages at: the largest image_quality in use."""
+    qualities = {config.get('image_quality', 'medium')}
+    if config.get('image_quality') == 'adaptive':
+        qualities.update((config.get('adaptive_quality') or {}).get('tiers') or ['high'])
+    qualities.update(tier['image_quality'] for tier in routing_tiers(config) if 'image_quality' in tier)
+    sizes = [IMAGE_QUALITY[quality][0] for quality in qualities if quality in IMAGE_QUALITY]
+    return min(config.get('max_image_size', 4096), max(sizes or [IMAGE_QUALITY['medium'][0]]))
+
+
+def parse_pdf_page(pdf_path: str, page: int, config: Dict[str, Any],
+                   cache: Optional[ExtractionCache] = None,
+                   stats: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Extract one PDF page, from its text layer if it has one, else from a rendered image.
+
+    Only this page is loaded, and it is rendered to a temporary PNG that is
+    deleted straight after, so long PDFs never sit in memory at once. Like
+    parse_receipt(), the cache is checked first and ``stats`` filled in;
+    ``stats['pdf_source']`` records whether the page was ``text`` or ``render``.
+    """
+    if stats is None:
+        stats = {}
+    pymupdf = import_pymupdf()
+    
+    with timed(stats, 'hash'):
+        st = os.stat(pdf_path)
+        pdf_hash = pdf_file_hash(pdf_path, st.st_size, st.st_mtime)
+        stats['content_hash'] = hashlib.sha256(f"{pdf_hash}:{page}".encode()).hexdigest()
+    if cache is not None:
+        with timed(stats, 'cache'):
+            key = cache.make_key(stats['content_hash'], config)
+            data = cache.get(key)
+        if data is not None:
+            stats['cache'] = 'hit'
+            return data
+        stats['cache'] = 'miss'
+    
+    image_path = None
+    with pymupdf.open(pdf_path) as doc:
+        pdf_page = doc.load_page(page)
+        with timed(stats, 'pdf_text'):
+            text = pdf_page.get_text().strip()
+        if len(text) >= MIN_PDF_TEXT_CHARS:
+            stats['pdf_source'] = 'text'
+        else:
+            stats['pdf_source'] = 'render'
+            text = None
+            with timed(stats, 'render'):
+                zoom = render_size(config) / max(pdf_page.rect.width, pdf_page.rect.height)
+                pixmap = pdf_page.get_pixmap(matrix=pymupdf.Matrix(zoom, zoom), alpha=False)
+                fd, image_path = tempfile.mkstemp(suffix='.png', prefix='receipt-page-')
+                os.close(fd)
+                pixmap.save(image_path)
+                del pixmap
+    
+    try:
+        data = call_provider(image_path or pdf_path, config, stats, text)
+    finally:
+        if image_path is not None:
+            os.remove(image_path)
+    if cache is not None:
+        with timed(stats, 'cache'):
+            cache.put(key, data)
+    return data
+
+
+def pdf_tasks(files: List[Path]) -> List[Tuple[Path, Optional[int]]]:
+    """Expand files into (path, page) tasks: one per PDF page, (path, None) for images."""
+    tasks = []
+    for file_path in files:
+        if file_path.suffix.lower() == '.pdf':
+            try:
+                pages = pdf_page_count(str(file_path))
+            except Exception:
+                pages = 0  # process_file() reports the error
+            if pages:
+                tasks.extend((file_path, page) for page in range(pages))
+                continue
+        tasks.append((file_path, None))
+    return tasks
+
+
+def continues_receipt(pages: List[Dict[str, Any]], data: Dict[str, Any]) -> bool:
+    """Whether a PDF page's data belongs to the receipt made of the previous ``pages``."""
+    numbers = {p['receipt_number'] for p in pages if p.get('receipt_number')}
+    if numbers and data.get('receipt_number'):
+        return data['receipt_number'] in numbers
+    totals = [p for p in pages if p.get('total')]
+    if not totals or not data.get('total'):
+        return True  # A page without a total goes with its neighbours
+    # The same receipt printed on each page
+    last = totals[-1]
+    return (data['total'] == last['total']
+            and normalize_key(data.get('vendor') or '') == normalize_key(last.get('vendor') or ''))
+
+
+def merge_pages(pages: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Merge the data of consecutive PDF pages into one receipt."""
+    merged = {}
+    for data in pages:
+        for key, value in data.items():
+            if key != 'items' and value not in (None, '', 0) and merged.get(key) in (None, '', 0):
+                merged[key] = value
+    
+    # Amounts come from the last page with a total (totals are printed at the end)
+    with_total = [data for data in pages if data.get('total')]
+    if with_total:
+        for key in ('subtotal', 'tax', 'total'):
+            merged[key] = with_total[-1].get(key)
+    
+    # Items from every page, skipping a page that only repeats earlier items
+    items, seen = [], []
+    for data in pages:
+        page_items = data.get('items') or []
+        if page_items and page_items not in seen:
+            items.extend(page_items)
+            seen.append(page_items)
+    merged['items'] = items
+    merged['confidence'] = min((data.get('confidence', 'medium') for data in pages),
+                               key=lambda c: CONFIDENCE_RANK.get(c, 2))
+    return merged
+
+
+def merge_stats(all_stats: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Combine per-page stats: numbers and timings add up, lists join, others keep the first."""
+    merged = {'timings': {}}
+    for stats in all_stats:
+        for key, value in stats.items():
+            if key == 'timings':
+                for stage, seconds in value.items():
+                    merged['timings'][stage] = merged['timings'].get(stage, 0.0) + seconds
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                merged[key] = merged.get(key, 0) + value
+            elif isinstance(value, list):
+                merged.setdefault(key, []).extend(value)
+            else:
+                merged.setdefault(key, value)
+    if any(stats.get('cache') == 'miss' for stats in all_stats):
+        merged['cache'] = 'miss'
+    return merged
+
+
+def finish_pdf(pages: List[Dict[str, Any]], config: Dict[str, Any],
+               confidence_threshold: str = 'medium') -> List[Dict[str, Any]]:
+    """Turn the page results of one PDF into receipt results.
+
+    Consecutive pages are grouped into receipts with continues_receipt(),
+    merged, then validated and formatted like any other receipt. Failed
+    pages are returned as errors of their own.
+    """
+    file_name = pages[0]['file_name']
+    results = [dict(r, file_name=f"{file_name} (page {r['page'] + 1})")
+               for r in pages if r['error'] is not None]
+    
+    groups = []
+    for page in (r for r in pages if r['error'] is None):
+        if groups and continues_receipt([r['data'] for r in groups[-1]], page['data']):
+            groups[-1].append(page)
+        else:
+            groups.append([page])
+    
+    for group in groups:
+        first, last = group[0]['page'] + 1, group[-1]['page'] + 1
+        pages_text = f"page {first}" if first == last else f"pages {first}-{last}"
+        name = file_name if len(groups) == 1 and not results else f"{file_name} ({pages_text})"
+        log = [f"  📄 {len(group)} page(s) merged ({pages_text})"]
+        stats = merge_stats([r['stats'] for r in group])
+        content_hash = hashlib.sha256(
+            ":".join(r['stats']['content_hash'] for r in group).encode()).hexdigest()
+        result = {'file_name': name, 'path': group[0]['path'], 'record': None, 'error': None,
+                  'log': log, 'stats': stats}
+        try:
+            result['record'] = finish_record(merge_pages([r['data'] for r in group]), config,
+                                             name, content_hash, confidence_threshold, log, stats)
+        except Exception as e:
+            result['error'] = str(e)
+            stats['error_type'] = type(e).__name__
+            log.append(f"  ✗ Error: {e}")
+        results.append(result)
+    return results
+
+
+def check_duplicate(file_path: Path, config: Dict[str, Any], stats: Dict[str, Any],
+                    log: List[str]) -> bool:
+    """Look a receipt image up in the near-duplicate index before any provider call.
+    
+    Returns True only if ``duplicates.action`` is skip and a file with
+    exactly the same content was already processed under another name.
+    Images that merely look alike are never skipped (receipts from one shop
+    or app look alike too): the closest is kept in ``stats['duplicate_match']``
+    for resolve_duplicates() to confirm by total and date after the run.
+    """
+    duplicates = get_duplicate_index(config)
+    if duplicates is None:
+        return False
+    
+    with timed(stats, 'hash'):
+        stats['content_hash'] = file_hash(str(file_path))
+    if (config.get('duplicates') or {}).get('action', 'flag') == 'skip':
+        with timed(stats, 'duplicates'):
+            earlier = duplicates.file_name_of(stats['content_hash'])
+        if earlier is not None and earlier != file_path.name:
+            stats['duplicate_of'] = earlier
+            log.append(f"  ⏭  Skipped: same file as {earlier}")
+            return True
+    
+    with timed(stats, 'dhash'):
+        stats['dhash'] = image_dhash(str(file_path))
+    with timed(stats, 'duplicates'):
+        match, stats['dhash_added'] = duplicates.check_and_add(
+            stats['dhash'], stats['content_hash'], file_path.name)
+    if match is not None:
+        stats['duplicate_match'] = match
+    return False
+
+
+def look_alike(result: Dict[str, Any]) -> Optional[Tuple[str, str, Tuple[str, str, int]]]:
+    """Return (content_hash, file_name, duplicate_match) of a result that looked like an earlier image."""
+    match = result['stats'].get('duplicate_match')
+    if match is None or result['record'] is None:
+        return None
+    return result['record']['content_hash'], result['file_name'], match
+
+
+def resolve_duplicates(look_alikes: List[Tuple[str, str, Tuple[str, str, int]]],
+                       config: Dict[str, Any]) -> Dict[str, str]:
+    """Confirm look-alike receipts once every receipt of the run is done.
+
+    ``look_alikes`` come from look_alike(). Done after the run, because the
+    earlier image may still have been in flight when its look-alike was
+    checked. A look-alike is a duplicate if its total and date match the
+    earlier image's. Returns {content_hash: file name it duplicates}.
+    """
+    duplicates = get_duplicate_index(config)
+    confirmed = {}
+    if duplicates is None:
+        return confirmed
+    for content_hash, file_name, (other_hash, other_name, distance) in look_alikes:
+        amounts = duplicates.amounts(content_hash)
+        if amounts and amounts[0] is not None and amounts == duplicates.amounts(other_hash):
+            confirmed[content_hash] = other_name
+            print(f"  ⚠ {file_name}: possible duplicate of {other_name} (distance {distance})")
+    return confirmed
+
+
+def process_file(file_path: Path, config: Dict[str, Any], confidence_threshold: str = 'medium',
+                 verbose: bool = False, cache: Optional[ExtractionCache] = None,
+                 page: Optional[int] = None) -> Dict[str, Any]:
+    """Parse, validate and format a single receipt.
+
+    Console output is collected in ``log`` instead of printed directly, so
+    results from concurrent workers can be reported in input order.
+    Errors are captured per file and never raised to the caller.
+    With ``page``, only that PDF page is extracted: its raw data is left in
+    ``data`` for finish_pdf() to merge, and ``record`` stays None.
+    """
+    log = []
+    stats = {}
+    result = {'file_name': file_path.name, 'path': str(file_path), 'record': None,
+              'error': None, 'log': log, 'stats': stats}
+    
+    if verbose:
+        log.append(f"🖼️  Image: {file_path}")
+    
+    try:
+        if page is not None:
+            # One page of a PDF, merged into receipts later by finish_pdf()
+            result['page'] = page
+            result['data'] = parse_pdf_page(str(file_path), page, config, cache, stats)
+            if verbose:
+                log.append(f"📊 Raw extraction ({stats['pdf_source']}): "
+                           f"{json.dumps(result['data'], indent=2)}")
+        
+        elif file_path.suffix.lower() == '.pdf':
+            # pdf_tasks() found no pages; report why
+            pdf_page_count(str(file_path))
+            raise ValueError("PDF has no pages")
+        
+        elif check_duplicate(file_path, config, stats, log):
+            result['skipped'] = 'duplicate'
+        
+        else:
+            # Parse receipt
+            data = parse_receipt(str(file_path), config, cache, stats)
+            
+            if verbose:
+                log.append(f"📊 Raw extraction: {json.dumps(data, indent=2)}")
+            
+            content_hash = stats.get('content_hash') or file_hash(str(file_path))
+            result['record'] = finish_record(data, config, file_path.name, content_hash,
+                                             confidence_threshold, log, stats)
+            if stats.get('dhash_added'):
+                # For resolve_duplicates() to compare look-alikes with
+                with timed(stats, 'duplicates'):
+                    get_duplicate_index(config).set_amounts(
+                        content_hash, result['record'].get('total'), result['record'].get('date'))
+    
+    except Exception as e:
+        result['error'] = str(e)
+        stats['error_type'] = type(e).__name__
+        log.append(f"  ✗ Error: {e}")
+        if stats.get('dhash_added'):
+            # Let a later copy of this receipt be processed normally
+            get_duplicate_index(config).discard(stats['content_hash'])
+    
+    if verbose and stats.get('route'):
+        log.append("  🧭 Route: " + " → ".join(stats['route']))
+        for reason in stats.get('escalations', []):
+            log.append(f"     escalated from {reason}")
+    
+    if verbose and stats.get('timings'):
+        log.append("  ⏱  " + ", ".join(
+            f"{stage} {seconds * 1000:.0f}ms" for stage, seconds in stats['timings'].items()))
+    
+    return result
+
+
+def finish_record(data: Dict[str, Any], config: Dict[str, Any], file_name: str,
+                  content_hash: str, confidence_threshold: str, log: List[str],
+                  stats: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Validate and format a raw extraction, logging warnings and confidence."""
+    if stats is None:
+        stats = {}
+    
+    # Validate
+    with timed(stats, 'validate'):
+        warnings = validate_receipt(data, config)
+    if warnings:
+        log.append(f"  ⚠ Warnings: {', '.join(warnings)}")
+    
+    # Format
+    with timed(stats, 'format'):
+        formatted = format_output(data, config, file_name)
+    formatted['content_hash'] = content_hash
+    
+    # Check confidence
+    confidence = formatted.get('confidence', 'medium')
+    
+    if CONFIDENCE_RANK.get(confidence, 2) < CONFIDENCE_RANK.get(confidence_threshold, 2):
+        log.append(f"  ⚠ Low confidence ({confidence}) - review recommended")
+    elif confidence == 'low':
+        log.append(f"  ⚠ Low confidence - review recommended")
+    else:
+        log.append(f"  ✓ Confidence: {confidence}")
+    
+    log.append(f"    {formatted.get('vendor', 'Unknown')} - ${formatted.get('total', 0):.2f}")
+    return formatted
+
+
+# Per-process state for the local OCR process pool (set by init_worker)
+_worker_state: Dict[str, Any] = {}
+
+
+def init_worker(config: Dict[str, Any], confidence_threshold: str, verbose: bool,
+                cache_path: Optional[str], cache_refresh: bool):
+    """Initialise a pool worker once with the run's config and cache."""
+    _worker_state['config'] = config
+    _worker_state['confidence_threshold'] = confidence_threshold
+    _worker_state['verbose'] = verbose
+    # Eviction is left to the parent process, which owns the cache's lifetime
+    _worker_state['cache'] = (
+        ExtractionCache(cache_path, max_entries=0, max_age_days=0, refresh=cache_refresh)
+        if cache_path else None
+    )
+
+
+def process_file_in_worker(task: Tuple[Path, Optional[int]]) -> Dict[str, Any]:
+    """Process a (path, page) task inside a pool worker set up by init_worker."""
+    file_path, page = task
+    return process_file(
+        file_path,
+        _worker_state['config'],
+        _worker_state['confidence_threshold'],
+        _worker_state['verbose'],
+        _worker_state['cache'],
+        page,
+    )
+
+
+def create_executor(config: Dict[str, Any], concurrency: int = 1, workers: int = 1,
+                    confidence_threshold: str = 'medium', verbose: bool = False,
+                    cache: Optional[ExtractionCache] = None):
+    """Create the worker pool for a run, or None to process serially.
+
+    Provider calls are network-bound, so a thread pool of ``concurrency``
+    is enough to overlap them. Local OCR is CPU-bound, so with
+    ``model_provider: local`` a pool of ``workers`` processes is used
+    instead, each initialised once with the config and cache.
+    """
+    if config.get('model_provider', 'openai') == 'local' and workers > 1:
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=init_worker,
+            initargs=(config, confidence_threshold, verbose,
+                      cache.path if cache else None, cache.refresh if cache else False),
+        )
+    if concurrency > 1:
+        return concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+    return None
+
+
+def process_files(files: List[Path], config: Dict[str, Any], concurrency: int = 1,
+                  confidence_threshold: str = 'medium', verbose: bool = False,
+                  cache: Optional[ExtractionCache] = None,
+                  workers: int = 1, executor=None,
+                  on_result=None) -> List[Dict[str, Any]]:
+    """Process receipts with up to ``concurrency`` provider calls in flight.
+
+    Uses ``executor`` if given (so a long-running caller can keep one warm),
+    otherwise a pool from create_executor() that lives for this call.
+    Each PDF page is a task of its own, so pages of one PDF run in parallel.
+    Process pools get tasks in chunks. Results are returned (and their logs
+    printed) in input order, as they arrive; a PDF's pages are merged into
+    receipts as soon as its last page is in. With ``on_result``, each result
+    is passed to it as it arrives instead of being kept and returned.
+    """
+    tasks = pdf_tasks(files)
+    total = len(tasks)
+    
+    def report(i: int, result: Dict[str, Any]) -> Dict[str, Any]:
+        label = result['file_name']
+        if result.get('page') is not None:
+            label += f" (page {result['page'] + 1})"
+        print(f"\n[{i}/{total}] Processing: {label}")
+        for line in result['log']:
+            print(line)
+        return result
+    
+    def collect(results) -> List[Dict[str, Any]]:
+        collected, pages = [], []
+        done = on_result or collected.append
+        
+        def flush():
+            for receipt in finish_pdf(pages, config, confidence_threshold):
+                if receipt.get('page') is None:  # Failed pages were reported already
+                    print(f"\n📄 {receipt['file_name']}")
+                    for line in receipt['log']:
+                        print(line)
+                done(receipt)
+            pages.clear()
+        
+        for i, result in enumerate(results, 1):
+            report(i, result)
+            if pages and result.get('path') != pages[0]['path']:
+                flush()
+            if result.get('page') is None:
+                done(result)
+            else:
+                pages.append(result)
+        if pages:
+            flush()
+        return collected
+    
+    owned = executor is None
+    if owned and total > 1:
+        executor = create_executor(config, concurrency, min(workers, total),
+                                   confidence_threshold, verbose, cache)
+    
+    try:
+        if executor is None:
+            return collect(process_file(f, config, confidence_threshold, verbose, cache, page)
+                           for f, page in tasks)
+        
+        if isinstance(executor, concurrent.futures.ProcessPoolExecutor):
+            chunksize = max(1, min(32, total // (workers * 4)))
+            results = executor.map(process_file_in_worker, tasks, chunksize=chunksize)
+        else:
+            results = executor.map(
+                lambda task: process_file(task[0], config, confidence_threshold, verbose, cache,
+                                          task[1]), tasks
+            )
+        return collect(results)
+    finally:
+        if owned and executor is not None:
+            executor.shutdown()
+
+
+class RunMetrics:
+    """Aggregates per-receipt stats into run-level instrumentation.
+
+    Fed with the ``stats`` dict of every process_file() result (and of
+    save_output()), then exported as a JSON run report and a Prometheus
+    text-format file.
+    """
+    
+    def __init__(self):
+        self.started_at = datetime.now()
+        self._started = time.perf_counter()
+        self.receipts = {'ok': 0, 'error': 0, 'skipped': 0}
+        self.errors = defaultdict(int)
+        self.cache = {'hit': 0, 'miss': 0}
+        self.stages = defaultdict(list)
+        self.bytes = {'original': 0, 'resized': 0, 'payload': 0}
+        self.tokens = {'input': 0, 'output': 0, 'cached': 0}
+        self.retries = 0
+        self.quality_tiers = defaultdict(lambda: {'sent': 0, 'final': 0})
+        self.routes = defaultdict(lambda: {'sent': 0, 'final': 0})
+        self.checks = {}
+    
+    def add_result(self, result: Dict[str, Any]):
+        """Count one process_file() result."""
+        stats = result.get('stats', {})
+        if result.get('skipped'):
+            self.receipts['skipped'] += 1
+        elif result.get('error') is None:
+            self.receipts['ok'] += 1
+        else:
+            self.receipts['error'] += 1
+            self.errors[stats.get('error_type', 'Exception')] += 1
+        if stats.get('cache') in self.cache:
+            self.cache[stats['cache']] += 1
+        for kind in self.bytes:
+            self.bytes[kind] += stats.get(f'bytes_{kind}', 0)
+        for direction in self.tokens:
+            self.tokens[direction] += stats.get(f'{direction}_tokens', 0)
+        self.retries += stats.get('retries', 0)
+        tiers = stats.get('quality_tiers', [])
+        for tier in tiers:
+            self.quality_tiers[tier]['sent'] += 1
+        if tiers and result.get('error') is None:
+            self.quality_tiers[tiers[-1]]['final'] += 1
+        route = stats.get('route', [])
+        for tier in route:
+            self.routes[tier]['sent'] += 1
+        if route and result.get('error') is None:
+            self.routes[route[-1]]['final'] += 1
+        self.add_timings(stats)
+    
+    def add_timings(self, stats: Dict[str, Any]):
+        """Record the stage timings in a stats dict."""
+        for stage, seconds in stats.get('timings', {}).items():
+            self.stages[stage].append(seconds)
+    
+    def summary(self) -> Dict[str, Any]:
+        """Return the run report as a JSON-serialisable dict."""
+        elapsed = time.perf_counter() - self._started
+        total = sum(self.receipts.values())
+        stages = {}
+        for stage, values in sorted(self.stages.items()):
+            ordered = sorted(values)
+            stages[stage] = {
+                'count': len(ordered),
+                'total_seconds': round(sum(ordered), 4),
+                'mean_ms': round(sum(ordered) / len(ordered) * 1000, 3),
+                'p50_ms': round(ordered[len(ordered) // 2] * 1000, 3),
+                'p95_ms': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 3),
+                'max_ms': round(ordered[-1] * 1000, 3),
+            }
+        return {
+            'started_at': self.started_at.strftime('%Y-%m-%d %H:%M:%S'),
+            'wall_seconds': round(elapsed, 3),
+            'receipts': dict(self.receipts),
+            'receipts_per_second': round(total / elapsed, 3) if elapsed > 0 else None,
+            'errors': dict(self.errors),
+            'retries': self.retries,
+            'cache': dict(self.cache),
+            'bytes': dict(self.bytes),
+            'tokens': dict(self.tokens),
+            'quality_tiers': {tier: dict(counts) for tier, counts in self.quality_tiers.items()},
+            'routes': {tier: dict(counts) for tier, counts in self.routes.items()},
+            'checks': dict(self.checks),
+            'stages': stages,
+        }
+    
+    def to_prometheus(self, prefix: str = 'expense_parser') -> str:
+        """Render the metrics in the Prometheus text exposition format."""
+        summary = self.summary()
+        lines = []
+        
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} {kind}")
+            for labels, value in samples:
+                label_text = ','.join(f'{k}="{v}"' for k, v in labels.items())
+                suffix = f"{{{label_text}}}" if label_text else ''
+                lines.append(f"{prefix}_{name}{suffix} {value}")
+        
+        metric('receipts_total', 'counter', 'Receipts processed, by outcome.',
+               [({'outcome': k}, v) for k, v in summary['receipts'].items()])
+        metric('errors_total', 'counter', 'Failed receipts, by error type.',
+               [({'type': k}, v) for k, v in summary['errors'].items()])
+        metric('retries_total', 'counter', 'Provider call retries.', [({}, summary['retries'])])
+        metric('cache_lookups_total', 'counter', 'Extraction cache lookups, by result.',
+               [({'result': k}, v) for k, v in summary['cache'].items()])
+        metric('image_bytes_total', 'counter',
+               'Image bytes: original files, after resizing, and base64 payload sent.',
+               [({'kind': k}, v) for k, v in summary['bytes'].items()])
+        metric('tokens_total', 'counter', 'Provider tokens reported in API usage (cached is part of input).',
+               [({'direction': k}, v) for k, v in summary['tokens'].items()])
+        metric('quality_tier_total', 'counter',
+               'Adaptive image quality: images sent per tier, and tier of the answer kept.',
+               [({'tier': tier, 'kind': kind}, n) for tier, counts in summary['quality_tiers'].items()
+                for kind, n in counts.items()])
+        metric('route_total', 'counter',
+               'Model routing: receipts sent to each tier, and tier of the answer kept.',
+               [({'tier': tier, 'kind': kind}, n) for tier, counts in summary['routes'].items()
+                for kind, n in counts.items()])
+        metric('checks_failed_total', 'counter', 'Receipts flagged by each batch validation check.',
+               [({'check': k}, v) for k, v in summary['checks'].items()])
+        
+        stage_samples = []
+        for stage, values in summary['stages'].items():
+            stage_samples.append(({'stage': stage, 'quantile': '0.5'}, round(values['p50_ms'] / 1000, 6)))
+            stage_samples.append(({'stage': stage, 'quantile': '0.95'}, round(values['p95_ms'] / 1000, 6)))
+        metric('stage_seconds', 'summary', 'Wall time per pipeline stage.', stage_samples)
+        for stage, values in summary['stages'].items():
+            lines.append(f'{prefix}_stage_seconds_sum{{stage="{stage}"}} {values["total_seconds"]}')
+            lines.append(f'{prefix}_stage_seconds_count{{stage="{stage}"}} {values["count"]}')
+        
+        metric('run_seconds', 'gauge', 'Wall time of the run so far.', [({}, summary['wall_seconds'])])
+        return "\n".join(lines) + "\n"
+
+
+def write_run_report(metrics: RunMetrics, config: Dict[str, Any]) -> Optional[str]:
+    """Write the JSON run report and Prometheus metrics file; return the report path."""
+    metrics_config = config.get('metrics', {})
+    if not metrics_config.get('enabled', True):
+        return None
+    folder = metrics_config.get('folder') or os.path.join(
+        config.get('output_folder', './output'), 'reports')
+    os.makedirs(folder, exist_ok=True)
+    
+    report_path = os.path.join(
+        folder, f"run_{metrics.started_at.strftime('%Y-%m-%d_%H-%M-%S')}.json")
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump(metrics.summary(), f, indent=2)
+    
+    # Overwritten each run, for a Prometheus textfile collector to scrape
+    prom_path = os.path.join(folder, 'metrics.prom')
+    with open(prom_path + '.tmp', 'w', encoding='utf-8') as f:
+        f.write(metrics.to_prometheus())
+    os.replace(prom_path + '.tmp', prom_path)
+    return report_path
+
+
+def batch_folder(config: Dict[str, Any]) -> str:
+    """Folder holding the state files of submitted provider batches."""
+    return os.path.join(config.get('output_folder', './output'), 'batches')
+
+
+def write_batch_state(state: Dict[str, Any], path: str):
+    """Atomically write a batch state file."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def submit_batch(files: List[Path], config: Dict[str, Any]) -> List[str]:
+    """Submit receipts through the provider's batch API instead of one call each.
+
+    Requests are built with the same prompt and image payload as
+    parse_with_openai/parse_with_anthropic, written to a JSONL file and
+    submitted in chunks of ``batch_api.max_requests``. Each batch id is
+    saved under output/batches/ so collect_batches() can pick the results
+    up later, even after a restart. Returns the submitted batch ids.
+    """
+    provider = config.get('model_provider', 'openai')
+    if provider not in ('openai', 'anthropic'):
+        raise ValueError(f"Batch API is not available for model provider: {provider}")
+    # Batch calls are few, so they keep the SDK's own retries
+    client = get_client(provider, config, get_api_key(provider)).with_options(
+        max_retries=int(config.get('max_retries', 3)))
+    
+    batch_config = config.get('batch_api', {})
+    chunk_size = max(1, int(batch_config.get('max_requests', 1000)))
+    folder = batch_folder(config)
+    os.makedirs(folder, exist_ok=True)
+    fingerprint = extraction_fingerprint(config)
+    
+    batch_ids = []
+    for start in range(0, len(files), chunk_size):
+        chunk = files[start:start + chunk_size]
+        stamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+        jsonl_path = os.path.join(folder, f"pending_{stamp}_{start}.jsonl")
+        entries = {}
+        
+        # Stream requests to disk so large chunks never sit in memory at once
+        with open(jsonl_path, 'w', encoding='utf-8') as f:
+            for i, file_path in enumerate(chunk, start):
+                custom_id = f"receipt-{i}"
+                try:
+                    if file_path.suffix.lower() == '.pdf':
+                        raise ValueError("PDFs are not sent through the batch API; "
+                                         "run without --batch-api to process them")
+                    if provider == 'openai':
+                        line = {"custom_id": custom_id, "method": "POST",
+                                "url": "/v1/chat/completions",
+                                "body": build_openai_request(str(file_path), config)}
+                    else:
+                        line = {"custom_id": custom_id,
+                                "params": build_anthropic_request(str(file_path), config)}
+                    entries[custom_id] = {
+                        'path': str(file_path),
+                        'file_name': file_path.name,
+                        'content_hash': file_hash(str(file_path)),
+                    }
+                except Exception as e:
+                    print(f"  ✗ Skipping {file_path.name}: {e}")
+                    continue
+                f.write(json.dumps(line) + "\n")
+        
+        if not entries:
+            os.remove(jsonl_path)
+            continue
+        
+        if provider == 'openai':
+            with open(jsonl_path, 'rb') as f:
+                uploaded = client.files.create(file=f, purpose='batch')
+            batch = client.batches.create(
+                input_file_id=uploaded.id,
+                endpoint='/v1/chat/completions',
+                completion_window='24h',
+            )
+        else:
+            with open(jsonl_path, 'r', encoding='utf-8') as f:
+                requests = [json.loads(line) for line in f]
+            batch = client.messages.batches.create(requests=requests)
+        
+        write_batch_state({
+            'provider': provider,
+            'batch_id': batch.id,
+            'submitted_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'status': 'submitted',
+            'fingerprint': fingerprint,
+            'requests': entries,
+        }, os.path.join(folder, f"batch_{batch.id}.json"))
+        os.remove(jsonl_path)
+        
+        print(f"  ✓ Submitted batch {batch.id} ({len(entries)} receipt(s))")
+        batch_ids.append(batch.id)
+    
+    return batch_ids
+
+
+def fetch_batch_results(client, state: Dict[str, Any]) -> Optional[Dict[str, Tuple[Optional[str], Optional[str]]]]:
+    """Return {custom_id: (reply text, error)} for a finished batch, or None if still running."""
+    results = {}
+    
+    if state['provider'] == 'openai':
+        batch = client.batches.retrieve(state['batch_id'])
+        if batch.status in ('validating', 'in_progress', 'finalizing', 'cancelling'):
+            return None
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            for line in client.files.content(file_id).text.splitlines():
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                response = item.get('response') or {}
+                if response.get('status_code') == 200:
+                    message = response['body']['choices'][0]['message']
+                    if message.get('refusal'):
+                        results[item['custom_id']] = (None, f"The model refused: {message['refusal']}")
+                    else:
+                        results[item['custom_id']] = (message.get('content'), None)
+                else:
+                    error = item.get('error') or response.get('body')
+                    results[item['custom_id']] = (None, f"Batch request failed: {error}")
+        if not results:
+            for custom_id in state['requests']:
+                results[custom_id] = (None, f"Batch {batch.status}")
+        return results
+    
+    batch = client.messages.batches.retrieve(state['batch_id'])
+    if batch.processing_status != 'ended':
+        return None
+    for item in client.messages.batches.results(state['batch_id']):
+        if item.result.type == 'succeeded':
+            results[item.custom_id] = (anthropic_reply_text(item.result.message.content), None)
+        else:
+            error = getattr(item.result, 'error', None) or item.result.type
+            results[item.custom_id] = (None, f"Batch request {item.result.type}: {error}")
+    return results
+
+
+def collect_batches(config: Dict[str, Any], cache: Optional[ExtractionCache] = None,
+                    confidence_threshold: str = 'medium') -> Tuple[List[Dict[str, Any]], List[str], int]:
+    """Collect results of finished batches into formatted records.
+
+    Returns (records, state paths collected, number of batches still running).
+    Replies are also stored in the extraction cache, so a later normal run
+    over the same files costs nothing.
+    """
+    folder = batch_folder(config)
+    if not os.path.isdir(folder):
+        return [], [], 0
+    
+    records, collected, pending = [], [], 0
+    for name in sorted(os.listdir(folder)):
+        if not (name.startswith('batch_') and name.endswith('.json')):
+            continue
+        state_path = os.path.join(folder, name)
+        with open(state_path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        if state.get('status') == 'collected':
+            continue
+        
+        provider = state['provider']
+        client = get_client(provider, config, get_api_key(provider)).with_options(
+            max_retries=int(config.get('max_retries', 3)))
+        replies = fetch_batch_results(client, state)
+        if replies is None:
+            print(f"  … Batch {state['batch_id']} still running ({len(state['requests'])} receipt(s))")
+            pending += 1
+            continue
+        
+        print(f"\n📦 Batch {state['batch_id']} finished")
+        for custom_id, entry in state['requests'].items():
+            log = []
+            try:
+                content, error = replies.get(custom_id, (None, "No result returned"))
+                if error:
+                    raise ValueError(error)
+                data = parse_reply(content)
+                if cache is not None:
+                    cache.put(cache.make_key(entry['content_hash'], config, state['fingerprint']), data)
+                records.append(finish_record(data, config, entry['file_name'],
+                                             entry['content_hash'], confidence_threshold, log))
+            except Exception as e:
+                log.append(f"  ✗ Error: {e}")
+            print(f"\n  {entry['file_name']}")
+            for line in log:
+                print(line)
+        collected.append(state_path)
+    
+    return records, collected, pending
+
+
+def mark_batches_collected(state_paths: List[str]):
+    """Record that these batches have been saved, so they are not collected twice."""
+    for state_path in state_paths:
+        with open(state_path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        state['status'] = 'collected'
+        state['collected_at'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        write_batch_state(state, state_path)
+
+
+class RecordSink:
+    """Writes receipts out as they finish, so a crash loses at most a few.
+
+    Each record is appended to ``output_folder/stream/run_<time>.jsonl``
+    (and a .csv next to it if ``stream.csv`` is set) and, with a ledger,
+    upserted into it. Files are flushed to disk and the ledger updated every
+    ``stream.flush_every`` records or ``stream.flush_seconds`` seconds,
+    whichever comes first. Nothing is held in memory in between; the final
+    export is built from the ledger or read back from the JSONL file.
+    A record's ``on_saved`` callback runs only once that flush is done.
+    The files are deleted with remove() once the run's output is saved,
+    unless ``stream.keep`` is set.
+    
+    Iterating a sink reads its records back one at a time, as often as
+    needed, from the ledger (or the JSONL file without one).
+    """
+    
+    def __init__(self, config: Dict[str, Any], ledger: Optional[Ledger] = None):
+        stream_config = config.get('stream') or {}
+        self.ledger = ledger
+        self.flush_every = max(1, int(stream_config.get('flush_every', 20)))
+        self.flush_seconds = float(stream_config.get('flush_seconds', 5))
+        self.count = 0
+        self.inserted = self.updated = 0
+        self.stats: Dict[str, Any] = {}
+        self._pending: List[Dict[str, Any]] = []
+        self._on_saved: List[Any] = []
+        self._duplicate_of: Dict[str, str] = {}
+        self._hashes = set()
+        self._last_flush = time.monotonic()
+        self._processed_from = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        
+        self.folder = os.path.join(config.get('output_folder', './output'), 'stream')
+        self.path = self._csv_path = None
+        self._write_csv = stream_config.get('csv', False)
+        self._columns = config.get('output_columns') or None
+        self._file = self._csv_file = self._csv = None
+    
+    def _open(self):
+        """Create the stream files when the first record arrives."""
+        os.makedirs(self.folder, exist_ok=True)
+        stem = os.path.join(self.folder, f"run_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}")
+        # Runs started in the same second each get a file of their own
+        for attempt in range(1, 1000):
+            self.path = stem + (f"-{attempt}" if attempt > 1 else '') + '.jsonl'
+            try:
+                self._file = open(self.path, 'x', encoding='utf-8')
+                break
+            except FileExistsError:
+                continue
+        if self._write_csv:
+            self._csv_path = self.path[:-len('.jsonl')] + '.csv'
+            self._csv_file = open(self._csv_path, 'w', newline='', encoding='utf-8')
+    
+    def write(self, record: Dict[str, Any], on_saved=None):
+        """Append one record, flushing if the interval is up.
+
+        ``on_saved`` is called once the record is safely on disk (and in the
+        ledger), e.g. to mark its input file as done in the journal.
+        """
+        if self._file is None:
+            self._open()
+        self._file.write(json.dumps(record, default=str) + "\n")
+        if self._csv_file is not None:
+            if self._csv is None:
+                self._csv = csv.DictWriter(self._csv_file, self._columns or list(record),
+                                           extrasaction='ignore')
+                self._csv.writeheader()
+            self._csv.writerow(record)
+        self._pending.append(record)
+        self._hashes.add(record.get('content_hash'))
+        if record.get('processed_at') and str(record['processed_at']) < self._processed_from:
+            self._processed_from = str(record['processed_at'])
+        if on_saved is not None:
+            self._on_saved.append(on_saved)
+        self.count += 1
+        if (len(self._pending) >= self.flush_every
+                or time.monotonic() - self._last_flush >= self.flush_seconds):
+            self.flush()
+    
+    def flush(self):
+        """Write buffered records to disk and the ledger."""
+        with timed(self.stats, 'save_stream'):
+            for f in (self._file, self._csv_file):
+                if f is not None and not f.closed:
+                    f.flush()
+                    os.fsync(f.fileno())
+        if self.ledger is not None and self._pending:
+            with timed(self.stats, 'save_ledger'):
+                inserted, updated = self.ledger.upsert(self._pending)
+            self.inserted += inserted
+            self.updated += updated
+        self._pending = []
+        self._last_flush = time.monotonic()
+        callbacks, self._on_saved = self._on_saved, []
+        for callback in callbacks:
+            callback()
+    
+    def mark_duplicates(self, duplicate_of: Dict[str, str]):
+        """Set ``duplicate_of`` on saved records, given {content_hash: file name}."""
+        self.flush()
+        self._duplicate_of.update(duplicate_of)
+        if self.ledger is not None:
+            self.ledger.mark_duplicates(duplicate_of)
+    
+    def __len__(self) -> int:
+        return self.count
+    
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        """Yield every record written so far."""
+        if self._file is None:
+            return
+        self.flush()
+        if self.ledger is not None and None not in self._hashes:
+            # Stored by this run: no older than its oldest record, with one of its hashes
+            for record in self.ledger.iterate(self._processed_from):
+                if record.get('content_hash') in self._hashes:
+                    yield record
+            return
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if record.get('content_hash') in self._duplicate_of:
+                    record['duplicate_of'] = self._duplicate_of[record['content_hash']]
+                yield record
+    
+    def close(self):
+        self.flush()
+        for f in (self._file, self._csv_file):
+            if f is not None:
+                f.close()
+    
+    def remove(self):
+        """Close and delete the stream files, once their records are saved elsewhere."""
+        self.close()
+        for path in (self.path, self._csv_path):
+            if path is not None and os.path.exists(path):
+                os.remove(path)
+
+
+def finish_run(records: Iterable[Dict[str, Any]], config: Dict[str, Any],
+               metrics: Optional[RunMetrics] = None, sink: Optional[RecordSink] = None):
+    """Save records, write the run report and print the end-of-run summary.
+
+    With a ``sink`` the records were already stored as they finished, so
+    only the output file is rebuilt, and ``records`` is the sink itself
+    (read back as needed rather than loaded whole). Then the whole run goes
+    through validate_batch(), against the ledger's receipts for duplicates.
+    """
+    save_stats = {}
+    ledger = sink.ledger if sink is not None else open_ledger(config)
+    try:
+        if sink is not None:
+            if ledger is not None:
+                print(f"  Ledger: {sink.inserted} new, {sink.updated} updated receipt(s) "
+                      f"in {ledger.path}")
+            output_path = export_output(records, config, ledger, save_stats)
+        else:
+            output_path = save_output(records, config, ledger, save_stats)
+        
+        with timed(save_stats, 'batch_checks'):
+            frame = batch_frame(records, config)
+            checks = validate_batch(frame, config, ledger if config.get(
+                'validation', {}).get('compare_with_ledger', True) else None)
+    finally:
+        if sink is None and ledger is not None:
+            ledger.close()
+    if len(frame):
+        print_batch_checks(checks, frame['file_name'])
+    
+    if metrics is not None:
+        metrics.add_timings(save_stats)
+        metrics.checks = {check: int(count) for check, count in checks.sum().items()}
+        report_path = write_run_report(metrics, config)
+        if report_path:
+            print(f"📈 Run report: {report_path}")
+    
+    # Summary
+    low_confidence = frame['file_name'][frame['confidence'] == 'low']
+    medium_confidence = int((frame['confidence'] == 'medium').sum())
+    
+    print(f"\n✓ Done! Processed {len(frame)} receipt(s)")
+    print(f"  High confidence: {len(frame) - len(low_confidence) - medium_confidence}")
+    if medium_confidence:
+        print(f"  Medium confidence: {medium_confidence} (quick review recommended)")
+    if len(low_confidence):
+        print(f"  ⚠ Low confidence: {len(low_confidence)} (detailed review needed)")
+        print(f"    Files: {', '.join(name or 'unknown' for name in low_confidence)}")
+    
+    # Play sound if configured (Mac only)
+    if config.get('play_sound', False) and sys.platform == 'darwin':
+        os.system('afplay /System/Library/Sounds/Glass.aiff')
     
     return output_path
 
 
-def save_iras_export(records: List[Dict[str, Any]], config: Dict[str, Any], output_folder: str):
-    """Save records in IRAS GST F5-compatible format."""
-    iras_config = config.get('iras_export', {})
-    default_code = iras_config.get('default_gst_code', 'TX')
-    category_codes = iras_config.get('category_gst_codes', {})
+def record_outcome(journal: Journal, result: Dict[str, Any], signature: Tuple[int, float],
+                   failed_paths: set):
+    """Write one result to the journal (a PDF fails if any of its receipts failed)."""
+    path = result['path']
+    if result['error'] is not None:
+        failed_paths.add(path)
+        outcome = 'error'
+    elif path in failed_paths:
+        return  # An earlier receipt of this PDF failed; keep that outcome
+    elif result.get('skipped'):
+        return  # Not done: checked again (without an AI call) next time
+    else:
+        outcome = 'ok'
+    if path.lower().endswith('.pdf'):
+        content_hash = pdf_file_hash(path, *signature)
+    else:
+        content_hash = result['stats'].get('content_hash')
+    journal.record(path, signature[0], signature[1], content_hash, outcome, result['error'])
+
+
+def add_dead_letter(result: Dict[str, Any], config: Dict[str, Any]):
+    """Append a receipt that failed for good to ``output_folder/dead_letter.jsonl``.
+
+    One JSON line per failure, with the error and how many attempts were
+    made, so the file can be reviewed (or fed back in) after the run.
+    """
+    if not (config.get('retry') or {}).get('dead_letter', True):
+        return
+    stats = result.get('stats', {})
+    entry = {
+        'failed_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'path': result.get('path'),
+        'file_name': result['file_name'],
+        'error': result['error'],
+        'error_type': stats.get('error_type'),
+        'attempts': stats.get('retries', 0) + 1,
+        # False: retrying would not help (bad request, bad key, unreadable file)
+        'retryable': stats.get('retryable', False),
+    }
+    folder = config.get('output_folder', './output')
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, 'dead_letter.jsonl'), 'a', encoding='utf-8') as f:
+        f.write(json.dumps(entry) + "\n")
+
+
+RECEIPT_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.pdf')
+
+
+def scan_receipts(folder: str, recursive: bool = False) -> Dict[str, Tuple[int, float]]:
+    """Return {path: (size, mtime)} for the receipt files in a folder.
+
+    With ``recursive``, sub-folders are scanned too (except hidden ones).
+    Uses os.scandir, so on most systems only files with a receipt
+    extension cost a stat call.
+    """
+    found = {}
+    folders = [folder]
+    while folders:
+        with os.scandir(folders.pop()) as entries:
+            for entry in entries:
+                if entry.name.lower().endswith(RECEIPT_EXTENSIONS) and entry.is_file():
+                    stat = entry.stat()
+                    found[entry.path] = (stat.st_size, stat.st_mtime)
+                elif (recursive and not entry.name.startswith('.')
+                      and entry.is_dir(follow_symlinks=False)):
+                    folders.append(entry.path)
+    return found
+
+
+def load_run_config(args) -> Dict[str, Any]:
+    """Load the config file and apply command-line overrides."""
+    config = load_config(args.config)
+    if args.output:
+        config['output_folder'] = args.output
+    if args.concurrency:
+        config['concurrency'] = args.concurrency
+    if args.workers:
+        config['workers'] = args.workers
+    return config
+
+
+def watch_folder(folder: str, args):
+    """Process receipts as they land in a folder, until interrupted.
+
+    Polls with os.scandir every ``watch.poll_interval`` seconds. A file is
+    picked up once its size and modification time have not changed for
+    ``watch.settle_seconds`` (so half-copied scans are left alone). The
+    worker pool, cache, ledger and journal stay open between files, and
+    config.yaml is reloaded whenever it changes.
+    """
+    config = load_run_config(args)
+    config_mtime = os.path.getmtime(args.config)
     
-    # Map records to IRAS format
-    iras_records = []
-    for record in records:
-        category = record.get('category', 'Others')
-        gst_code = category_codes.get(category, default_code)
-        
-        # Calculate GST amount
-        subtotal = record.get('subtotal', 0) or record.get('total', 0)
-        tax = record.get('tax', 0)
-        total = record.get('total', 0)
-        
-        # For zero-rated or out-of-scope, adjust
-        if gst_code in ['ZP', 'OS']:
-            tax = 0
-        
-        iras_records.append({
-            'Date': record.get('date', ''),
-            'Supplier Name': record.get('vendor', ''),
-            'Supplier GST Reg No': '',  # Would need to be extracted or mapped
-            'Description': record.get('description', ''),
-            'Value Excl GST': subtotal,
-            'GST Amount': tax,
-            'Total Amount': total,
-            'GST Code': gst_code,
-            'Receipt Reference': record.get('receipt_number', ''),
-        })
+    def close_resources(cache, ledger, journal, executor):
+        if executor is not None:
+            executor.shutdown()
+        for store in (cache, ledger, journal):
+            if store is not None:
+                store.close()
+        close_clients()
+    
+    def open_resources(config):
+        opened = [None, None, None, None]  # cache, ledger, journal, executor
+        try:
+            opened[0] = None if args.no_cache else open_cache(config, refresh=args.refresh)
+            opened[1] = open_ledger(config)
+            opened[2] = open_journal(config)
+            concurrency = max(1, int(config.get('concurrency', 1)))
+            workers = max(1, int(config.get('workers') or os.cpu_count() or 1))
+            opened[3] = create_executor(config, concurrency, workers,
+                                        args.confidence_threshold, args.verbose, opened[0])
+        except Exception:
+            close_resources(*opened)
+            raise
+        return (*opened, concurrency, workers)
+    
+    cache, ledger, journal, executor, concurrency, workers = open_resources(config)
+    metrics = RunMetrics()
+    failed_paths = set()
     
-    # Save as CSV
-    df = pd.DataFrame(iras_records)
-    iras_path = os.path.join(output_folder, f"iras_gst_export_{datetime.now().strftime('%Y-%m-%d')}.csv")
-    df.to_csv(iras_path, index=False)
+    # Files the journal (or, for images, the ledger) has from an earlier run
+    found = scan_receipts(folder, args.recursive)
+    todo = set(journal.plan(found)[0]) if journal is not None else set(found)
+    known = {}
+    for path, signature in found.items():
+        if path not in todo or (ledger is not None and not path.lower().endswith('.pdf')
+                                and ledger.contains(file_hash(path))):
+            known[path] = signature
+    candidates = {}  # path -> ((size, mtime), time first seen with that signature)
     
-    return iras_path
+    print(f"👀 Watching {folder} for new receipts (Ctrl+C to stop)")
+    if known:
+        print(f"  {len(known)} receipt(s) already processed")
+    
+    try:
+        while True:
+            watch_config = config.get('watch', {})
+            
+            # Reload config if it changed
+            try:
+                mtime = os.path.getmtime(args.config)
+                if mtime != config_mtime:
+                    config_mtime = mtime
+                    new_config = load_run_config(args)
+                    # The old pool and stores stay in use unless the new ones all open
+                    resources = open_resources(new_config)
+                    close_resources(cache, ledger, journal, executor)
+                    config = new_config
+                    cache, ledger, journal, executor, concurrency, workers = resources
+                    print(f"🔄 Reloaded config from {args.config}")
+            except Exception as e:
+                print(f"  ⚠ Could not reload config, keeping the previous one: {e}")
+            
+            # Pick up files whose size and mtime have settled
+            now = time.time()
+            settle = watch_config.get('settle_seconds', 3)
+            found = scan_receipts(folder, args.recursive)
+            ready = []
+            for path, signature in found.items():
+                if known.get(path) == signature:
+                    continue
+                seen = candidates.get(path)
+                if seen is None or seen[0] != signature:
+                    candidates[path] = (signature, now)
+                elif now - seen[1] >= settle and now - signature[1] >= settle:
+                    ready.append(path)
+            for path in list(candidates):
+                if path not in found:
+                    del candidates[path]
+            
+            if ready:
+                ready.sort()
+                results = process_files([Path(p) for p in ready], config, concurrency,
+                                        args.confidence_threshold, args.verbose, cache,
+                                        workers, executor)
+                for path in ready:
+                    known[path] = candidates.pop(path)[0]
+                for result in results:
+                    metrics.add_result(result)
+                    if result['error'] is not None:
+                        add_dead_letter(result, config)
+                duplicate_of = resolve_duplicates(
+                    [match for match in map(look_alike, results) if match is not None], config)
+                records = [r['record'] for r in results if r['record'] is not None]
+                for record in records:
+                    if record['content_hash'] in duplicate_of:
+                        record['duplicate_of'] = duplicate_of[record['content_hash']]
+                if records:
+                    save_stats = {}
+                    save_output(records, config, ledger, save_stats)
+                    metrics.add_timings(save_stats)
+                if journal is not None:
+                    # Only once saved, as in a normal run
+                    for result in results:
+                        record_outcome(journal, result, known[result['path']], failed_paths)
+                write_run_report(metrics, config)
+            
+            time.sleep(watch_config.get('poll_interval', 2))
+    except KeyboardInterrupt:
+        print("\n👋 Stopped watching")
+    finally:
+        close_resources(cache, ledger, journal, executor)
 
 
 def main():
@@ -563,6 +3865,7 @@ def main():
     )
     parser.add_argument(
         'input',
+        nargs='?',
         help='Receipt image file or folder containing images'
     )
     parser.add_argument(
@@ -585,106 +3888,295 @@ def main():
         choices=['high', 'medium', 'low'],
         help='Minimum confidence level to accept (default: medium)'
     )
+    parser.add_argument(
+        '--concurrency',
+        type=int,
+        help='Number of receipts to process in parallel (overrides config)'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        help='Number of CPU worker processes for local OCR (default: number of CPU cores)'
+    )
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='Do not read or write the extraction cache'
+    )
+    parser.add_argument(
+        '--refresh',
+        action='store_true',
+        help='Ignore cached extractions and re-parse every receipt (results are re-cached)'
+    )
+    parser.add_argument(
+        '--recursive', '-r',
+        action='store_true',
+        help='Also look for receipts in sub-folders of the input folder'
+    )
+    parser.add_argument(
+        '--force',
+        action='store_true',
+        help='Process every file, even ones an earlier run already processed'
+    )
+    parser.add_argument(
+        '--retry-failed',
+        action='store_true',
+        help='Only process files that failed in an earlier run'
+    )
+    parser.add_argument(
+        '--export',
+        action='store_true',
+        help='Rebuild the output file for the current period from the ledger, without parsing'
+    )
+    parser.add_argument(
+        '--watch',
+        metavar='DIR',
+        help='Keep running and process new receipts as they are saved into DIR'
+    )
+    parser.add_argument(
+        '--iras-quarter',
+        metavar='QUARTER',
+        help='Write the IRAS GST export and F5 summary for one filing quarter '
+             '(e.g. 2025-Q1) from the ledger, without parsing'
+    )
+    parser.add_argument(
+        '--check-ledger',
+        action='store_true',
+        help='Run the validation checks over every receipt in the ledger, without parsing'
+    )
+    parser.add_argument(
+        '--batch-api',
+        action='store_true',
+        help='Submit receipts as one provider batch job (cheaper, results within 24h)'
+    )
+    parser.add_argument(
+        '--batch-collect',
+        action='store_true',
+        help='Collect results of finished batch jobs and save them'
+    )
+    parser.add_argument(
+        '--batch-wait',
+        action='store_true',
+        help='With --batch-collect, keep polling until every batch has finished'
+    )
     
     args = parser.parse_args()
+    load_env()
     
     # Load config
     if args.verbose:
         print(f"🔧 Loading config from: {args.config}")
-    config = load_config(args.config)
+    config = load_run_config(args)
     
     if args.verbose:
         print(f"⚙️  Settings: {json.dumps(config, indent=2)}")
     
-    if args.output:
-        config['output_folder'] = args.output
+    if args.export:
+        ledger = open_ledger(config)
+        if ledger is None:
+            parser.error("--export needs the ledger (set ledger: enabled: true in config)")
+        export_output([], config, ledger)
+        ledger.close()
+        return
+    
+    if args.iras_quarter:
+        ledger = open_ledger(config)
+        if ledger is None:
+            parser.error("--iras-quarter needs the ledger (set ledger: enabled: true in config)")
+        start_month = int(config.get('iras_export', {}).get('quarter_start_month', 1))
+        try:
+            date_from, date_to = quarter_range(args.iras_quarter, start_month)
+        except ValueError as e:
+            parser.error(str(e))
+        records = ledger.fetch_dated(date_from, date_to)
+        ledger.close()
+        label = re.sub(r'^(\d{4})-?Q', r'\1-Q', args.iras_quarter.strip().upper())
+        os.makedirs(config.get('output_folder', './output'), exist_ok=True)
+        iras_path, summary_path = save_iras_export(records, config,
+                                                   config.get('output_folder', './output'), label)
+        print(f"✓ IRAS GST export for {label} ({date_from} to {date_to}, {len(records)} receipts): "
+              f"{iras_path}")
+        print(f"✓ F5 summary: {summary_path}")
+        return
+    
+    if args.check_ledger:
+        ledger = open_ledger(config)
+        if ledger is None:
+            parser.error("--check-ledger needs the ledger (set ledger: enabled: true in config)")
+        started = time.perf_counter()
+        try:
+            frame = batch_frame(ledger.iterate(), config)
+        finally:
+            ledger.close()
+        checks = validate_batch(frame, config)
+        print_batch_checks(checks, frame['file_name'])
+        print(f"⏱  Checked {len(frame)} receipt(s) in {time.perf_counter() - started:.2f}s")
+        return
+    
+    if args.batch_collect:
+        cache = None if args.no_cache else open_cache(config)
+        records, collected, pending = [], [], 0
+        poll_interval = config.get('batch_api', {}).get('poll_interval', 60)
+        try:
+            while True:
+                new_records, new_collected, pending = collect_batches(
+                    config, cache, args.confidence_threshold)
+                records.extend(new_records)
+                collected.extend(new_collected)
+                if not (args.batch_wait and pending):
+                    break
+                time.sleep(poll_interval)
+        finally:
+            if cache is not None:
+                cache.close()
+        if records:
+            finish_run(records, config)
+        if collected:
+            mark_batches_collected(collected)
+        print(f"\n📦 {len(collected)} batch(es) collected, {pending} still running")
+        return
+    
+    if args.watch:
+        if not os.path.isdir(args.watch):
+            parser.error(f"--watch needs a folder: {args.watch}")
+        watch_folder(args.watch, args)
+        return
+    
+    if not args.input:
+        parser.error("the input file or folder is required")
     
     # Get input files
     input_path = Path(args.input)
+    journal = None
     if input_path.is_dir():
-        # Get all image files
-        extensions = ['*.jpg', '*.jpeg', '*.png', '*.pdf']
-        files = []
-        for ext in extensions:
-            files.extend(input_path.glob(ext))
-            files.extend(input_path.glob(ext.upper()))
-        files = list(set(files))  # Remove duplicates
+        # Absolute paths, so the journal matches whatever folder we run from
+        found = {os.path.abspath(p): signature
+                 for p, signature in scan_receipts(args.input, args.recursive).items()}
+        files = [Path(p) for p in sorted(found)]
     else:
+        found = {}
         files = [input_path]
     
     if not files:
         print("No receipt files found!")
         sys.exit(1)
     
+    # Skip files an earlier run already processed (folders only)
+    if found and not args.batch_api:
+        journal = open_journal(config)
+    if journal is not None and not args.force:
+        todo, counts = journal.plan(found, args.retry_failed)
+        print(f"📒 {counts['new']} new, {counts['changed']} changed, {counts['failed']} failed before, "
+              f"{counts['unchanged']} already processed")
+        files = [Path(p) for p in todo]
+        if not files:
+            journal.close()
+            print("✓ Nothing to do (use --force to process everything again)")
+            return
+    
+    if args.batch_api:
+        print(f"Submitting {len(files)} receipt(s) to the batch API")
+        batch_ids = submit_batch(files, config)
+        print(f"\n✓ {len(batch_ids)} batch(es) submitted. Collect results later with:")
+        print(f"  python parse_receipt.py --batch-collect --config {args.config}")
+        return
+    
+    concurrency = max(1, int(config.get('concurrency', 1)))
+    workers = max(1, int(config.get('workers') or os.cpu_count() or 1))
+    
     print(f"Found {len(files)} receipt(s) to process")
     if args.verbose:
         print(f"📁 Files: {[f.name for f in files]}")
+        print(f"🧵 Concurrency: {concurrency}, local OCR workers: {workers}")
+    
+    cache = None if args.no_cache else open_cache(config, refresh=args.refresh)
+    ledger = open_ledger(config)
+    sink = RecordSink(config, ledger)
+    
+    # Process each receipt, saving each one as soon as it is done
+    metrics = RunMetrics()
+    failed, failed_paths, look_alikes = [], set(), []
+    run_started_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     
-    # Process each receipt
-    records = []
-    for i, file_path in enumerate(files, 1):
-        print(f"\n[{i}/{len(files)}] Processing: {file_path.name}")
+    def handle(result):
+        metrics.add_result(result)
+        match = look_alike(result)
+        if match is not None:
+            look_alikes.append(match)
         
-        if args.verbose:
-            print(f"🖼️  Image: {file_path}")
+        def outcome():
+            if journal is not None:
+                record_outcome(journal, result, found[result['path']], failed_paths)
         
-        try:
-            # Parse receipt
-            data = parse_receipt(str(file_path), config)
-            
-            if args.verbose:
-                print(f"📊 Raw extraction: {json.dumps(data, indent=2)}")
-            
-            # Validate
-            warnings = validate_receipt(data, config)
-            if warnings:
-                print(f"  ⚠ Warnings: {', '.join(warnings)}")
-            
-            # Format
-            formatted = format_output(data, config, file_path.name)
-            
-            # Check confidence
-            confidence = formatted.get('confidence', 'medium')
-            threshold_map = {'high': 3, 'medium': 2, 'low': 1}
-            confidence_map = {'high': 3, 'medium': 2, 'low': 1}
-            
-            if confidence_map.get(confidence, 2) < threshold_map.get(args.confidence_threshold, 2):
-                print(f"  ⚠ Low confidence ({confidence}) - review recommended")
-            elif confidence == 'low':
-                print(f"  ⚠ Low confidence - review recommended")
-            else:
-                print(f"  ✓ Confidence: {confidence}")
-            
-            records.append(formatted)
-            
-            print(f"    {formatted.get('vendor', 'Unknown')} - ${formatted.get('total', 0):.2f}")
-            
-        except Exception as e:
-            print(f"  ✗ Error: {e}")
-            continue
+        if result['record'] is not None:
+            # Journalled only once saved, so a crash never marks an unsaved receipt done
+            sink.write(result['record'], on_saved=outcome)
+        else:
+            outcome()
+        if result['error'] is not None:
+            failed.append(result['file_name'])
+            add_dead_letter(result, config)
+    
+    started = time.perf_counter()
+    try:
+        process_files(files, config, concurrency, args.confidence_threshold,
+                      args.verbose, cache, workers, on_result=handle)
+    finally:
+        sink.close()
+        if cache is not None:
+            cache.close()
+    elapsed = time.perf_counter() - started
+    if look_alikes:
+        sink.mark_duplicates(resolve_duplicates(look_alikes, config))
+    metrics.add_timings(sink.stats)
+    processed = sum(metrics.receipts.values())
+    
+    rate = processed / elapsed if elapsed > 0 else 0.0
+    print(f"\n⏱  {processed} file(s) in {elapsed:.1f}s "
+          f"({rate:.2f} receipts/s, concurrency {concurrency})")
+    if cache is not None:
+        print(f"  Cache: {metrics.cache['hit']} hit(s), {metrics.cache['miss']} miss(es)")
+    if metrics.tokens['input'] or metrics.tokens['output']:
+        print(f"  Tokens: {metrics.tokens['input']} in ({metrics.tokens['cached']} cached), "
+              f"{metrics.tokens['output']} out")
+    if metrics.quality_tiers:
+        print("  Image tiers: " + ", ".join(
+            f"{tier} {counts['sent']} sent/{counts['final']} kept"
+            for tier, counts in metrics.quality_tiers.items()))
+    if metrics.routes:
+        print("  Routes: " + ", ".join(
+            f"{tier} {counts['sent']} sent/{counts['final']} kept"
+            for tier, counts in metrics.routes.items()))
+    if metrics.receipts['skipped']:
+        print(f"  ⏭  Skipped: {metrics.receipts['skipped']} copies of files already processed")
+    if metrics.retries:
+        print(f"  🔁 Retries: {metrics.retries}")
+    if failed:
+        print(f"  ✗ Failed: {len(failed)} ({', '.join(failed)})")
+        if (config.get('retry') or {}).get('dead_letter', True):
+            print(f"    Details in {os.path.join(config.get('output_folder', './output'), 'dead_letter.jsonl')}")
     
     # Save output
-    if records:
-        output_path = save_output(records, config)
-        
-        # Summary
-        low_confidence = [r for r in records if r.get('confidence') == 'low']
-        medium_confidence = [r for r in records if r.get('confidence') == 'medium']
-        
-        print(f"\n✓ Done! Processed {len(records)} receipt(s)")
-        print(f"  High confidence: {len(records) - len(low_confidence) - len(medium_confidence)}")
-        if medium_confidence:
-            print(f"  Medium confidence: {len(medium_confidence)} (quick review recommended)")
-        if low_confidence:
-            print(f"  ⚠ Low confidence: {len(low_confidence)} (detailed review needed)")
-            print(f"    Files: {', '.join(r.get('file_name', 'unknown') for r in low_confidence)}")
-        
-        # Play sound if configured (Mac only)
-        if config.get('play_sound', False) and sys.platform == 'darwin':
-            os.system('afplay /System/Library/Sounds/Glass.aiff')
-    else:
-        print("\n✗ No receipts were successfully processed")
-        sys.exit(1)
+    try:
+        if sink.count:
+            output_path = finish_run(sink, config, metrics, sink)
+            if journal is not None:
+                journal.set_output(output_path, run_started_at)
+            # Everything is in the output file (and ledger) now
+            if output_path and not (config.get('stream') or {}).get('keep', False):
+                sink.remove()
+        elif metrics.receipts['skipped'] and not failed:
+            write_run_report(metrics, config)
+            print("\n✓ Nothing new to save (all receipts were duplicates)")
+        else:
+            write_run_report(metrics, config)
+            print("\n✗ No receipts were successfully processed")
+            sys.exit(1)
+    finally:
+        if ledger is not None:
+            ledger.close()
+        if journal is not None:
+            journal.close()
 
 
 if __name__ == '__main__':
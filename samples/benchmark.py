@@ -0,0 +1,796 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the expense parser.
+Results are printed and can be saved as JSON to compare before/after a change.
+
+    python samples/benchmark.py pipeline --sizes 10,100,1000 --latency 0.8
+    python samples/benchmark.py vendors --aliases 10000 --vendors 100000
+    python samples/benchmark.py keywords --keywords 5000
+    python samples/benchmark.py startup --budget-ms 250
+    python samples/benchmark.py clients --requests 500 --concurrency 16
+    python samples/benchmark.py duplicates --hashes 100000
+    python samples/benchmark.py discovery --files 80000
+    python samples/benchmark.py excel --rows 50000
+    python samples/benchmark.py iras --rows 100000
+    python samples/benchmark.py checks --rows 100000
+    python samples/benchmark.py ratelimit --requests 200 --requests-per-minute 2400
+
+The pipeline benchmark generates receipts with generate_samples.py and runs
+them through the real parser against mock_provider.py, so it needs no API
+key and measures our own overhead plus the simulated provider latency.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import shutil
+import statistics
+import string
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+SAMPLES_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(SAMPLES_DIR))
+sys.path.insert(0, SAMPLES_DIR)
+
+import parse_receipt  # noqa: E402
+import generate_samples  # noqa: E402
+import mock_provider  # noqa: E402
+
+
+def receipt_set(workdir: str, count: int, width: int, image_format: str) -> list:
+    """Return ``count`` generated receipts, generating them once per workdir."""
+    folder = os.path.join(workdir, f"receipts_{width}_{image_format}")
+    paths = sorted(Path(folder).glob(f"*.{image_format}")) if os.path.isdir(folder) else []
+    if len(paths) < count:
+        generate_samples.generate_random_receipts(folder, count, width, image_format)
+        paths = sorted(Path(folder).glob(f"*.{image_format}"))
+    return paths[:count]
+
+
+def bench_pipeline(sizes: list, width: int = 1200, image_format: str = 'jpg',
+                   provider: str = 'openai', latency: float = 0.5, jitter: float = 0.1,
+                   error_rate: float = 0.0, concurrency: int = 8,
+                   workdir: str = None, image_quality: str = 'medium',
+                   unsure_rate: float = 0.0) -> dict:
+    """Run generated receipts end to end against the mock provider."""
+    workdir = workdir or os.path.join(tempfile.gettempdir(), 'expense-parser-bench')
+    files = receipt_set(workdir, max(sizes), width, image_format)
+
+    server = mock_provider.serve(0, latency, jitter, error_rate, unsure_rate)
+    port = server.server_address[1]
+    os.environ.setdefault('OPENAI_API_KEY', 'mock')
+    os.environ.setdefault('ANTHROPIC_API_KEY', 'mock')
+
+    config = parse_receipt.load_config(os.path.join(os.path.dirname(SAMPLES_DIR), 'config.yaml'))
+    config.update({
+        'model_provider': provider,
+        'model': 'mock',
+        'api_base_url': f"http://127.0.0.1:{port}" + ('/v1' if provider == 'openai' else ''),
+        'concurrency': concurrency,
+        'image_quality': image_quality,
+        'cache': {'enabled': False},
+        'merge_files': 'false',
+    })
+
+    runs = []
+    try:
+        for size in sizes:
+            config['output_folder'] = tempfile.mkdtemp(prefix='bench-out-', dir=workdir)
+            metrics = parse_receipt.RunMetrics()
+            save_stats = {}
+
+            started = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                results = parse_receipt.process_files(files[:size], config, concurrency)
+                records = [r['record'] for r in results if r['record'] is not None]
+                ledger = parse_receipt.open_ledger(config)
+                if records:
+                    parse_receipt.save_output(records, config, ledger, save_stats)
+                if ledger is not None:
+                    ledger.close()
+            wall = time.perf_counter() - started
+
+            for result in results:
+                metrics.add_result(result)
+            metrics.add_timings(save_stats)
+            report = metrics.summary()
+
+            runs.append({
+                "receipts": size,
+                "wall_seconds": round(wall, 3),
+                "receipts_per_second": round(size / wall, 2),
+                "errors": report['receipts']['error'],
+                "bytes": report['bytes'],
+                "tokens": report['tokens'],
+                "quality_tiers": report['quality_tiers'],
+                "stages": report['stages'],
+            })
+    finally:
+        server.shutdown()
+
+    return {
+        "benchmark": "pipeline",
+        "provider": provider,
+        "width": width,
+        "format": image_format,
+        "latency": latency,
+        "jitter": jitter,
+        "error_rate": error_rate,
+        "unsure_rate": unsure_rate,
+        "image_quality": image_quality,
+        "concurrency": concurrency,
+        "runs": runs,
+    }
+
+
+def bench_clients(requests: int = 500, concurrency: int = 16, provider: str = 'openai',
+                  latency: float = 0.02) -> dict:
+    """Compare a new SDK client per call with the shared, pooled client."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    server = mock_provider.serve(0, latency)
+    port = server.server_address[1]
+    config = {
+        'api_base_url': f"http://127.0.0.1:{port}" + ('/v1' if provider == 'openai' else ''),
+        'timeout': 30,
+        'http': {'max_connections': concurrency},
+    }
+    # A tiny request, so the per-call client cost is not hidden by image encoding
+    request = {'model': 'mock', 'max_tokens': 16, 'messages': [{'role': 'user', 'content': 'ping'}]}
+
+    def call(client):
+        if provider == 'openai':
+            client.chat.completions.create(**request)
+        else:
+            client.messages.create(**request)
+
+    def fresh(_):
+        client = parse_receipt.make_client(provider, config, 'mock')
+        try:
+            call(client)
+        finally:
+            client.close()
+
+    def shared(_):
+        call(parse_receipt.get_client(provider, config, 'mock'))
+
+    runs = {}
+    try:
+        for name, task in (('client_per_request', fresh), ('shared_client', shared)):
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                list(pool.map(task, range(requests)))
+            wall = time.perf_counter() - started
+            runs[name] = {
+                "wall_seconds": round(wall, 3),
+                "requests_per_second": round(requests / wall, 1),
+                "overhead_ms_per_request": round((wall * concurrency / requests - latency) * 1000, 2),
+            }
+    finally:
+        parse_receipt.close_clients()
+        server.shutdown()
+
+    return {
+        "benchmark": "clients",
+        "provider": provider,
+        "requests": requests,
+        "concurrency": concurrency,
+        "latency": latency,
+        **runs,
+    }
+
+
+def random_name(rng: random.Random) -> str:
+    """Make up a vendor name of one to three words."""
+    words = []
+    for _ in range(rng.randint(1, 3)):
+        words.append(''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(3, 9))))
+    return ' '.join(words).title()
+
+
+def add_noise(rng: random.Random, name: str) -> str:
+    """Imitate receipt/OCR variation: case, store numbers, one wrong letter."""
+    kind = rng.random()
+    if kind < 0.25:
+        return name.upper()
+    if kind < 0.5:
+        return f"{name} #{rng.randint(1, 999)}"
+    if kind < 0.75:
+        i = rng.randrange(len(name))
+        return name[:i] + rng.choice(string.ascii_lowercase) + name[i + 1:]
+    return f"{name} {random_name(rng)}"
+
+
+def bench_vendors(aliases: int, vendors: int, seed: int = 42) -> dict:
+    """Time building the vendor index and matching vendor names against it."""
+    rng = random.Random(seed)
+    canonical = [random_name(rng) for _ in range(max(1, aliases // 3))]
+    alias_table = {}
+    while len(alias_table) < aliases:
+        alias_table[random_name(rng)] = rng.choice(canonical)
+    known = list(alias_table) + canonical
+
+    # Half known names with noise, a quarter exact, a quarter unknown
+    queries = []
+    for _ in range(vendors):
+        kind = rng.random()
+        if kind < 0.5:
+            queries.append(add_noise(rng, rng.choice(known)))
+        elif kind < 0.75:
+            queries.append(rng.choice(known))
+        else:
+            queries.append(random_name(rng))
+
+    started = time.perf_counter()
+    index = parse_receipt.VendorIndex(alias_table)
+    build_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    matched = sum(1 for q in queries if index.match(q)[1] is not None)
+    match_seconds = time.perf_counter() - started
+
+    return {
+        "benchmark": "vendors",
+        "aliases": aliases,
+        "vendors": vendors,
+        "build_seconds": round(build_seconds, 4),
+        "match_seconds": round(match_seconds, 4),
+        "matches_per_second": round(vendors / match_seconds, 1) if match_seconds else None,
+        "matched": matched,
+    }
+
+
+def bench_keywords(keywords: int, texts: int, seed: int = 42) -> dict:
+    """Time classifying OCR-sized texts with a large category_keywords table."""
+    rng = random.Random(seed)
+    categories = [f"Category {i}" for i in range(12)]
+    category_keywords = {cat: [] for cat in categories}
+    for _ in range(keywords):
+        category_keywords[rng.choice(categories)].append(random_name(rng).lower())
+    vocabulary = [kw for kws in category_keywords.values() for kw in kws]
+
+    # ~40 lines of receipt-like text, a few known keywords in each
+    samples = []
+    for _ in range(texts):
+        lines = [random_name(rng) + f" {rng.randint(1, 99)}.{rng.randint(0, 99):02d}" for _ in range(40)]
+        for _ in range(3):
+            lines[rng.randrange(40)] += " " + rng.choice(vocabulary)
+        samples.append("\n".join(lines))
+
+    started = time.perf_counter()
+    classifier = parse_receipt.KeywordClassifier(category_keywords)
+    build_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for text in samples:
+        classifier.classify(text)
+    classify_seconds = time.perf_counter() - started
+
+    return {
+        "benchmark": "keywords",
+        "keywords": keywords,
+        "texts": texts,
+        "build_seconds": round(build_seconds, 4),
+        "classify_seconds": round(classify_seconds, 4),
+        "ms_per_text": round(classify_seconds / texts * 1000, 3),
+    }
+
+
+def bench_duplicates(hashes: int, lookups: int = 10000, max_distance: int = 4,
+                     seed: int = 42, adds: int = 1000) -> dict:
+    """Time near-duplicate lookups, adds and discards on an index of ``hashes`` stored images."""
+    rng = random.Random(seed)
+    values = [rng.getrandbits(64) for _ in range(hashes)]
+    folder = tempfile.mkdtemp(prefix='bench-dup-')
+    path = os.path.join(folder, 'duplicates.sqlite')
+
+    # Fill the database directly; building the index is part of opening it
+    index = parse_receipt.DuplicateIndex(path, max_distance)
+    index._conn.executemany(
+        "INSERT INTO image_hashes (dhash, content_hash, file_name, added_at) VALUES (?, ?, ?, ?)",
+        ((f"{value:016x}", f"hash{i}", f"receipt{i}.jpg", '2025-01-01 00:00:00')
+         for i, value in enumerate(values)))
+    index._conn.commit()
+    index.close()
+
+    started = time.perf_counter()
+    index = parse_receipt.DuplicateIndex(path, max_distance)
+    load_seconds = time.perf_counter() - started
+
+    # Half near copies of stored images (a few bits flipped), half new images
+    queries = []
+    for _ in range(lookups):
+        value = rng.choice(values)
+        if rng.random() < 0.5:
+            for bit in rng.sample(range(64), rng.randint(0, max_distance)):
+                value ^= 1 << bit
+        else:
+            value = rng.getrandbits(64)
+        queries.append(value)
+
+    times = []
+    found = 0
+    for value in queries:
+        started = time.perf_counter()
+        found += index.find(value) is not None
+        times.append((time.perf_counter() - started) * 1000)
+
+    # As in a run: each new image is looked up and stored, failed ones forgotten
+    add_times, discard_times = [], []
+    for i, value in enumerate(queries[:adds]):
+        started = time.perf_counter()
+        index.check_and_add(value, f"new{i}", f"new{i}.jpg")
+        add_times.append((time.perf_counter() - started) * 1000)
+    for i in range(min(adds, len(queries))):
+        started = time.perf_counter()
+        index.discard(f"new{i}")
+        discard_times.append((time.perf_counter() - started) * 1000)
+    index.close()
+
+    times.sort()
+    add_times.sort()
+    discard_times.sort()
+    return {
+        "benchmark": "duplicates",
+        "hashes": hashes,
+        "lookups": lookups,
+        "max_distance": max_distance,
+        "load_seconds": round(load_seconds, 3),
+        "lookup_ms_mean": round(statistics.mean(times), 4),
+        "lookup_ms_p99": round(times[int(len(times) * 0.99)], 4),
+        "found": found,
+        "adds": len(add_times),
+        "add_ms_mean": round(statistics.mean(add_times), 4) if add_times else None,
+        "add_ms_p99": round(add_times[int(len(add_times) * 0.99)], 4) if add_times else None,
+        "discard_ms_mean": round(statistics.mean(discard_times), 4) if discard_times else None,
+        "discard_ms_p99": (round(discard_times[int(len(discard_times) * 0.99)], 4)
+                           if discard_times else None),
+    }
+
+
+def bench_discovery(files: int, per_folder: int = 1000) -> dict:
+    """Time finding receipts in a big archive and deciding which need processing."""
+    root = tempfile.mkdtemp(prefix='bench-archive-')
+    for i in range(files):
+        folder = os.path.join(root, f"{i // per_folder:04d}")
+        if i % per_folder == 0:
+            os.makedirs(folder)
+        with open(os.path.join(folder, f"receipt-{i:06d}.jpg"), 'wb') as f:
+            f.write(i.to_bytes(4, 'big'))
+
+    # What the parser did before: one glob per extension and letter case
+    started = time.perf_counter()
+    found = set()
+    for ext in ['*.jpg', '*.jpeg', '*.png', '*.pdf']:
+        found.update(Path(root).rglob(ext))
+        found.update(Path(root).rglob(ext.upper()))
+    glob_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    scanned = parse_receipt.scan_receipts(root, recursive=True)
+    scan_seconds = time.perf_counter() - started
+
+    journal = parse_receipt.Journal(os.path.join(root, 'journal.sqlite'))
+    with journal._lock:
+        journal._conn.executemany(
+            "INSERT INTO files (path, size, mtime, content_hash, outcome, processed_at)"
+            " VALUES (?, ?, ?, ?, 'ok', '2025-01-01 00:00:00')",
+            ((path, size, mtime, None) for path, (size, mtime) in scanned.items()))
+        journal._conn.commit()
+    started = time.perf_counter()
+    todo, counts = journal.plan(scanned)
+    plan_seconds = time.perf_counter() - started
+    journal.close()
+    shutil.rmtree(root)
+
+    return {
+        "benchmark": "discovery",
+        "files": files,
+        "glob_seconds": round(glob_seconds, 3),
+        "scan_seconds": round(scan_seconds, 3),
+        "plan_seconds": round(plan_seconds, 3),
+        "to_process": len(todo),
+        "found": len(found) == len(scanned) == files,
+    }
+
+
+def sample_records(count: int, seed: int = 42):
+    """Yield ``count`` formatted receipts, like the ledger would."""
+    rng = random.Random(seed)
+    for i in range(count):
+        subtotal = round(rng.uniform(2, 300), 2)
+        tax = round(subtotal * 0.09, 2)
+        yield {
+            "date": f"{rng.randint(1, 28):02d}/{rng.randint(1, 12):02d}/2025",
+            "vendor": random_name(rng), "category": "Meals & Entertainment",
+            "description": "Lunch", "subtotal": subtotal, "tax": tax,
+            "total": round(subtotal + tax, 2), "currency": "SGD", "payment_method": "Visa",
+            "receipt_number": f"R{i:08d}", "items_count": 3, "confidence": "high",
+            "file_name": f"receipt-{i:06d}.jpg", "processed_at": "2025-06-01 12:00:00",
+            "content_hash": f"{i:064x}",
+        }
+
+
+def bench_excel(rows: int, memory: bool = False) -> dict:
+    """Time (and with ``memory``, peak memory) of writing a big workbook.
+
+    Memory is measured with tracemalloc in a second, much slower pass.
+    """
+    import pandas as pd
+
+    folder = tempfile.mkdtemp(prefix='bench-excel-')
+    config = parse_receipt.load_config(os.path.join(os.path.dirname(SAMPLES_DIR), 'config.yaml'))
+    columns = config.get('output_columns', [])
+
+    def measure(write):
+        started = time.perf_counter()
+        write()
+        seconds = time.perf_counter() - started
+        if not memory:
+            return round(seconds, 2), None
+        tracemalloc.start()
+        write()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return round(seconds, 2), round(peak / 1e6, 1)
+
+    def pandas_export():
+        # What write_export() did before: whole DataFrame, then a width scan per column
+        df = pd.DataFrame(list(sample_records(rows)))[columns]
+        with pd.ExcelWriter(os.path.join(folder, 'pandas.xlsx'), engine='xlsxwriter') as writer:
+            df.to_excel(writer, sheet_name='Expenses', index=False)
+            worksheet = writer.sheets['Expenses']
+            for i, col in enumerate(df.columns):
+                max_len = max(df[col].fillna('').astype(str).map(len).max(), len(col)) + 2
+                worksheet.set_column(i, i, min(max_len, 50))
+
+    def streaming_export():
+        parse_receipt.write_excel(sample_records(rows), columns,
+                                  os.path.join(folder, 'streamed.xlsx'), sidecar=True)
+
+    pandas_seconds, pandas_mb = measure(pandas_export)
+    streaming_seconds, streaming_mb = measure(streaming_export)
+
+    # Merging new receipts into the file: re-reading it vs the sidecar rows
+    started = time.perf_counter()
+    pd.read_excel(os.path.join(folder, 'pandas.xlsx'), sheet_name='Expenses')
+    read_excel_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    parse_receipt.merge_existing_output([], {'output_format': 'excel'},
+                                        os.path.join(folder, 'streamed.xlsx'), 'daily')
+    sidecar_seconds = time.perf_counter() - started
+    shutil.rmtree(folder)
+
+    return {
+        "benchmark": "excel",
+        "rows": rows,
+        "pandas_seconds": pandas_seconds,
+        "pandas_peak_mb": pandas_mb,
+        "streaming_seconds": streaming_seconds,
+        "streaming_peak_mb": streaming_mb,
+        "merge_read_excel_seconds": round(read_excel_seconds, 2),
+        "merge_sidecar_seconds": round(sidecar_seconds, 2),
+    }
+
+
+def bench_iras(rows: int) -> dict:
+    """Time the IRAS GST export over a year of receipts, and a quarter from the ledger."""
+    import pandas as pd
+
+    config = parse_receipt.load_config(os.path.join(os.path.dirname(SAMPLES_DIR), 'config.yaml'))
+    iras_config = config.get('iras_export', {})
+    categories = list(iras_config.get('category_gst_codes', {})) + ['Software']
+    rng = random.Random(7)
+    records = []
+    for record in sample_records(rows):
+        record['category'] = rng.choice(categories)
+        records.append(record)
+
+    # What save_iras_export() did before: one dict per record in a Python loop
+    started = time.perf_counter()
+    iras_records = []
+    for record in records:
+        gst_code = iras_config.get('category_gst_codes', {}).get(
+            record.get('category', 'Others'), iras_config.get('default_gst_code', 'TX'))
+        tax = 0 if gst_code in ['ZP', 'OS'] else record.get('tax', 0)
+        iras_records.append({
+            'Date': record.get('date', ''), 'Supplier Name': record.get('vendor', ''),
+            'Supplier GST Reg No': '', 'Description': record.get('description', ''),
+            'Value Excl GST': record.get('subtotal', 0) or record.get('total', 0),
+            'GST Amount': tax, 'Total Amount': record.get('total', 0), 'GST Code': gst_code,
+            'Receipt Reference': record.get('receipt_number', ''),
+        })
+    pd.DataFrame(iras_records)
+    loop_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    summary = parse_receipt.f5_summary(parse_receipt.iras_frame(records, config))
+    vectorised_seconds = time.perf_counter() - started
+
+    # A quarter straight from the ledger's date index vs the whole ledger
+    folder = tempfile.mkdtemp(prefix='bench-iras-')
+    ledger = parse_receipt.Ledger(os.path.join(folder, 'ledger.sqlite'))
+    ledger.upsert(records)
+    started = time.perf_counter()
+    everything = ledger.fetch()
+    fetch_all_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    quarter = ledger.fetch_dated(*parse_receipt.quarter_range('2025-Q1'))
+    fetch_quarter_seconds = time.perf_counter() - started
+    ledger.close()
+    shutil.rmtree(folder)
+
+    return {
+        "benchmark": "iras",
+        "rows": rows,
+        "loop_seconds": round(loop_seconds, 3),
+        "vectorised_with_f5_seconds": round(vectorised_seconds, 3),
+        "summary_rows": len(summary),
+        "ledger_fetch_all_seconds": round(fetch_all_seconds, 3),
+        "ledger_fetch_quarter_seconds": round(fetch_quarter_seconds, 3),
+        "quarter_receipts": f"{len(quarter)} of {len(everything)}",
+    }
+
+
+def bench_checks(rows: int) -> dict:
+    """Time validating a big run one receipt at a time vs with validate_batch()."""
+    config = parse_receipt.load_config(os.path.join(os.path.dirname(SAMPLES_DIR), 'config.yaml'))
+    rng = random.Random(11)
+    records = []
+    for record in sample_records(rows):
+        if records and rng.random() < 0.01:
+            # The same receipt again, from another file, for the duplicate check
+            earlier = rng.choice(records)
+            record.update({key: earlier[key] for key in ('vendor', 'date', 'subtotal', 'tax', 'total',
+                                                         'receipt_number')})
+        record['items'] = [{"description": "Item", "amount": round(record['subtotal'] / 2, 2)}] * 2
+        records.append(record)
+
+    # Per receipt, as finish_record() and the routing rules check them
+    started = time.perf_counter()
+    for record in records:
+        parse_receipt.validate_receipt(record, config)
+        parse_receipt.check_arithmetic(record)
+    per_record_seconds = time.perf_counter() - started
+
+    # Warm up first, so pandas is loaded as it is after a run's export
+    parse_receipt.validate_batch(records[:10], config)
+    started = time.perf_counter()
+    checks = parse_receipt.validate_batch(records, config)
+    batch_seconds = time.perf_counter() - started
+
+    return {
+        "benchmark": "checks",
+        "rows": rows,
+        "per_record_seconds": round(per_record_seconds, 3),
+        "batch_seconds": round(batch_seconds, 3),
+        "flagged": {check: int(count) for check, count in checks.sum().items() if count},
+    }
+
+
+def bench_ratelimit(requests: int = 200, concurrency: int = 16, requests_per_minute: float = 2400,
+                    latency: float = 0.05, provider: str = 'openai') -> dict:
+    """Send receipts faster than a mock provider's rate limit allows.
+
+    Compares no retries, retries alone (429s and backoff) and retries with
+    the client-side rate limiter set to the provider's limit.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    server = mock_provider.serve(0, latency)
+    port = server.server_address[1]
+    base_config = {
+        'model_provider': provider,
+        'api_base_url': f"http://127.0.0.1:{port}" + ('/v1' if provider == 'openai' else ''),
+        'timeout': 30,
+        'http': {'max_connections': concurrency},
+        'retry': {'backoff_seconds': 0.5, 'max_backoff_seconds': 5},
+    }
+    modes = {
+        'no_retries': dict(base_config, max_retries=0),
+        'retries': dict(base_config, max_retries=8),
+        'retries_and_rate_limit': dict(base_config, max_retries=8, rate_limits={
+            provider: {'requests_per_minute': requests_per_minute}}),
+    }
+    parse = parse_receipt.parse_with_openai if provider == 'openai' else parse_receipt.parse_with_anthropic
+    text = "STARBUCKS\nLatte 6.50\nTotal 17.99"
+
+    runs = {}
+    try:
+        for name, config in modes.items():
+            mock_provider.configure(latency, requests_per_minute=requests_per_minute)
+            parse_receipt._rate_limiters.clear()
+            stats = [{} for _ in range(requests)]
+
+            def call(i):
+                try:
+                    parse(None, config, 'mock', stats=stats[i], text=text)
+                    return True
+                except Exception:
+                    return False
+
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                ok = sum(pool.map(call, range(requests)))
+            wall = time.perf_counter() - started
+            runs[name] = {
+                "wall_seconds": round(wall, 2),
+                "succeeded": ok,
+                "failed": requests - ok,
+                "http_429s": mock_provider.MockHandler.state.throttled,
+                "retries": sum(s.get('retries', 0) for s in stats),
+                "rate_limit_wait_seconds": round(sum(
+                    s.get('timings', {}).get('rate_limit', 0) for s in stats), 1),
+            }
+    finally:
+        parse_receipt.close_clients()
+        server.shutdown()
+
+    return {
+        "benchmark": "ratelimit",
+        "provider": provider,
+        "requests": requests,
+        "concurrency": concurrency,
+        "requests_per_minute": requests_per_minute,
+        "best_possible_seconds": round(requests / (requests_per_minute / 60), 2),
+        **runs,
+    }
+
+
+# Libraries that must not be imported just by starting the CLI
+HEAVY_MODULES = ['yaml', 'pandas', 'PIL', 'pytesseract', 'openai', 'anthropic', 'dotenv',
+                 'multiprocessing']
+
+
+def bench_startup(runs: int = 10, budget_ms: float = 250.0) -> dict:
+    """Time fresh interpreters running ``--help`` and a bare import of the parser."""
+    root = os.path.dirname(SAMPLES_DIR)
+    script = os.path.join(root, 'parse_receipt.py')
+    check = ("import sys, json, parse_receipt; "
+             f"print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))")
+
+    def time_command(cmd: list) -> list:
+        times = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            subprocess.run(cmd, cwd=root, check=True, stdout=subprocess.DEVNULL)
+            times.append((time.perf_counter() - started) * 1000)
+        return times
+
+    baseline = time_command([sys.executable, '-c', 'pass'])
+    help_times = time_command([sys.executable, script, '--help'])
+    import_times = time_command([sys.executable, '-c', 'import parse_receipt'])
+    loaded = json.loads(subprocess.run([sys.executable, '-c', check], cwd=root, check=True,
+                                       capture_output=True, text=True).stdout)
+
+    help_ms = statistics.median(help_times)
+    return {
+        "benchmark": "startup",
+        "runs": runs,
+        "interpreter_ms": round(statistics.median(baseline), 1),
+        "help_ms": round(help_ms, 1),
+        "import_ms": round(statistics.median(import_times), 1),
+        "heavy_modules_loaded": loaded,
+        "budget_ms": budget_ms,
+        "within_budget": help_ms <= budget_ms and not loaded,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run expense parser benchmarks')
+    parser.add_argument('--json', help='Also write results to this JSON file')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    pipeline = subparsers.add_parser('pipeline', help='End-to-end throughput and per-stage latency')
+    pipeline.add_argument('--sizes', default='10,100,1000',
+                          help='Comma-separated receipt counts to run (default: 10,100,1000)')
+    pipeline.add_argument('--width', type=int, default=1200, help='Receipt width in pixels')
+    pipeline.add_argument('--format', choices=['jpg', 'png'], default='jpg')
+    pipeline.add_argument('--provider', choices=['openai', 'anthropic'], default='openai')
+    pipeline.add_argument('--latency', type=float, default=0.5,
+                          help='Simulated provider latency in seconds (default: 0.5)')
+    pipeline.add_argument('--jitter', type=float, default=0.1)
+    pipeline.add_argument('--error-rate', type=float, default=0.0)
+    pipeline.add_argument('--unsure-rate', type=float, default=0.0,
+                          help='Fraction of mock answers with low confidence (default: 0)')
+    pipeline.add_argument('--image-quality', choices=['low', 'medium', 'high', 'adaptive'],
+                          default='medium')
+    pipeline.add_argument('--concurrency', type=int, default=8)
+    pipeline.add_argument('--workdir', help='Where generated receipts are kept between runs')
+
+    vendors = subparsers.add_parser('vendors', help='Vendor alias matching')
+    vendors.add_argument('--aliases', type=int, default=10000)
+    vendors.add_argument('--vendors', type=int, default=100000)
+
+    keywords = subparsers.add_parser('keywords', help='Local OCR category classification')
+    keywords.add_argument('--keywords', type=int, default=5000)
+    keywords.add_argument('--texts', type=int, default=1000)
+
+    startup = subparsers.add_parser('startup', help='CLI start-up time and eagerly loaded libraries')
+    startup.add_argument('--runs', type=int, default=10)
+    startup.add_argument('--budget-ms', type=float, default=250.0,
+                         help='Fail if `parse_receipt.py --help` takes longer (default: 250)')
+
+    clients = subparsers.add_parser('clients', help='New SDK client per call vs the shared pooled client')
+    clients.add_argument('--requests', type=int, default=500)
+    clients.add_argument('--concurrency', type=int, default=16)
+    clients.add_argument('--provider', choices=['openai', 'anthropic'], default='openai')
+    clients.add_argument('--latency', type=float, default=0.02,
+                         help='Simulated provider latency in seconds (default: 0.02)')
+
+    duplicates = subparsers.add_parser('duplicates', help='Near-duplicate image lookups')
+    duplicates.add_argument('--hashes', type=int, default=100000,
+                            help='Images already in the index (default: 100000)')
+    duplicates.add_argument('--lookups', type=int, default=10000)
+    duplicates.add_argument('--max-distance', type=int, default=4)
+    duplicates.add_argument('--adds', type=int, default=1000,
+                            help='images to add with check_and_add, then discard')
+
+    discovery = subparsers.add_parser('discovery', help='Scanning an archive and skipping done files')
+    discovery.add_argument('--files', type=int, default=80000)
+
+    excel = subparsers.add_parser('excel', help='Writing and merging a big Excel workbook')
+    excel.add_argument('--rows', type=int, default=50000)
+    excel.add_argument('--memory', action='store_true',
+                       help='Also measure peak memory (slow)')
+
+    iras = subparsers.add_parser('iras', help='IRAS GST export and F5 summary')
+    iras.add_argument('--rows', type=int, default=100000)
+
+    checks = subparsers.add_parser('checks', help='Batch validation checks')
+    checks.add_argument('--rows', type=int, default=100000)
+
+    ratelimit = subparsers.add_parser('ratelimit', help='Rate limits, 429s and retries')
+    ratelimit.add_argument('--requests', type=int, default=200)
+    ratelimit.add_argument('--concurrency', type=int, default=16)
+    ratelimit.add_argument('--requests-per-minute', type=float, default=2400)
+    ratelimit.add_argument('--latency', type=float, default=0.05)
+    ratelimit.add_argument('--provider', choices=['openai', 'anthropic'], default='openai')
+
+    args = parser.parse_args()
+
+    if args.benchmark == 'pipeline':
+        sizes = [int(n) for n in args.sizes.split(',')]
+        results = bench_pipeline(sizes, args.width, args.format, args.provider, args.latency,
+                                 args.jitter, args.error_rate, args.concurrency, args.workdir,
+                                 args.image_quality, args.unsure_rate)
+    elif args.benchmark == 'vendors':
+        results = bench_vendors(args.aliases, args.vendors)
+    elif args.benchmark == 'keywords':
+        results = bench_keywords(args.keywords, args.texts)
+    elif args.benchmark == 'startup':
+        results = bench_startup(args.runs, args.budget_ms)
+    elif args.benchmark == 'clients':
+        results = bench_clients(args.requests, args.concurrency, args.provider, args.latency)
+    elif args.benchmark == 'duplicates':
+        results = bench_duplicates(args.hashes, args.lookups, args.max_distance, adds=args.adds)
+    elif args.benchmark == 'discovery':
+        results = bench_discovery(args.files)
+    elif args.benchmark == 'excel':
+        results = bench_excel(args.rows, args.memory)
+    elif args.benchmark == 'iras':
+        results = bench_iras(args.rows)
+    elif args.benchmark == 'checks':
+        results = bench_checks(args.rows)
+    elif args.benchmark == 'ratelimit':
+        results = bench_ratelimit(args.requests, args.concurrency, args.requests_per_minute,
+                                  args.latency, args.provider)
+
+    print(json.dumps(results, indent=2))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if results.get('within_budget') is False:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
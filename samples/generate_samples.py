@@ -5,7 +5,10 @@ Run this to create sample receipts in the samples/ folder.
 """
 
 from PIL import Image, ImageDraw, ImageFont
+import argparse
+import json
 import os
+import random
 
 def create_receipt_starbucks():
     """Create a clean Starbucks receipt."""
@@ -274,8 +277,135 @@ def create_receipt_grab():
     return img
 
 
+# Vendors for random receipts: (name, category, payment methods, items)
+RANDOM_VENDORS = [
+    ("STARBUCKS", "Meals & Entertainment", ["Visa", "Mastercard", "Cash"],
+     ["Venti Latte", "Butter Croissant", "Iced Americano", "Chicken Pie", "Green Tea Frappe"]),
+    ("NTUC FAIRPRICE", "Others", ["PayLah!", "NETS", "Cash"],
+     ["Fresh Milk 2L", "Gardenia Bread", "Eggs (10pcs)", "Rice 5kg", "Cooking Oil 1L"]),
+    ("POPULAR BOOKSTORE", "Office Supplies", ["Visa", "NETS"],
+     ["A4 Paper 500s", "Ballpoint Pen (3)", "Notebook A5", "Printer Ink Black", "Stapler"]),
+    ("GRAB", "Transport", ["GrabPay"],
+     ["Base Fare", "Distance", "Time", "Peak Hour Surcharge", "Booking Fee"]),
+    ("COMFORTDELGRO", "Transport", ["Cash", "Visa"],
+     ["Metered Fare", "Booking Fee", "ERP Charges", "Midnight Surcharge"]),
+    ("TOAST BOX", "Meals & Entertainment", ["Cash", "NETS", "Visa"],
+     ["Kaya Toast Set", "Laksa", "Teh C", "Kopi O", "Mee Siam"]),
+]
+
+
+def create_random_receipt(rng: random.Random, width: int = 400, tax_rate: float = 0.09):
+    """Create a randomised receipt; return (image, ground-truth data)."""
+    vendor, category, payments, catalogue = rng.choice(RANDOM_VENDORS)
+    items = [
+        {"description": name, "amount": round(rng.uniform(1.5, 30), 2)}
+        for name in rng.sample(catalogue, rng.randint(1, len(catalogue)))
+    ]
+    subtotal = round(sum(item["amount"] for item in items), 2)
+    tax = round(subtotal * tax_rate, 2)
+    truth = {
+        "vendor": vendor,
+        "date": f"{rng.randint(1, 28):02d}/{rng.randint(1, 12):02d}/2025",
+        "category": category,
+        "items": items,
+        "subtotal": subtotal,
+        "tax": tax,
+        "total": round(subtotal + tax, 2),
+        "currency": "SGD",
+        "payment_method": rng.choice(payments),
+        "receipt_number": f"{vendor[:2]}{rng.randint(10**8, 10**9 - 1)}",
+        "confidence": "high",
+    }
+    
+    # Draw at the usual 400px width, then scale to the requested resolution
+    img = Image.new('RGB', (400, 260 + 22 * len(items)), color='white')
+    draw = ImageDraw.Draw(img)
+    
+    try:
+        font_large = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", 18)
+        font_medium = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", 14)
+        font_small = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", 12)
+    except:
+        font_large = ImageFont.load_default()
+        font_medium = ImageFont.load_default()
+        font_small = ImageFont.load_default()
+    
+    y = 20
+    draw.text((200, y), vendor, fill='black', font=font_large, anchor="mm")
+    y += 30
+    draw.line([(20, y), (380, y)], fill='black', width=1)
+    y += 15
+    draw.text((20, y), f"Date: {truth['date']}", fill='black', font=font_small)
+    y += 20
+    draw.text((20, y), f"Receipt: {truth['receipt_number']}", fill='black', font=font_small)
+    y += 25
+    draw.line([(20, y), (380, y)], fill='black', width=1)
+    y += 15
+    
+    for item in items:
+        draw.text((20, y), item["description"], fill='black', font=font_medium)
+        draw.text((380, y), f"${item['amount']:.2f}", fill='black', font=font_medium, anchor="rm")
+        y += 22
+    
+    y += 5
+    draw.line([(20, y), (380, y)], fill='black', width=1)
+    y += 15
+    draw.text((20, y), "Subtotal:", fill='black', font=font_small)
+    draw.text((380, y), f"${subtotal:.2f}", fill='black', font=font_small, anchor="rm")
+    y += 20
+    draw.text((20, y), f"GST ({tax_rate:.0%}):", fill='black', font=font_small)
+    draw.text((380, y), f"${tax:.2f}", fill='black', font=font_small, anchor="rm")
+    y += 25
+    draw.text((20, y), "TOTAL:", fill='black', font=font_medium)
+    draw.text((380, y), f"${truth['total']:.2f}", fill='black', font=font_medium, anchor="rm")
+    y += 30
+    draw.text((20, y), f"Payment: {truth['payment_method']}", fill='black', font=font_small)
+    
+    if width != 400:
+        img = img.resize((width, round(img.height * width / 400)), Image.Resampling.LANCZOS)
+    return img, truth
+
+
+def generate_random_receipts(out_dir: str, count: int, width: int = 400,
+                             image_format: str = 'jpg', seed: int = 42):
+    """Write ``count`` random receipts plus a ground-truth JSON file for each."""
+    os.makedirs(out_dir, exist_ok=True)
+    rng = random.Random(seed)
+    pil_format = {'jpg': 'JPEG', 'png': 'PNG'}[image_format]
+    paths = []
+    
+    for i in range(count):
+        img, truth = create_random_receipt(rng, width)
+        path = os.path.join(out_dir, f"receipt-{i:05d}.{image_format}")
+        img.save(path, pil_format, quality=90)
+        with open(os.path.join(out_dir, f"receipt-{i:05d}.json"), 'w') as f:
+            json.dump(truth, f, indent=2)
+        paths.append(path)
+    
+    return paths
+
+
 def main():
-    """Generate all sample receipts."""
+    """Generate all sample receipts (or a random set with --count)."""
+    parser = argparse.ArgumentParser(description='Generate sample receipt images')
+    parser.add_argument('--count', type=int, default=0,
+                        help='Generate this many random receipts instead of the 3 samples')
+    parser.add_argument('--width', type=int, default=400,
+                        help='Width in pixels of random receipts (default: 400)')
+    parser.add_argument('--format', choices=['jpg', 'png'], default='jpg',
+                        help='Image format of random receipts (default: jpg)')
+    parser.add_argument('--out', default='generated',
+                        help='Folder for random receipts (default: generated/)')
+    parser.add_argument('--seed', type=int, default=42,
+                        help='Random seed, so the same set can be regenerated')
+    args = parser.parse_args()
+    
+    if args.count:
+        print(f"Generating {args.count} random receipts ({args.width}px {args.format})...")
+        generate_random_receipts(args.out, args.count, args.width, args.format, args.seed)
+        print(f"Done! Receipts and ground-truth .json files are in {args.out}/")
+        return
+    
     samples_dir = os.path.dirname(os.path.abspath(__file__))
     
     print("Generating sample receipts...")
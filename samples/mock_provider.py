@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the OpenAI and Anthropic APIs.
+Lets you try the expense parser (including --batch-api) without an API key
+or network access, and benchmark it with realistic provider latency and
+failures. Every receipt "parses" to the same sample answer.
+
+Run it, then point config.yaml at it:
+
+    python samples/mock_provider.py --port 8765
+    # config.yaml:  api_base_url: http://127.0.0.1:8765/v1
+"""
+
+import argparse
+import json
+import math
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SAMPLE_RECEIPT = {
+    "vendor": "STARBUCKS",
+    "date": "18/02/2025",
+    "category": "Meals & Entertainment",
+    "items": [
+        {"description": "Venti Latte", "amount": 6.50},
+        {"description": "Butter Croissant", "amount": 4.20},
+        {"description": "Iced Americano", "amount": 5.80},
+    ],
+    "subtotal": 16.50,
+    "tax": 1.49,
+    "total": 17.99,
+    "currency": "SGD",
+    "payment_method": "Visa",
+    "receipt_number": "SB250218001",
+    "confidence": "high",
+}
+
+
+# The same answer with the short keys the parser's receipt schema asks for
+SHORT_RECEIPT = {
+    "v": "STARBUCKS", "d": "18/02/2025", "c": "Meals & Entertainment",
+    "i": [{"d": "Venti Latte", "a": 6.50}, {"d": "Butter Croissant", "a": 4.20},
+          {"d": "Iced Americano", "a": 5.80}],
+    "st": 16.50, "tx": 1.49, "t": 17.99, "cur": "SGD", "pm": "Visa",
+    "no": "SB250218001", "cf": "high",
+}
+
+
+def count_tokens(value) -> int:
+    """Very rough token count: about four characters per token, images ~765."""
+    text = json.dumps(value)
+    images = text.count('"image_url"') + text.count('"type": "image"')
+    for key in ('"url": "data:', '"data": "'):
+        # Don't count base64 image data as text
+        while key in text:
+            start = text.index(key)
+            end = text.index('"', start + len(key))
+            text = text[:start] + text[end:]
+    return len(text) // 4 + images * 765
+
+
+def reply_for(request: dict, unsure: bool = False) -> str:
+    """Answer in the format the request asked for (schema/tool => short keys).
+
+    An ``unsure`` answer has low confidence, like a blurry or tiny image would.
+    """
+    if request.get('response_format') or request.get('tools'):
+        return json.dumps(dict(SHORT_RECEIPT, cf='low') if unsure else SHORT_RECEIPT)
+    return json.dumps(dict(SAMPLE_RECEIPT, confidence='low') if unsure else SAMPLE_RECEIPT)
+
+
+def openai_completion(reply: str, request: dict = None) -> dict:
+    """Build a chat.completions response body."""
+    prompt_tokens = count_tokens(request) if request else 850
+    return {
+        "id": "chatcmpl-mock",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": "mock",
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": reply},
+            "finish_reason": "stop",
+        }],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": count_tokens(reply),
+                  "total_tokens": prompt_tokens + count_tokens(reply)},
+    }
+
+
+def anthropic_message(reply: str, request: dict = None) -> dict:
+    """Build a messages.create response body (a tool call if tools were given)."""
+    if request and request.get('tools'):
+        content = [{"type": "tool_use", "id": "toolu_mock", "name": request['tools'][0]['name'],
+                    "input": json.loads(reply)}]
+        stop_reason = "tool_use"
+    else:
+        content = [{"type": "text", "text": reply}]
+        stop_reason = "end_turn"
+    return {
+        "id": "msg_mock",
+        "type": "message",
+        "role": "assistant",
+        "model": "mock",
+        "content": content,
+        "stop_reason": stop_reason,
+        "stop_sequence": None,
+        "usage": {"input_tokens": count_tokens(request) if request else 850,
+                  "output_tokens": count_tokens(reply)},
+    }
+
+
+class MockState:
+    """Files and batches 'uploaded' to the mock server, and its rate limit."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = {}
+        self.batches = {}
+        self.counter = 0
+        self.allowance = 0.0
+        self.updated = time.monotonic()
+        self.throttled = 0
+
+    def reset_limit(self, requests_per_minute: float):
+        with self.lock:
+            self.allowance = max(1.0, requests_per_minute / 60)
+            self.updated = time.monotonic()
+            self.throttled = 0
+
+    def wait_for_slot(self, requests_per_minute: float):
+        """Return 0 if a call may go ahead now, else the seconds until it may.
+
+        Allows requests_per_minute / 60 calls each second, like the real
+        APIs enforce their per-minute limits over short windows.
+        """
+        rate = requests_per_minute / 60
+        with self.lock:
+            now = time.monotonic()
+            self.allowance = min(max(1.0, rate), self.allowance + (now - self.updated) * rate)
+            self.updated = now
+            if self.allowance >= 1:
+                self.allowance -= 1
+                return 0.0
+            self.throttled += 1
+            return (1 - self.allowance) / rate
+
+    def new_id(self, prefix: str) -> str:
+        with self.lock:
+            self.counter += 1
+            return f"{prefix}{self.counter}"
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """Answers the subset of provider endpoints the parser uses."""
+
+    # HTTP/1.1 keeps connections open between calls, like the real APIs
+    protocol_version = 'HTTP/1.1'
+    state = MockState()
+    # Simulated provider behaviour for completion calls (set by serve/main)
+    latency = 0.0
+    jitter = 0.0
+    error_rate = 0.0
+    unsure_rate = 0.0
+    requests_per_minute = 0.0
+    throttle_rate = 0.0
+
+    def log_message(self, format, *args):
+        pass  # Keep the console quiet
+
+    def send_json(self, body: dict, status: int = 200):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_text(self, text: str):
+        data = text.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/jsonl')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self) -> bytes:
+        length = int(self.headers.get('Content-Length', 0))
+        return self.rfile.read(length) if length else b''
+
+    def send_rate_limited(self, retry_after: float):
+        """Answer 429 with the retry-after headers the real APIs send."""
+        data = json.dumps({"error": {"type": "rate_limit_error",
+                                     "message": "Simulated rate limit"}}).encode('utf-8')
+        self.send_response(429)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('retry-after', str(max(1, math.ceil(retry_after))))
+        self.send_header('retry-after-ms', str(int(retry_after * 1000)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def simulate(self) -> bool:
+        """Wait like a real provider would; return False if this call should fail."""
+        if self.requests_per_minute:
+            retry_after = self.state.wait_for_slot(self.requests_per_minute)
+            if retry_after:
+                self.send_rate_limited(retry_after)
+                return False
+        if random.random() < self.throttle_rate:
+            with self.state.lock:
+                self.state.throttled += 1
+            self.send_rate_limited(random.uniform(0.05, 0.5))
+            return False
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        if random.random() < self.error_rate:
+            self.send_json({"error": {"type": "server_error", "message": "Simulated failure"}}, 500)
+            return False
+        return True
+
+    def unsure(self) -> bool:
+        return random.random() < self.unsure_rate
+
+    def do_POST(self):
+        body = self.read_body()
+        path = self.path.split('?')[0]
+
+        if path.endswith('/chat/completions'):
+            request = json.loads(body)
+            if self.simulate():
+                self.send_json(openai_completion(reply_for(request, self.unsure()), request))
+            return
+        if path.endswith('/messages'):
+            request = json.loads(body)
+            if self.simulate():
+                self.send_json(anthropic_message(reply_for(request, self.unsure()), request))
+            return
+        if path.endswith('/files'):
+            return self.upload_file(body)
+        if path.endswith('/messages/batches'):
+            return self.create_anthropic_batch(json.loads(body))
+        if path.endswith('/batches'):
+            return self.create_openai_batch(json.loads(body))
+        self.send_json({"error": {"message": f"Unknown endpoint {path}"}}, 404)
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        parts = path.strip('/').split('/')
+
+        if path.endswith('/content') and 'files' in parts:
+            file_id = parts[-2]
+            return self.send_text(self.state.files.get(file_id, ''))
+        if 'messages' in parts and 'batches' in parts:
+            if path.endswith('/results'):
+                return self.send_text(self.state.files.get(parts[-2], ''))
+            return self.send_json(self.state.batches[parts[-1]])
+        if 'batches' in parts:
+            return self.send_json(self.state.batches[parts[-1]])
+        self.send_json({"error": {"message": f"Unknown endpoint {path}"}}, 404)
+
+    # --- OpenAI Batch API -------------------------------------------------
+
+    def upload_file(self, body: bytes):
+        # Pull the JSONL payload out of the multipart form
+        boundary = self.headers['Content-Type'].split('boundary=')[1].encode()
+        content = b''
+        for part in body.split(b'--' + boundary):
+            if b'name="file"' in part:
+                content = part.split(b'\r\n\r\n', 1)[1].rsplit(b'\r\n', 1)[0]
+        file_id = self.state.new_id('file-')
+        self.state.files[file_id] = content.decode('utf-8')
+        self.send_json({"id": file_id, "object": "file", "bytes": len(content),
+                        "created_at": int(time.time()), "filename": "batch.jsonl",
+                        "purpose": "batch", "status": "processed"})
+
+    def create_openai_batch(self, request: dict):
+        lines = []
+        for line in self.state.files[request['input_file_id']].splitlines():
+            if line.strip():
+                item = json.loads(line)
+                custom_id = item['custom_id']
+                lines.append(json.dumps({
+                    "id": f"batch_req_{custom_id}", "custom_id": custom_id,
+                    "response": {"status_code": 200, "request_id": custom_id,
+                                 "body": openai_completion(reply_for(item['body'], self.unsure()), item['body'])},
+                    "error": None,
+                }))
+        output_id = self.state.new_id('file-')
+        self.state.files[output_id] = "\n".join(lines) + "\n"
+        batch_id = self.state.new_id('batch_')
+        self.state.batches[batch_id] = {
+            "id": batch_id, "object": "batch", "endpoint": request['endpoint'],
+            "input_file_id": request['input_file_id'],
+            "completion_window": request['completion_window'],
+            "status": "completed", "output_file_id": output_id, "error_file_id": None,
+            "created_at": int(time.time()),
+            "request_counts": {"total": len(lines), "completed": len(lines), "failed": 0},
+        }
+        self.send_json(self.state.batches[batch_id])
+
+    # --- Anthropic Message Batches ---------------------------------------
+
+    def create_anthropic_batch(self, request: dict):
+        batch_id = self.state.new_id('msgbatch_')
+        lines = [json.dumps({
+            "custom_id": item['custom_id'],
+            "result": {"type": "succeeded",
+                       "message": anthropic_message(reply_for(item['params'], self.unsure()),
+                                                 item['params'])},
+        }) for item in request['requests']]
+        self.state.files[batch_id] = "\n".join(lines) + "\n"
+        host = f"http://{self.headers['Host']}"
+        now = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        self.state.batches[batch_id] = {
+            "id": batch_id, "type": "message_batch", "processing_status": "ended",
+            "request_counts": {"processing": 0, "succeeded": len(lines), "errored": 0,
+                               "canceled": 0, "expired": 0},
+            "created_at": now, "ended_at": now, "expires_at": now,
+            "archived_at": None, "cancel_initiated_at": None,
+            "results_url": f"{host}/v1/messages/batches/{batch_id}/results",
+        }
+        self.send_json(self.state.batches[batch_id])
+
+
+def configure(latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+              unsure_rate: float = 0.0, requests_per_minute: float = 0.0,
+              throttle_rate: float = 0.0):
+    """Set the simulated latency (seconds), failure rate and low-confidence rate.
+
+    With ``requests_per_minute``, calls over that rate get HTTP 429 with a
+    retry-after header; ``throttle_rate`` is a fraction of calls that get a
+    429 anyway. MockHandler.state.throttled counts the 429s sent.
+    """
+    MockHandler.latency = latency
+    MockHandler.jitter = jitter
+    MockHandler.error_rate = error_rate
+    MockHandler.unsure_rate = unsure_rate
+    MockHandler.requests_per_minute = requests_per_minute
+    MockHandler.throttle_rate = throttle_rate
+    MockHandler.state.reset_limit(requests_per_minute)
+
+
+def serve(port: int = 8765, latency: float = 0.0, jitter: float = 0.0,
+          error_rate: float = 0.0, unsure_rate: float = 0.0,
+          requests_per_minute: float = 0.0, throttle_rate: float = 0.0) -> ThreadingHTTPServer:
+    """Start the mock server in a background thread and return it."""
+    configure(latency, jitter, error_rate, unsure_rate, requests_per_minute, throttle_rate)
+    server = ThreadingHTTPServer(('127.0.0.1', port), MockHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a local stand-in for the AI provider APIs')
+    parser.add_argument('--port', type=int, default=8765, help='Port to listen on (default: 8765)')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds to wait before answering each receipt (default: 0)')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='Random +/- variation added to --latency (default: 0)')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Fraction of receipt calls that fail with HTTP 500 (default: 0)')
+    parser.add_argument('--unsure-rate', type=float, default=0.0,
+                        help='Fraction of answers returned with low confidence (default: 0)')
+    parser.add_argument('--requests-per-minute', type=float, default=0.0,
+                        help='Answer HTTP 429 to receipt calls over this rate (default: no limit)')
+    parser.add_argument('--throttle-rate', type=float, default=0.0,
+                        help='Fraction of receipt calls that get HTTP 429 anyway (default: 0)')
+    args = parser.parse_args()
+
+    configure(args.latency, args.jitter, args.error_rate, args.unsure_rate,
+              args.requests_per_minute, args.throttle_rate)
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), MockHandler)
+    server.daemon_threads = True
+    print(f"Mock provider listening on http://127.0.0.1:{args.port}/v1")
+    print("Set api_base_url in config.yaml to this address. Press Ctrl+C to stop.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,17 @@
+import parse_receipt
+
+
+def test_discarded_image_is_no_longer_matched(tmp_path):
+    index = parse_receipt.DuplicateIndex(str(tmp_path / 'duplicates.sqlite'))
+    try:
+        assert index.check_and_add(0b1111, 'a', 'a.jpg') == (None, True)
+        assert index.check_and_add(0b0111, 'b', 'b.jpg')[0] == ('a', 'a.jpg', 1)
+
+        index.discard('a')
+
+        assert index.find(0b1111) == ('b', 'b.jpg', 1)
+        assert index.find(0b1111, 'b') is None
+        assert len(index) == 1
+        index.discard('a')  # Already gone
+    finally:
+        index.close()
@@ -0,0 +1,79 @@
+import os
+from datetime import datetime
+
+import pandas as pd
+import pytest
+
+import parse_receipt
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'config.yaml')
+
+
+def receipt(n, **fields):
+    return dict({
+        'date': '01/10/2026', 'vendor': f"Shop {n}", 'category': 'Others', 'total': 10.0 + n,
+        'currency': 'SGD', 'confidence': 'high', 'file_name': f"receipt-{n}.jpg",
+        'processed_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'content_hash': f"{n:064x}", 'items': [{'description': 'Item', 'amount': 10.0 + n}],
+    }, **fields)
+
+
+@pytest.fixture
+def config(tmp_path):
+    config = parse_receipt.load_config(CONFIG_PATH)
+    config.update(output_folder=str(tmp_path), merge_files='monthly')
+    return config
+
+
+def workbook_path(config):
+    filename, _, _ = parse_receipt.export_period('monthly')
+    return os.path.join(config['output_folder'], filename)
+
+
+def save(records, config):
+    ledger = parse_receipt.open_ledger(config)
+    try:
+        return parse_receipt.save_output(records, config, ledger)
+    finally:
+        ledger.close()
+
+
+def test_workbook_from_before_the_ledger_is_kept(config):
+    # As written by earlier versions: output columns only, no content hash
+    columns = config['output_columns']
+    rows = [{key: record.get(key) for key in columns} for record in map(receipt, range(5))]
+    pd.DataFrame(rows, columns=columns).to_excel(workbook_path(config), sheet_name='Expenses',
+                                                 index=False)
+
+    save([receipt(5)], config)
+
+    df = pd.read_excel(workbook_path(config), sheet_name='Expenses')
+    assert sorted(df['file_name']) == [f"receipt-{n}.jpg" for n in range(6)]
+
+    save([receipt(6)], config)  # The imported rows are not added twice
+    assert len(pd.read_excel(workbook_path(config), sheet_name='Expenses')) == 7
+
+
+def test_hand_edits_survive_the_next_run(config):
+    save([receipt(0), receipt(1)], config)
+    df = pd.read_excel(workbook_path(config), sheet_name='Expenses')
+    df.loc[df['file_name'] == 'receipt-0.jpg', 'vendor'] = 'Corrected Vendor'
+    df.to_excel(workbook_path(config), sheet_name='Expenses', index=False)
+
+    save([receipt(2)], config)
+
+    df = pd.read_excel(workbook_path(config), sheet_name='Expenses')
+    assert len(df) == 3
+    assert df.loc[df['file_name'] == 'receipt-0.jpg', 'vendor'].tolist() == ['Corrected Vendor']
+
+
+def test_edited_row_of_a_reprocessed_receipt_gives_way(config):
+    save([receipt(0, processed_at='2000-01-01 00:00:00')], config)
+    df = pd.DataFrame([{'file_name': 'receipt-0.jpg', 'vendor': 'Old',
+                        'processed_at': '2000-01-01 00:00:00'}])
+    df.to_excel(workbook_path(config), sheet_name='Expenses', index=False)
+
+    save([receipt(0, vendor='New')], config)
+
+    df = pd.read_excel(workbook_path(config), sheet_name='Expenses')
+    assert df['vendor'].tolist() == ['New']
@@ -0,0 +1,24 @@
+import pytest
+from PIL import Image
+
+import parse_receipt
+
+
+@pytest.mark.parametrize('mode', ['P', '1', 'I;16', 'RGBA', 'L'])
+def test_load_image_reduces_any_mode(tmp_path, mode):
+    path = tmp_path / f"scan-{mode.replace(';', '')}.png"
+    Image.new(mode, (400, 450)).save(path)
+
+    img = parse_receipt.load_image(str(path), 100)
+
+    assert img.mode in ('RGB', 'L')
+    assert max(img.size) <= 225  # Reduced by 4 before any resize
+
+
+@pytest.mark.parametrize('mode', ['P', '1'])
+def test_resize_and_dhash_accept_palette_and_1bit_scans(tmp_path, mode):
+    path = tmp_path / 'scan.png'
+    Image.new(mode, (400, 450)).save(path)
+
+    assert parse_receipt.resize_image(str(path), quality='low')[:2] == b'\xff\xd8'  # A JPEG
+    assert 0 <= parse_receipt.image_dhash(str(path)) < 2 ** 64
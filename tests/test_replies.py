@@ -0,0 +1,23 @@
+from types import SimpleNamespace
+
+import pytest
+
+import parse_receipt
+
+
+@pytest.mark.parametrize('content', [None, [], [SimpleNamespace(type='text', text='')]])
+def test_empty_anthropic_reply_is_a_parse_error(content):
+    with pytest.raises(ValueError, match='no receipt data'):
+        parse_receipt.parse_reply(parse_receipt.anthropic_reply_text(content))
+
+
+def test_openai_refusal_is_a_parse_error():
+    message = SimpleNamespace(refusal="I can't help with that.", content=None)
+    with pytest.raises(ValueError, match='refused'):
+        parse_receipt.openai_reply_text(message)
+
+
+def test_short_prompt_is_not_marked_for_caching():
+    config = {'model': 'claude-3-5-haiku-20241022'}
+    request = parse_receipt.build_anthropic_request(None, config, text='Total 5.00')
+    assert 'cache_control' not in request['system'][0]
@@ -0,0 +1,28 @@
+import pytest
+
+import parse_receipt
+
+ALIASES = {
+    'SB': 'Starbucks',
+    'NTUC': 'NTUC FairPrice',
+    'Fairprice': 'NTUC FairPrice',
+    'KFC': 'Kentucky Fried Chicken',
+}
+
+
+@pytest.mark.parametrize('vendor, expected', [
+    ('SB', 'Starbucks'),
+    ('starbucks #123', 'Starbucks'),
+    ('NTUC FalrPrice', 'NTUC FairPrice'),       # OCR noise
+    ('Kentucky Fried Chiken', 'Kentucky Fried Chicken'),
+    ('Starbucks Reserve', 'Starbucks Reserve'),  # An extra word is another vendor
+    ('NTUC Income', 'NTUC Income'),
+    ('Unity', 'Unity'),
+])
+def test_normalize_vendor_takes_the_aliases(vendor, expected):
+    assert parse_receipt.normalize_vendor(vendor, ALIASES) == expected
+
+
+def test_config_index_uses_the_threshold():
+    config = {'vendor_aliases': ALIASES, 'vendor_match_threshold': 0}
+    assert parse_receipt.get_vendor_index(config).match('NTUC FalrPrice')[0] == 'NTUC FalrPrice'